@@ -0,0 +1,243 @@
+"""
+Patient analytics for the doctor's patient view
+
+All statistics, categorical breakdowns and time buckets are computed with
+SQL aggregates so the database returns a few hundred grouped rows instead of
+the patient's whole log history. Time buckets are read from the
+SmokingDailyRollup table (see rollups.py), which holds at most one row per
+patient per hour.
+"""
+import hashlib
+from datetime import datetime, timedelta
+from sqlalchemy import func, case
+from models import db, MedicalReport, SmokingDailyRollup, SmokingLog, User
+
+CATEGORY_FIELDS = ('trigger', 'location', 'emotion', 'who_with')
+PATIENT_SORTS = ('name', 'email', 'last_log', 'smoked_7d', 'resist_rate', 'reports')
+MONTH_NAMES = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+smoked_flag = case((SmokingLog.smoke_or_resist == 'Smoked', 1), else_=0)
+resisted_flag = case((SmokingLog.smoke_or_resist == 'Resisted', 1), else_=0)
+
+
+def patient_stats(patient_id):
+    """Totals, smoked/resisted counts and average urge level"""
+    total, smoked, resisted, avg_urge = db.session.query(
+        func.count(SmokingLog.id),
+        func.coalesce(func.sum(smoked_flag), 0),
+        func.coalesce(func.sum(resisted_flag), 0),
+        func.avg(SmokingLog.urge_level)
+    ).filter(SmokingLog.user_id == patient_id).one()
+
+    total_reports = db.session.query(func.count(MedicalReport.id))\
+        .filter(MedicalReport.user_id == patient_id).scalar()
+
+    return {
+        'total_entries': total,
+        'smoked_count': smoked,
+        'resisted_count': resisted,
+        'avg_urge_level': float(avg_urge) if avg_urge is not None else 0,
+        'total_reports': total_reports
+    }
+
+
+def _category_counts(patient_id, field_name):
+    """Return (value, count, smoked_count) rows for one categorical column"""
+    column = getattr(SmokingLog, field_name)
+    count = func.count(SmokingLog.id)
+    return db.session.query(column, count, func.sum(smoked_flag))\
+        .filter(SmokingLog.user_id == patient_id,
+                column.isnot(None),
+                func.trim(column) != '')\
+        .group_by(column)\
+        .order_by(count.desc(), column)\
+        .all()
+
+
+def patient_chart_data(patient_id):
+    """Categorical breakdowns used by the 'Overall' charts"""
+    chart_data = {}
+    for field_name in CATEGORY_FIELDS:
+        rows = _category_counts(patient_id, field_name)
+        chart_data[field_name] = [(value, count) for value, count, _ in rows] or None
+
+        if field_name in ('trigger', 'location'):
+            smoked = sorted(((value, smoked) for value, _, smoked in rows if smoked),
+                            key=lambda x: x[1], reverse=True)
+            chart_data[f'{field_name}_smoke'] = smoked or None
+
+    urge_rows = db.session.query(SmokingLog.urge_level, func.count(SmokingLog.id))\
+        .filter(SmokingLog.user_id == patient_id)\
+        .group_by(SmokingLog.urge_level)\
+        .order_by(SmokingLog.urge_level)\
+        .all()
+    chart_data['urge_level'] = [(level, count) for level, count in urge_rows] or None
+
+    return chart_data
+
+
+def _smoked_per_day(patient_id, start, end):
+    """Map of date -> smoked count for dates in [start, end]"""
+    rows = db.session.query(SmokingDailyRollup.day, func.sum(SmokingDailyRollup.smoked_count))\
+        .filter(SmokingDailyRollup.user_id == patient_id,
+                SmokingDailyRollup.day >= start,
+                SmokingDailyRollup.day <= end,
+                SmokingDailyRollup.smoked_count > 0)\
+        .group_by(SmokingDailyRollup.day)\
+        .all()
+    return {day: count for day, count in rows}
+
+
+def _smoked_per_hour(patient_id, day):
+    """Map of hour -> smoked count for a single day"""
+    rows = db.session.query(SmokingDailyRollup.hour, SmokingDailyRollup.smoked_count)\
+        .filter(SmokingDailyRollup.user_id == patient_id,
+                SmokingDailyRollup.day == day)\
+        .all()
+    return {hour: count for hour, count in rows}
+
+
+def patient_summaries(patient_id, today=None):
+    """Smoked counts bucketed for the last 30 days, this week, today, this month and this year"""
+    today = today or datetime.utcnow().date()
+
+    start_30 = today - timedelta(days=29)
+    week_monday = today - timedelta(days=today.weekday())
+    week_days = [week_monday + timedelta(days=i) for i in range(7)]
+    first_of_month = today.replace(day=1)
+    if first_of_month.month == 12:
+        first_next_month = first_of_month.replace(year=first_of_month.year + 1, month=1)
+    else:
+        first_next_month = first_of_month.replace(month=first_of_month.month + 1)
+    year_start = today.replace(month=1, day=1)
+    year_end = today.replace(month=12, day=31)
+
+    # One grouped query covers every day-level window
+    per_day = _smoked_per_day(patient_id,
+                              min(start_30, week_monday, year_start),
+                              max(year_end, week_days[-1]))
+
+    last30_days = [start_30 + timedelta(days=i) for i in range(30)]
+    summary_last30 = {
+        'labels': [d.strftime('%Y-%m-%d') for d in last30_days],
+        'counts': [per_day.get(d, 0) for d in last30_days]
+    }
+
+    summary_lastweek = {
+        'labels': [d.strftime('%a %d') for d in week_days],
+        'counts': [per_day.get(d, 0) for d in week_days]
+    }
+
+    per_hour = _smoked_per_hour(patient_id, today)
+    summary_today = {
+        'labels': [f'{h:02d}:00' for h in range(24)],
+        'counts': [per_hour.get(h, 0) for h in range(24)]
+    }
+
+    days_in_month = (first_next_month - first_of_month).days
+    summary_month = {
+        'labels': [str(day) for day in range(1, days_in_month + 1)],
+        'counts': [per_day.get(first_of_month.replace(day=day), 0) for day in range(1, days_in_month + 1)]
+    }
+
+    month_counts = {m: 0 for m in range(1, 13)}
+    for day, count in per_day.items():
+        if year_start <= day <= year_end:
+            month_counts[day.month] += count
+    summary_year = {
+        'labels': MONTH_NAMES,
+        'counts': [month_counts[m] for m in range(1, 13)]
+    }
+
+    return {
+        'summary_last30': summary_last30,
+        'summary_lastweek': summary_lastweek,
+        'summary_today': summary_today,
+        'summary_month': summary_month,
+        'summary_year': summary_year
+    }
+
+
+def compute_patient_analytics(patient_id, today=None):
+    """Return the stats, chart_data and summary_* structures for view_patient.html"""
+    analytics = {
+        'stats': patient_stats(patient_id),
+        'chart_data': patient_chart_data(patient_id)
+    }
+    analytics.update(patient_summaries(patient_id, today))
+    return analytics
+
+
+def analytics_etag(patient_id, today=None):
+    """Strong ETag for compute_patient_analytics, from one cheap query
+
+    Logs and reports are only ever appended, so their counts and latest ids
+    change whenever the analytics would. The date is included because the
+    summaries are relative to today.
+    """
+    today = today or datetime.utcnow().date()
+    log_count = db.select(func.count(SmokingLog.id))\
+        .where(SmokingLog.user_id == patient_id).scalar_subquery()
+    last_log_id = db.select(func.max(SmokingLog.id))\
+        .where(SmokingLog.user_id == patient_id).scalar_subquery()
+    report_count = db.select(func.count(MedicalReport.id))\
+        .where(MedicalReport.user_id == patient_id).scalar_subquery()
+    fingerprint = db.session.execute(db.select(log_count, last_log_id, report_count)).one()
+
+    raw = f'{patient_id}:{fingerprint[0]}:{fingerprint[1]}:{fingerprint[2]}:{today.isoformat()}'
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def patient_overview_query(search='', sort='name', descending=False, today=None):
+    """Query every patient with their triage columns for the doctor dashboard
+
+    Each column is a correlated subquery answered from an index (the
+    (user_id, logged_at) log index, the rollup primary key and the report
+    user_id index), so the whole list is one statement. Sorted by name or
+    email, a page only evaluates the subqueries for the rows it returns;
+    sorted by last_log, smoked_7d, resist_rate or reports, the ORDER BY
+    evaluates that column's subquery for every matching patient before the
+    LIMIT applies, so those sorts cost one index lookup per patient.
+    """
+    today = today or datetime.utcnow().date()
+    week_start = today - timedelta(days=6)
+
+    last_log_at = db.select(func.max(SmokingLog.logged_at))\
+        .where(SmokingLog.user_id == User.id)\
+        .correlate(User).scalar_subquery()
+    smoked_7d = db.select(func.coalesce(func.sum(SmokingDailyRollup.smoked_count), 0))\
+        .where(SmokingDailyRollup.user_id == User.id, SmokingDailyRollup.day >= week_start)\
+        .correlate(User).scalar_subquery()
+    resist_rate = db.select(
+        func.sum(SmokingDailyRollup.resisted_count) * 1.0 /
+        func.nullif(func.sum(SmokingDailyRollup.smoked_count + SmokingDailyRollup.resisted_count), 0)
+    ).where(SmokingDailyRollup.user_id == User.id)\
+        .correlate(User).scalar_subquery()
+    report_count = db.select(func.count(MedicalReport.id))\
+        .where(MedicalReport.user_id == User.id)\
+        .correlate(User).scalar_subquery()
+
+    columns = {
+        'name': User.name,
+        'email': User.email,
+        'last_log': last_log_at,
+        'smoked_7d': smoked_7d,
+        'resist_rate': resist_rate,
+        'reports': report_count
+    }
+
+    query = db.session.query(
+        User,
+        last_log_at.label('last_log_at'),
+        smoked_7d.label('smoked_7d'),
+        resist_rate.label('resist_rate'),
+        report_count.label('report_count')
+    ).filter(User.role == 'patient')
+
+    if search:
+        query = query.filter(User.name.icontains(search, autoescape=True) |
+                             User.email.icontains(search, autoescape=True))
+
+    order = columns.get(sort, User.name)
+    order = order.desc() if descending else order.asc()
+    return query.order_by(order, User.id)
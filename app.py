@@ -1,12 +1,36 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify, abort, session
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify, abort, session, stream_with_context
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.exceptions import RequestEntityTooLarge
-from models import db, User, MedicalReport, SmokingLog
+from sqlalchemy import and_, func, tuple_
+from sqlalchemy.exc import IntegrityError
+from urllib.parse import quote
+from models import db, User, MedicalReport, SmokingLog, SmokingDailyRollup, SmokingLogSuggestion, UploadSession, PreviewJob
+from analytics import PATIENT_SORTS, analytics_etag, compute_patient_analytics, patient_overview_query
+from cohort import COHORT_FIELDS, build_cohort, cohort_patient_count, cohort_summary, refresh_cohort
+from patterns import association_rules, update_patterns
+from rollups import record_logs
+from logsync import insert_log_batch
+from logexport import iter_csv, iter_ndjson, export_rows
+from suggestions import SUGGESTION_FIELDS, SuggestionService, record_suggestions
+from cache import make_cache
+from identity import load_identity
+from storage import LocalStorage, make_storage
+from blocking import run_blocking
+from passwords import HasherBusy, LoginThrottle, PasswordHasher
+from metrics import MetricsMiddleware, MetricsRegistry
+from querydebug import QueryDebugger
+import uploads
+import previews
 from datetime import datetime, timedelta
 import os
 import re
+import json
+import mimetypes
+import base64
+import time
 import logging
 
 app = Flask(__name__)
@@ -18,23 +42,65 @@ if config_name == 'production':
 else:
     app.config.from_object('config.DevelopmentConfig')
 
+# Request latency, SQL and template metrics for /metrics, and N+1/query
+# budget checks in development
+metrics_registry = None
+query_debugger = None
+if app.config['METRICS_ENABLED']:
+    metrics_registry = MetricsRegistry(app.config['METRICS_DIR'])
+if app.config['QUERY_DEBUG']:
+    query_debugger = QueryDebugger(app, app.config['QUERY_BUDGETS'], app.config['QUERY_BUDGET_DEFAULT'],
+                                   app.config['QUERY_REPEAT_THRESHOLD'], app.config['QUERY_SLOW_STATEMENT'])
+if metrics_registry is not None or query_debugger is not None:
+    app.wsgi_app = MetricsMiddleware(app, metrics_registry, app.config['METRICS_SLOW_REQUEST'],
+                                     capture_parameters=query_debugger is not None)
+
+if app.config['PROXY_COUNT']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_COUNT'], x_proto=app.config['PROXY_COUNT'])
+
+# Password hashing off the request thread, and brute-force throttling
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'],
+                                 app.config['PASSWORD_HASH_WORKERS'],
+                                 app.config['PASSWORD_HASH_MAX_PENDING'])
+login_throttle = LoginThrottle(app.config['LOGIN_THROTTLE_PATH'], app.config['LOGIN_THROTTLE_WINDOW'])
+
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# Content-addressed report storage
+storage = make_storage(app.config)
+
+# Background thumbnail/preview generation
+preview_pool = previews.PreviewPool(app, storage, app.config['PREVIEW_WORKERS'])
+
+# Part files of resumable uploads in progress
+upload_tmp_folder = app.config['UPLOAD_TMP_FOLDER'] or os.path.join(app.config['UPLOAD_FOLDER'], 'partial')
+os.makedirs(upload_tmp_folder, exist_ok=True)
+
 db.init_app(app)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+analytics_cache = make_cache('analytics', app.config)
+cohort_cache = make_cache('cohort', app.config)
+patterns_cache = make_cache('patterns', app.config)
+identity_cache = make_cache('identity', app.config,
+                            local_ttl=app.config['IDENTITY_CACHE_TTL'],
+                            shared_ttl=app.config['IDENTITY_CACHE_TTL'])
+
+suggestion_service = SuggestionService(app.config['AUTOCOMPLETE_CACHE_SIZE'],
+                                       app.config['AUTOCOMPLETE_CACHE_TTL'])
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Please login to access this page.'
 
 @login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
+def load_user(session_id):
+    return load_identity(session_id, identity_cache)
 
 
 # Validation utilities
@@ -64,6 +130,17 @@ def validate_password(password):
     return True, ""
 
 
+def duplicate_user_field(error):
+    """'email' or 'username' for an IntegrityError from the user table's unique columns"""
+    diag = getattr(error.orig, 'diag', None)  # psycopg2 names the constraint
+    detail = getattr(diag, 'constraint_name', None) or str(error.orig).rsplit(':', 1)[-1]
+    if 'email' in detail:
+        return 'email'
+    if 'username' in detail:
+        return 'username'
+    return None
+
+
 def sanitize_input(text, max_length=200):
     """Sanitize user input"""
     if not text:
@@ -76,6 +153,144 @@ def sanitize_input(text, max_length=200):
     return text
 
 
+def validate_log_entry(data):
+    """Check and clean one smoking log entry from a form or JSON object
+    
+    Returns (column values, None), or (None, error message).
+    """
+    def text(name):
+        value = data.get(name)
+        return '' if value is None else str(value).strip()
+    
+    # Validate required fields
+    date = text('date')
+    time = text('time')
+    smoke_or_resist = text('smoke_or_resist')
+    if not date or not time or not smoke_or_resist:
+        return None, 'Date, time, and action are required'
+    
+    logged_at = SmokingLog.parse_logged_at(date, time)
+    if logged_at is None:
+        return None, 'Invalid date or time'
+    
+    # Validate urge level: a form sends text, JSON a number (but not true/false or 2.5)
+    urge_level = data.get('urge_level')
+    if isinstance(urge_level, str):
+        try:
+            urge_level = int(urge_level.strip())
+        except ValueError:
+            return None, 'Invalid urge level'
+    if not isinstance(urge_level, int) or isinstance(urge_level, bool):
+        return None, 'Invalid urge level'
+    if urge_level < 1 or urge_level > 5:
+        return None, 'Urge level must be between 1 and 5'
+    
+    # Validate smoke_or_resist
+    if smoke_or_resist not in ['Smoked', 'Resisted']:
+        return None, 'Invalid action selected'
+    
+    # Store the parsed values, zero padded, since the log is ordered by these strings
+    return {
+        'date': logged_at.strftime('%Y-%m-%d'),
+        'time': logged_at.strftime('%H:%M'),
+        'logged_at': logged_at,
+        'location': sanitize_input(text('location'), 200),
+        'trigger': sanitize_input(text('trigger'), 200),
+        'emotion': sanitize_input(text('emotion'), 200),
+        'who_with': sanitize_input(text('who_with'), 200),
+        'urge_level': urge_level,
+        'smoke_or_resist': smoke_or_resist,
+        'how_it_felt': sanitize_input(text('how_it_felt'), 200),
+        'notes': sanitize_input(text('notes'), 500)
+    }, None
+
+
+# Smoking log pagination (keyset on date, time, id - newest first)
+def encode_log_cursor(log):
+    """Opaque cursor pointing just past log"""
+    raw = json.dumps([log.date, log.time, log.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_log_cursor(cursor):
+    """Return (date, time, id) from a cursor, or None if it is malformed"""
+    try:
+        date, time, log_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(date), str(time), int(log_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def smoking_log_page(patient_id, after=None, limit=50):
+    """One page of a patient's logs and the cursor for the next page (None on the last page)"""
+    query = SmokingLog.query.filter_by(user_id=patient_id)
+    if after:
+        query = query.filter(tuple_(SmokingLog.date, SmokingLog.time, SmokingLog.id) < after)
+    
+    logs = query.order_by(SmokingLog.date.desc(), SmokingLog.time.desc(), SmokingLog.id.desc())\
+        .limit(limit + 1).all()
+    
+    next_cursor = encode_log_cursor(logs[limit - 1]) if len(logs) > limit else None
+    return logs[:limit], next_cursor
+
+
+def get_patient_analytics(patient_id):
+    """compute_patient_analytics through the analytics cache"""
+    today = datetime.utcnow().date()
+    generation = analytics_cache.generation(patient_id)
+    analytics = analytics_cache.get(patient_id, variant=today.isoformat(), generation=generation)
+    if analytics is None:
+        analytics = compute_patient_analytics(patient_id, today)
+        analytics_cache.set(patient_id, analytics, variant=today.isoformat(), generation=generation)
+    return analytics
+
+
+def get_cohort_analytics(search=''):
+    """cohort_summary through the cohort cache, folding in logs added since it was stored"""
+    key = search.lower()
+    generation = cohort_cache.generation('cohort')
+    data = cohort_cache.get('cohort', variant=key, generation=generation)
+    if data is None or time.time() - data['built_at'] > app.config['COHORT_REBUILD_AFTER']:
+        data = build_cohort(search)
+        cohort_cache.set('cohort', data, variant=key, generation=generation)
+    else:
+        refreshed = refresh_cohort(data, search)
+        if refreshed is not None:
+            data = refreshed
+            cohort_cache.set('cohort', data, variant=key, generation=generation)
+    return cohort_summary(data, cohort_patient_count(search))
+
+
+def get_patient_patterns(patient_id):
+    """association_rules for a patient from the memoized itemset counts, counting only new logs"""
+    generation = patterns_cache.generation(patient_id)
+    memo = patterns_cache.get(patient_id, generation=generation)
+    if memo is not None and time.time() - memo.get('built_at', 0) > app.config['PATTERN_REBUILD_AFTER']:
+        memo = None
+    updated = update_patterns(patient_id, memo)
+    if updated is not None:
+        memo = updated
+        patterns_cache.set(patient_id, memo, generation=generation)
+    return association_rules(memo, app.config['PATTERN_MIN_SUPPORT'], app.config['PATTERN_RULE_LIMIT'])
+
+
+def serialize_log(log):
+    """JSON representation of a SmokingLog row"""
+    return {
+        'id': log.id,
+        'date': log.date,
+        'time': log.time,
+        'location': log.location,
+        'trigger': log.trigger,
+        'emotion': log.emotion,
+        'who_with': log.who_with,
+        'urge_level': log.urge_level,
+        'smoke_or_resist': log.smoke_or_resist,
+        'how_it_felt': log.how_it_felt,
+        'notes': log.notes
+    }
+
+
 # Error handlers
 @app.errorhandler(404)
 def not_found_error(error):
@@ -145,16 +360,13 @@ def register():
         name = sanitize_input(name, 120)
         role = role if role in ['patient', 'doctor'] else 'patient'
         
-        # Check if username already exists
-        if User.query.filter_by(username=username).first():
-            flash('Username already taken!', 'error')
-            return redirect(url_for('register'))
-        
-        # Check if email already exists
-        if User.query.filter_by(email=email.lower()).first():
-            flash('Email already registered!', 'error')
+        # Logins containing @ are looked up by email
+        if '@' in username:
+            flash('Username cannot contain @', 'error')
             return redirect(url_for('register'))
         
+        # Duplicate usernames (in any case) and emails are caught by the
+        # unique indexes on insert
         try:
             # Create new user
             user = User(
@@ -162,7 +374,7 @@ def register():
                 email=email.lower(),
                 name=name,
                 role=role,
-                password_hash=generate_password_hash(password)
+                password_hash=password_hasher.hash(password)
             )
             db.session.add(user)
             db.session.commit()
@@ -170,6 +382,16 @@ def register():
             logger.info(f'New user registered: {username} ({role})')
             flash('Registration successful! Please login.', 'success')
             return redirect(url_for('login'))
+        except IntegrityError as e:
+            db.session.rollback()
+            if duplicate_user_field(e) == 'email':
+                flash('Email already registered!', 'error')
+            else:
+                flash('Username already taken!', 'error')
+            return redirect(url_for('register'))
+        except HasherBusy:
+            flash('The server is busy. Please try again in a moment.', 'error')
+            return render_template('register.html'), 503
         except Exception as e:
             db.session.rollback()
             logger.error(f'Registration error: {e}')
@@ -190,13 +412,35 @@ def login():
             flash('Username/Email and password are required', 'error')
             return render_template('login.html')
         
+        # Throttle before hashing anything: per client IP, then per account
+        ip_key = f'ip:{request.remote_addr}'
+        retry_after = login_throttle.attempt(ip_key, app.config['LOGIN_MAX_ATTEMPTS_PER_IP'])
+        
         try:
-            # Try to find user by username or email
-            user = User.query.filter(
-                (User.username == login_input) | (User.email == login_input.lower())
-            ).first()
+            # One point lookup: emails and lowercased usernames are both uniquely indexed
+            user = None
+            if not retry_after:
+                column = User.email if '@' in login_input else User.username_lower
+                user = User.query.filter(column == login_input.lower()).first()
+                if user:
+                    retry_after = login_throttle.attempt(f'user:{user.id}', app.config['LOGIN_MAX_ATTEMPTS_PER_ACCOUNT'])
             
-            if user and check_password_hash(user.password_hash, password):
+            if retry_after:
+                logger.warning(f'Login throttled for: {login_input} from {request.remote_addr}')
+                flash(f'Too many login attempts. Please try again in {(retry_after + 59) // 60} minute(s).', 'error')
+                return render_template('login.html'), 429
+            
+            if user and password_hasher.verify(user.password_hash, password):
+                login_throttle.reset(f'user:{user.id}')
+                login_throttle.release(ip_key)
+                if password_hasher.needs_rehash(user.password_hash):
+                    # Hashing parameters changed since this hash was made
+                    try:
+                        user.password_hash = password_hasher.hash(password)
+                        db.session.commit()
+                    except HasherBusy:
+                        pass  # upgrade on a later login
+                
                 login_user(user, remember=True)
                 session.permanent = True
                 logger.info(f'User logged in: {user.username} ({user.role})')
@@ -212,6 +456,12 @@ def login():
             else:
                 logger.warning(f'Failed login attempt for: {login_input}')
                 flash('Invalid username/email or password', 'error')
+        except HasherBusy:
+            login_throttle.release(ip_key)
+            if user:
+                login_throttle.release(f'user:{user.id}')
+            flash('The server is busy. Please try again in a moment.', 'error')
+            return render_template('login.html'), 503
         except Exception as e:
             logger.error(f'Login error: {e}')
             flash('An error occurred. Please try again.', 'error')
@@ -236,7 +486,7 @@ def patient_dashboard():
     
     # Get recent smoking logs
     recent_logs = SmokingLog.query.filter_by(user_id=current_user.id)\
-        .order_by(SmokingLog.date.desc(), SmokingLog.time.desc())\
+        .order_by(SmokingLog.logged_at.desc(), SmokingLog.id.desc())\
         .limit(10).all()
     
     # Get medical reports
@@ -257,55 +507,19 @@ def add_smoking_log():
         return redirect(url_for('doctor_dashboard'))
     
     try:
-        # Validate required fields
-        date = request.form.get('date', '').strip()
-        time = request.form.get('time', '').strip()
-        urge_level = request.form.get('urge_level', '0')
-        smoke_or_resist = request.form.get('smoke_or_resist', '').strip()
-        
-        if not date or not time or not smoke_or_resist:
-            flash('Date, time, and action are required', 'error')
+        fields, error = validate_log_entry(request.form)
+        if error:
+            flash(error, 'error')
             return redirect(url_for('patient_dashboard'))
         
-        # Validate urge level
-        try:
-            urge_level = int(urge_level)
-            if urge_level < 1 or urge_level > 5:
-                flash('Urge level must be between 1 and 5', 'error')
-                return redirect(url_for('patient_dashboard'))
-        except ValueError:
-            flash('Invalid urge level', 'error')
-            return redirect(url_for('patient_dashboard'))
-        
-        # Validate smoke_or_resist
-        if smoke_or_resist not in ['Smoked', 'Resisted']:
-            flash('Invalid action selected', 'error')
-            return redirect(url_for('patient_dashboard'))
-        
-        # Sanitize optional fields
-        location = sanitize_input(request.form.get('location', ''), 200)
-        trigger = sanitize_input(request.form.get('trigger', ''), 200)
-        emotion = sanitize_input(request.form.get('emotion', ''), 200)
-        who_with = sanitize_input(request.form.get('who_with', ''), 200)
-        how_it_felt = sanitize_input(request.form.get('how_it_felt', ''), 200)
-        notes = sanitize_input(request.form.get('notes', ''), 500)
-        
-        log = SmokingLog(
-            user_id=current_user.id,
-            date=date,
-            time=time,
-            location=location,
-            trigger=trigger,
-            emotion=emotion,
-            who_with=who_with,
-            urge_level=urge_level,
-            smoke_or_resist=smoke_or_resist,
-            how_it_felt=how_it_felt,
-            notes=notes
-        )
+        log = SmokingLog(user_id=current_user.id, **fields)
         
         db.session.add(log)
+        record_logs([log])
+        record_suggestions([log])
         db.session.commit()
+        suggestion_service.invalidate(current_user.id)
+        analytics_cache.invalidate(current_user.id)
         
         logger.info(f'Smoking log added by user {current_user.email}')
         flash('Smoking log entry added successfully!', 'success')
@@ -317,6 +531,93 @@ def add_smoking_log():
         return redirect(url_for('patient_dashboard'))
 
 
+@app.route('/api/smoking-logs/batch', methods=['POST'])
+@login_required
+def sync_smoking_logs():
+    """Store a batch of smoking logs recorded offline, idempotently
+    
+    Body: {"entries": [{"client_id": ..., "date": ..., "time": ..., ...}]}.
+    Each entry gets a result: created, duplicate (already stored) or invalid.
+    """
+    if current_user.role == 'doctor':
+        return jsonify({'error': 'Access denied'}), 403
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    entries = data.get('entries')
+    if not isinstance(entries, list):
+        return jsonify({'error': 'entries must be a list'}), 400
+    if len(entries) > app.config['LOG_BATCH_MAX_SIZE']:
+        return jsonify({'error': f"At most {app.config['LOG_BATCH_MAX_SIZE']} entries per batch"}), 413
+    
+    results = []
+    valid = {}
+    for entry in entries:
+        client_id = entry.get('client_id') if isinstance(entry, dict) else None
+        if not isinstance(client_id, str) or not 0 < len(client_id) <= 64:
+            results.append({'client_id': client_id, 'status': 'invalid', 'error': 'client_id is required (at most 64 characters)'})
+            continue
+        fields, error = validate_log_entry(entry)
+        if error:
+            results.append({'client_id': client_id, 'status': 'invalid', 'error': error})
+        elif client_id in valid:
+            results.append({'client_id': client_id, 'status': 'invalid', 'error': 'client_id repeated in batch'})
+        else:
+            valid[client_id] = fields
+            results.append({'client_id': client_id})
+    
+    try:
+        stored = insert_log_batch(current_user.id, valid)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f'Error syncing smoking logs: {e}')
+        return jsonify({'error': 'An error occurred. Please try again.'}), 500
+    
+    created = 0
+    for result in results:
+        if 'status' not in result:
+            log_id, is_new = stored[result['client_id']]
+            result.update(status='created' if is_new else 'duplicate', id=log_id)
+            created += is_new
+    
+    if created:
+        suggestion_service.invalidate(current_user.id)
+        analytics_cache.invalidate(current_user.id)
+        logger.info(f'{created} smoking logs synced by user {current_user.email}')
+    
+    return jsonify({'created': created, 'results': results})
+
+
+def store_blob(stream):
+    """Save a file to report storage; returns (content_hash, size)
+    
+    Local storage is disk- and hash-bound, so it runs off the gevent loop.
+    Remote storage mostly waits on the network, which gevent already
+    multiplexes (and its sockets must stay on the loop's thread).
+    """
+    if isinstance(storage, LocalStorage):
+        return run_blocking(storage.save, stream)
+    return storage.save(stream)
+
+
+def add_report(user_id, report_name, original_filename, content_hash, size):
+    """Add a MedicalReport for a stored blob; the caller commits"""
+    # Secure filename
+    filename = datetime.now().strftime('%Y%m%d_%H%M%S_') + secure_filename(original_filename)
+    report = MedicalReport(
+        user_id=user_id,
+        report_name=report_name,
+        filename=filename,
+        content_hash=content_hash,
+        size=size,
+        content_type=mimetypes.guess_type(filename)[0]
+    )
+    db.session.add(report)
+    return report
+
+
 @app.route('/patient/upload-report', methods=['POST'])
 @login_required
 def upload_report():
@@ -348,24 +649,15 @@ def upload_report():
         return redirect(url_for('patient_dashboard'))
     
     try:
-        # Secure filename
-        filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
-        filename = timestamp + filename
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
-        # Save file
-        file.save(filepath)
+        # Save file (identical contents share one stored blob)
+        content_hash, size = store_blob(file.stream)
         
         # Create database entry
-        report = MedicalReport(
-            user_id=current_user.id,
-            report_name=report_name,
-            filename=filename
-        )
-        
-        db.session.add(report)
+        report = add_report(current_user.id, report_name, file.filename, content_hash, size)
+        preview_job_id = previews.enqueue(report)
         db.session.commit()
+        preview_pool.submit(preview_job_id)
+        analytics_cache.invalidate(current_user.id)
         
         logger.info(f'Medical report uploaded by user {current_user.email}: {report_name}')
         flash('Medical report uploaded successfully!', 'success')
@@ -377,6 +669,179 @@ def upload_report():
     return redirect(url_for('patient_dashboard'))
 
 
+def find_upload(upload_id):
+    """The current user's upload session, or None"""
+    upload = db.session.get(UploadSession, upload_id)
+    if upload is None or upload.user_id != current_user.id:
+        return None
+    return upload
+
+
+def upload_state(upload):
+    return {
+        'upload_id': upload.id,
+        'offset': upload.received,
+        'size': upload.size,
+        'chunk_size': app.config['UPLOAD_CHUNK_SIZE']
+    }
+
+
+@app.route('/patient/uploads', methods=['POST'])
+@login_required
+def start_upload():
+    """Open a resumable upload; the file is then sent with append_upload_chunk"""
+    if current_user.role == 'doctor':
+        return jsonify({'error': 'Access denied'}), 403
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    original_filename = str(data.get('filename', ''))
+    report_name = sanitize_input(str(data.get('report_name', '')), 200) or 'Unnamed Report'
+    size = data.get('size')
+    checksum = str(data.get('sha256') or '').lower() or None
+    
+    if not allowed_file(original_filename) or not is_valid_filename(original_filename):
+        return jsonify({'error': 'Invalid file type. Only PDF, JPG, and PNG files are allowed.'}), 400
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        return jsonify({'error': 'Invalid file size'}), 400
+    if size > app.config['MAX_REPORT_SIZE']:
+        return jsonify({'error': 'File is too large'}), 413
+    if checksum is not None and not re.fullmatch(r'[0-9a-f]{64}', checksum):
+        return jsonify({'error': 'Invalid checksum'}), 400
+    
+    try:
+        uploads.purge_expired(upload_tmp_folder, app.config['UPLOAD_SESSION_TTL'])
+        upload = UploadSession(
+            id=uploads.new_upload_id(),
+            user_id=current_user.id,
+            report_name=report_name,
+            original_filename=original_filename,
+            size=size,
+            checksum=checksum
+        )
+        db.session.add(upload)
+        open(uploads.part_path(upload_tmp_folder, upload.id), 'wb').close()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f'Error starting upload: {e}')
+        return jsonify({'error': 'An error occurred. Please try again.'}), 500
+    
+    return jsonify(upload_state(upload)), 201
+
+
+@app.route('/patient/uploads/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    """Where to resume an upload"""
+    upload = find_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(upload_state(upload))
+
+
+@app.route('/patient/uploads/<upload_id>', methods=['PATCH'])
+@login_required
+def append_upload_chunk(upload_id):
+    """Write the raw request body at the Upload-Offset header's position"""
+    upload = find_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    offset = request.headers.get('Upload-Offset', type=int)
+    length = request.content_length
+    if length is None:
+        return jsonify({'error': 'Content-Length required'}), 411
+    if offset != upload.received:
+        # Out of step with the server (e.g. a retried chunk): resume from here
+        return jsonify(upload_state(upload)), 409
+    if length > app.config['UPLOAD_CHUNK_SIZE'] or offset + length > upload.size:
+        return jsonify({'error': 'Chunk too large'}), 413
+    
+    try:
+        # Not run_blocking: this reads the request socket, which has to stay
+        # on the worker's own thread; the 64KB disk writes are short
+        written = uploads.write_chunk(uploads.part_path(upload_tmp_folder, upload.id),
+                                      offset, request.stream, length)
+        if not uploads.advance(upload, offset, written):
+            db.session.rollback()
+            db.session.refresh(upload)
+            return jsonify(upload_state(upload)), 409
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f'Error writing upload chunk: {e}')
+        return jsonify({'error': 'An error occurred. Please try again.'}), 500
+    
+    db.session.refresh(upload)
+    return jsonify(upload_state(upload))
+
+
+@app.route('/patient/uploads/<upload_id>/finalize', methods=['POST'])
+@login_required
+def finalize_upload(upload_id):
+    """Verify a complete upload's checksum and turn it into a MedicalReport"""
+    upload = find_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    checksum = str(data.get('sha256') or '').lower() or upload.checksum
+    if upload.received != upload.size:
+        return jsonify(upload_state(upload)), 409
+    if checksum is None:
+        return jsonify({'error': 'Checksum required'}), 400
+    
+    try:
+        with open(uploads.part_path(upload_tmp_folder, upload.id), 'rb') as part:
+            content_hash, size = store_blob(part)
+        
+        if content_hash != checksum:
+            # Corrupted in transit: drop it, the client has to start over
+            uploads.discard(upload, upload_tmp_folder)
+            db.session.commit()
+            release_report_blobs([content_hash])
+            logger.warning(f'Checksum mismatch on upload {upload_id} by user {current_user.email}')
+            return jsonify({'error': 'Checksum mismatch; please upload the file again'}), 422
+        
+        report = add_report(current_user.id, upload.report_name, upload.original_filename,
+                            content_hash, size)
+        preview_job_id = previews.enqueue(report)
+        uploads.discard(upload, upload_tmp_folder)
+        db.session.commit()
+        preview_pool.submit(preview_job_id)
+        analytics_cache.invalidate(current_user.id)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f'Error finalizing upload: {e}')
+        return jsonify({'error': 'An error occurred during upload. Please try again.'}), 500
+    
+    logger.info(f'Medical report uploaded by user {current_user.email}: {report.report_name}')
+    flash('Medical report uploaded successfully!', 'success')
+    return jsonify({
+        'report_name': report.report_name,
+        'filename': report.filename,
+        'size': report.size,
+        'url': url_for('view_report', report_id=report.id)
+    }), 201
+
+
+@app.route('/patient/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def cancel_upload(upload_id):
+    upload = find_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    uploads.discard(upload, upload_tmp_folder)
+    db.session.commit()
+    return '', 204
+
+
 @app.route('/doctor/dashboard')
 @login_required
 def doctor_dashboard():
@@ -384,10 +849,44 @@ def doctor_dashboard():
         flash('Access denied', 'error')
         return redirect(url_for('patient_dashboard'))
     
-    # Get all patients (users who are not doctors)
-    patients = User.query.filter_by(role='patient').all()
+    search = request.args.get('q', '').strip()
+    sort = request.args.get('sort', 'name')
+    if sort not in PATIENT_SORTS:
+        sort = 'name'
+    direction = 'desc' if request.args.get('dir') == 'desc' else 'asc'
     
-    return render_template('doctor_dashboard.html', patients=patients)
+    # Patients with their triage columns, one page at a time
+    patients = patient_overview_query(search, sort, direction == 'desc').paginate(
+        per_page=app.config['PATIENTS_PAGE_SIZE'],
+        max_per_page=app.config['PATIENTS_PAGE_SIZE'],
+        error_out=False
+    )
+    
+    return render_template('doctor_dashboard.html', patients=patients,
+                           search=search, sort=sort, direction=direction)
+
+
+@app.route('/doctor/cohort')
+@login_required
+def cohort_dashboard():
+    """Trigger, location and emotion frequencies, resist rates and urge levels across patients"""
+    if current_user.role != 'doctor':
+        flash('Access denied', 'error')
+        return redirect(url_for('patient_dashboard'))
+    
+    search = request.args.get('q', '').strip()
+    return render_template('cohort.html', cohort=get_cohort_analytics(search),
+                           fields=COHORT_FIELDS, search=search)
+
+
+@app.route('/api/cohort')
+@login_required
+def cohort_api():
+    """Cohort analytics as JSON; ?q= narrows the cohort like the patient search"""
+    if current_user.role != 'doctor':
+        return jsonify({'error': 'Access denied'}), 403
+    
+    return jsonify(get_cohort_analytics(request.args.get('q', '').strip()))
 
 
 @app.route('/admin/dashboard')
@@ -400,18 +899,66 @@ def admin_dashboard():
         else:
             return redirect(url_for('patient_dashboard'))
     
-    # Get all users
-    users = User.query.order_by(User.created_at.desc()).all()
-    
-    # Get statistics
+    # Get statistics (one GROUP BY over the role index)
+    role_counts = dict(db.session.query(User.role, func.count(User.id)).group_by(User.role).all())
     stats = {
-        'total_users': len(users),
-        'patients': len([u for u in users if u.role == 'patient']),
-        'doctors': len([u for u in users if u.role == 'doctor']),
-        'admins': len([u for u in users if u.role == 'admin'])
+        'total_users': sum(role_counts.values()),
+        'patients': role_counts.get('patient', 0),
+        'doctors': role_counts.get('doctor', 0),
+        'admins': role_counts.get('admin', 0)
     }
     
-    return render_template('admin_dashboard.html', users=users, stats=stats)
+    # Newest users first, optionally filtered by username/email prefix
+    search = request.args.get('q', '').strip()
+    users = User.query
+    if search:
+        # Range bounds rather than LIKE so the indexes are used; both
+        # columns are lower case, so the match ignores case
+        prefix = search.lower()
+        users = users.filter(
+            and_(User.username_lower >= prefix, User.username_lower < prefix + '\uffff') |
+            and_(User.email >= prefix, User.email < prefix + '\uffff')
+        )
+    users = users.order_by(User.created_at.desc(), User.id.desc()).paginate(
+        per_page=app.config['USERS_PAGE_SIZE'],
+        max_per_page=app.config['USERS_PAGE_SIZE'],
+        error_out=False
+    )
+    
+    return render_template('admin_dashboard.html', users=users, stats=stats, search=search)
+
+
+@app.route('/admin/cache-stats')
+@login_required
+def cache_stats():
+    """Hit/miss counters of this worker's caches"""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Access denied'}), 403
+    
+    return jsonify({
+        'pid': os.getpid(),
+        'analytics': analytics_cache.stats(),
+        'identity': identity_cache.stats()
+    })
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics of all workers of this server"""
+    if metrics_registry is None:
+        abort(404)
+    
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if request.headers.get('Authorization', '') != f'Bearer {token}':
+            return jsonify({'error': 'Access denied'}), 403
+    elif request.remote_addr not in ('127.0.0.1', '::1') or 'X-Forwarded-For' in request.headers:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    response = app.response_class(metrics_registry.render(), mimetype='text/plain')
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.cache_control.no_store = True
+    return response
 
 
 @app.route('/admin/users/<int:user_id>')
@@ -449,21 +996,26 @@ def update_user(user_id):
         if user.role not in ['patient', 'doctor', 'admin']:
             user.role = 'patient'
         
-        # Check for duplicate username (excluding current user)
-        existing = User.query.filter(User.id != user.id, User.username == user.username).first()
-        if existing:
-            flash('Username already taken', 'error')
-            return redirect(url_for('view_user', user_id=user_id))
-        
-        # Check for duplicate email (excluding current user)
-        existing = User.query.filter(User.id != user.id, User.email == user.email).first()
-        if existing:
-            flash('Email already registered', 'error')
+        if '@' in user.username:
+            db.session.rollback()
+            flash('Username cannot contain @', 'error')
             return redirect(url_for('view_user', user_id=user_id))
         
+        # Duplicates are caught by the unique indexes
         db.session.commit()
+        identity_cache.invalidate(user_id)
+        cohort_cache.invalidate('cohort')
+        if user.id == current_user.id:
+            login_user(user, remember=True)  # the write replaced the version in this session
         logger.info(f'User {user_id} updated by admin {current_user.username}')
         flash('User updated successfully', 'success')
+    except IntegrityError as e:
+        db.session.rollback()
+        if duplicate_user_field(e) == 'email':
+            flash('Email already registered', 'error')
+        else:
+            flash('Username already taken', 'error')
+        return redirect(url_for('view_user', user_id=user_id))
     except Exception as e:
         db.session.rollback()
         logger.error(f'Error updating user: {e}')
@@ -487,8 +1039,23 @@ def delete_user(user_id):
         return redirect(url_for('admin_dashboard'))
     
     try:
+        content_hashes = [report.content_hash for report in user.medical_reports]
+        for report in user.medical_reports:
+            db.session.delete(report)
+        for upload in UploadSession.query.filter_by(user_id=user.id).all():
+            uploads.discard(upload, upload_tmp_folder)
+        for model in (SmokingLog, SmokingDailyRollup, SmokingLogSuggestion):
+            model.query.filter_by(user_id=user.id).delete(synchronize_session=False)
         db.session.delete(user)
         db.session.commit()
+        release_report_blobs(content_hashes)
+        # SQLite may give the id to the next new user, who must not inherit
+        # anything cached for this one
+        identity_cache.invalidate(user_id)
+        analytics_cache.invalidate(user_id)
+        patterns_cache.invalidate(user_id)
+        suggestion_service.invalidate(user_id)
+        cohort_cache.invalidate('cohort')
         logger.info(f'User {user_id} deleted by admin {current_user.username}')
         flash('User deleted successfully', 'success')
     except Exception as e:
@@ -519,8 +1086,11 @@ def reset_password(user_id):
         return redirect(url_for('view_user', user_id=user_id))
     
     try:
-        user.password_hash = generate_password_hash(new_password)
+        user.password_hash = password_hasher.hash(new_password)
         db.session.commit()
+        identity_cache.invalidate(user_id)
+        if user.id == current_user.id:
+            login_user(user, remember=True)  # other sessions of this user end
         logger.info(f'Password reset for user {user_id} by admin {current_user.username}')
         flash('Password reset successfully', 'success')
     except Exception as e:
@@ -540,267 +1110,249 @@ def view_patient_data(patient_id):
     
     patient = User.query.get_or_404(patient_id)
     
-    # Get all smoking logs
-    smoking_logs = SmokingLog.query.filter_by(user_id=patient_id)\
-        .order_by(SmokingLog.date.desc(), SmokingLog.time.desc()).all()
+    # First page of smoking logs; the rest load on demand from patient_logs_page
+    smoking_logs, next_cursor = smoking_log_page(patient_id, limit=app.config['LOG_PAGE_SIZE'])
     
     # Get all medical reports
     reports = MedicalReport.query.filter_by(user_id=patient_id)\
         .order_by(MedicalReport.uploaded_at.desc()).all()
     
-    # Calculate statistics
-    stats = {
-        'total_entries': len(smoking_logs),
-        'smoked_count': len([log for log in smoking_logs if log.smoke_or_resist == 'Smoked']),
-        'resisted_count': len([log for log in smoking_logs if log.smoke_or_resist == 'Resisted']),
-        'avg_urge_level': sum(log.urge_level for log in smoking_logs) / len(smoking_logs) if smoking_logs else 0,
-        'total_reports': len(reports)
-    }
-    
-    # Prepare data for visualization charts
-    trigger_data = {}
-    location_data = {}
-    emotion_data = {}
-    who_with_data = {}
-    urge_distribution = {}
-    
-    for log in smoking_logs:
-        # Trigger data
-        if log.trigger and log.trigger.strip():
-            trigger_data[log.trigger] = trigger_data.get(log.trigger, 0) + 1
-        
-        # Location data
-        if log.location and log.location.strip():
-            location_data[log.location] = location_data.get(log.location, 0) + 1
-        
-        # Emotion data
-        if log.emotion and log.emotion.strip():
-            emotion_data[log.emotion] = emotion_data.get(log.emotion, 0) + 1
-        
-        # Who with data
-        if log.who_with and log.who_with.strip():
-            who_with_data[log.who_with] = who_with_data.get(log.who_with, 0) + 1
-        
-        # Urge level distribution
-        urge_distribution[log.urge_level] = urge_distribution.get(log.urge_level, 0) + 1
-    
-    # Sort by count descending
-    chart_data = {
-        'trigger': sorted(trigger_data.items(), key=lambda x: x[1], reverse=True) if trigger_data else None,
-        'location': sorted(location_data.items(), key=lambda x: x[1], reverse=True) if location_data else None,
-        'emotion': sorted(emotion_data.items(), key=lambda x: x[1], reverse=True) if emotion_data else None,
-        'who_with': sorted(who_with_data.items(), key=lambda x: x[1], reverse=True) if who_with_data else None,
-        'urge_level': sorted(urge_distribution.items(), key=lambda x: x[0]) if urge_distribution else None
-    }
-    
-    # Find patterns - what triggers lead to smoking
-    trigger_smoke_pattern = {}
-    for log in smoking_logs:
-        if log.trigger and log.trigger.strip() and log.smoke_or_resist == 'Smoked':
-            if log.trigger not in trigger_smoke_pattern:
-                trigger_smoke_pattern[log.trigger] = 0
-            trigger_smoke_pattern[log.trigger] += 1
-    
-    location_smoke_pattern = {}
-    for log in smoking_logs:
-        if log.location and log.location.strip() and log.smoke_or_resist == 'Smoked':
-            if log.location not in location_smoke_pattern:
-                location_smoke_pattern[log.location] = 0
-            location_smoke_pattern[log.location] += 1
-    
-    chart_data['trigger_smoke'] = sorted(trigger_smoke_pattern.items(), key=lambda x: x[1], reverse=True) if trigger_smoke_pattern else None
-    chart_data['location_smoke'] = sorted(location_smoke_pattern.items(), key=lambda x: x[1], reverse=True) if location_smoke_pattern else None
-
-    # Summary: last 30 days smoked counts per day
-    end_date = datetime.utcnow().date()
-    start_date = end_date - timedelta(days=29)
-    daily_counts = {}
-    for i in range(30):
-        d = start_date + timedelta(days=i)
-        daily_counts[d.strftime('%Y-%m-%d')] = 0
-    for log in smoking_logs:
-        if log.smoke_or_resist == 'Smoked':
-            try:
-                log_date = datetime.strptime(log.date, '%Y-%m-%d').date()
-            except Exception:
-                # Skip if date format is unexpected
-                continue
-            if start_date <= log_date <= end_date:
-                key = log_date.strftime('%Y-%m-%d')
-                daily_counts[key] = daily_counts.get(key, 0) + 1
-
-    summary_last30 = {
-        'labels': list(daily_counts.keys()),
-        'counts': list(daily_counts.values())
-    }
-
-    # This week: Monday to Sunday of the current week (future days may be zero)
-    today = datetime.utcnow().date()
-    current_week_monday = today - timedelta(days=today.weekday())  # this week's Monday
-    this_week_days = [current_week_monday + timedelta(days=i) for i in range(7)]
-    this_week_counts = {d.strftime('%Y-%m-%d'): 0 for d in this_week_days}
-    for log in smoking_logs:
-        if log.smoke_or_resist == 'Smoked':
-            try:
-                d = datetime.strptime(log.date, '%Y-%m-%d').date()
-            except Exception:
-                continue
-            if current_week_monday <= d <= current_week_monday + timedelta(days=6):
-                key = d.strftime('%Y-%m-%d')
-                this_week_counts[key] = this_week_counts.get(key, 0) + 1
-    summary_lastweek = {
-        'labels': [d.strftime('%a %d') for d in this_week_days],
-        'counts': [this_week_counts[d.strftime('%Y-%m-%d')] for d in this_week_days]
-    }
-
-    # Today: hour-wise 0-23
-    hours = list(range(24))
-    today_counts = {h: 0 for h in hours}
-    for log in smoking_logs:
-        if log.smoke_or_resist == 'Smoked':
-            try:
-                d = datetime.strptime(log.date, '%Y-%m-%d').date()
-                t = datetime.strptime(log.time, '%H:%M')
-            except Exception:
-                continue
-            if d == today:
-                today_counts[t.hour] = today_counts.get(t.hour, 0) + 1
-    summary_today = {
-        'labels': [f'{h:02d}:00' for h in hours],
-        'counts': [today_counts[h] for h in hours]
-    }
-
-    # Monthly: current month daily counts
-    first_of_month = today.replace(day=1)
-    if first_of_month.month == 12:
-        first_next_month = first_of_month.replace(year=first_of_month.year + 1, month=1, day=1)
-    else:
-        first_next_month = first_of_month.replace(month=first_of_month.month + 1, day=1)
-    days_in_month = (first_next_month - first_of_month).days
-    month_counts = {day: 0 for day in range(1, days_in_month + 1)}
-    for log in smoking_logs:
-        if log.smoke_or_resist == 'Smoked':
-            try:
-                d = datetime.strptime(log.date, '%Y-%m-%d').date()
-            except Exception:
-                continue
-            if first_of_month <= d < first_next_month:
-                month_counts[d.day] = month_counts.get(d.day, 0) + 1
-    summary_month = {
-        'labels': [str(day) for day in range(1, days_in_month + 1)],
-        'counts': [month_counts[day] for day in range(1, days_in_month + 1)]
-    }
-
-    # Yearly: current year month-wise counts
-    year_start = today.replace(month=1, day=1)
-    year_end = today.replace(month=12, day=31)
-    month_names = ['Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec']
-    year_counts = {m: 0 for m in range(1, 13)}
-    for log in smoking_logs:
-        if log.smoke_or_resist == 'Smoked':
-            try:
-                d = datetime.strptime(log.date, '%Y-%m-%d').date()
-            except Exception:
-                continue
-            if year_start <= d <= year_end:
-                year_counts[d.month] = year_counts.get(d.month, 0) + 1
-    summary_year = {
-        'labels': month_names,
-        'counts': [year_counts[m] for m in range(1, 13)]
-    }
+    # Charts load the rest of the cached analytics from patient_analytics_api
+    stats = get_patient_analytics(patient_id)['stats']
     
     return render_template(
         'view_patient.html',
         patient=patient,
         logs=smoking_logs,
+        next_cursor=next_cursor,
         reports=reports,
-        stats=stats,
-        chart_data=chart_data,
-        summary_last30=summary_last30,
-        summary_lastweek=summary_lastweek,
-        summary_today=summary_today,
-        summary_month=summary_month,
-        summary_year=summary_year
+        stats=stats
     )
 
 
+@app.route('/api/patients/<int:patient_id>/analytics')
+@login_required
+def patient_analytics_api(patient_id):
+    """Stats, chart data and summaries for a patient as JSON, with conditional GET"""
+    if current_user.role != 'doctor':
+        return jsonify({'error': 'Access denied'}), 403
+    
+    etag = analytics_etag(patient_id)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(get_patient_analytics(patient_id))
+    
+    response.set_etag(etag)
+    # Browsers keep the body but revalidate on every use
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/api/patients/<int:patient_id>/patterns')
+@login_required
+def patient_patterns_api(patient_id):
+    """Combinations of trigger, emotion, location, company and time of day linked to smoking"""
+    if current_user.role != 'doctor':
+        return jsonify({'error': 'Access denied'}), 403
+    
+    return jsonify(get_patient_patterns(patient_id))
+
+
+@app.route('/doctor/patient/<int:patient_id>/logs')
+@login_required
+def patient_logs_page(patient_id):
+    """Next page of a patient's smoking logs as JSON"""
+    if current_user.role != 'doctor':
+        return jsonify({'error': 'Access denied'}), 403
+    
+    after = None
+    cursor = request.args.get('cursor')
+    if cursor:
+        after = decode_log_cursor(cursor)
+        if after is None:
+            return jsonify({'error': 'Invalid cursor'}), 400
+    
+    limit = request.args.get('limit', app.config['LOG_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['LOG_PAGE_MAX_SIZE']))
+    
+    logs, next_cursor = smoking_log_page(patient_id, after, limit)
+    return jsonify({
+        'logs': [serialize_log(log) for log in logs],
+        'next_cursor': next_cursor
+    })
+
+
+EXPORT_FORMATS = {
+    'csv': (iter_csv, 'text/csv'),
+    'ndjson': (iter_ndjson, 'application/x-ndjson'),
+}
+
+
+@app.route('/doctor/patient/<int:patient_id>/export.<fmt>')
+@login_required
+def export_patient_logs(patient_id, fmt):
+    """Stream a patient's full smoking log as CSV or NDJSON, optionally between ?from= and ?to= dates"""
+    if current_user.role != 'doctor':
+        flash('Access denied', 'error')
+        return redirect(url_for('patient_dashboard'))
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+    
+    patient = User.query.get_or_404(patient_id)
+    
+    try:
+        start = datetime.strptime(request.args['from'], '%Y-%m-%d') if request.args.get('from') else None
+        end = datetime.strptime(request.args['to'], '%Y-%m-%d') + timedelta(days=1) if request.args.get('to') else None
+    except ValueError:
+        flash('Invalid date range. Use YYYY-MM-DD.', 'error')
+        return redirect(url_for('view_patient_data', patient_id=patient_id))
+    
+    formatter, mimetype = EXPORT_FORMATS[fmt]
+    rows = export_rows(patient.id, start, end)
+    response = app.response_class(stream_with_context(formatter(rows)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="patient-{patient.id}-smoking-logs.{fmt}"'
+    response.cache_control.private = True
+    response.cache_control.no_store = True
+    return response
+
+
 @app.route('/autocomplete/<field_name>')
 @login_required
 def get_autocomplete_suggestions(field_name):
-    """Get autocomplete suggestions for a specific field (last 7 entries, most used first)"""
+    """Get autocomplete suggestions for a specific field (7 values starting with q, most used first)"""
     if current_user.role == 'doctor':
         return jsonify([]), 403
     
     # Query is optional search term
-    query = request.args.get('q', '').strip().lower()
-    
-    # Get field from SmokingLog model
-    if field_name == 'location':
-        field = SmokingLog.location
-    elif field_name == 'trigger':
-        field = SmokingLog.trigger
-    elif field_name == 'emotion':
-        field = SmokingLog.emotion
-    elif field_name == 'who_with':
-        field = SmokingLog.who_with
-    else:
+    query = request.args.get('q', '').strip()
+    
+    if field_name not in SUGGESTION_FIELDS:
         return jsonify([])
     
-    # Get all unique values for this field from user's logs
-    logs = SmokingLog.query.filter_by(user_id=current_user.id).all()
+    return jsonify(suggestion_service.lookup(current_user.id, field_name, query))
+
+
+def find_report(report_id):
+    """Return the report with report_id if the current user may read it
     
-    # Count occurrences and filter by query
-    suggestions = {}
-    for log in logs:
-        value = getattr(log, field_name)
-        if value and value.strip():
-            value_lower = value.strip().lower()
-            if not query or query in value_lower:
-                if value not in suggestions:
-                    suggestions[value] = 0
-                suggestions[value] += 1
+    Reports are addressed by id: their filenames are only labels, and two
+    patients may upload files with the same name in the same second.
+    """
+    report = db.session.get(MedicalReport, report_id)
+    if report is None or (current_user.role == 'patient' and report.user_id != current_user.id):
+        return None
+    return report
+
+
+def release_report_blobs(content_hashes):
+    """Delete stored blobs that no MedicalReport references any more"""
+    for content_hash in set(filter(None, content_hashes)):
+        if db.session.query(MedicalReport.id).filter_by(content_hash=content_hash).first() is None:
+            storage.delete(content_hash)
+            PreviewJob.query.filter_by(content_hash=content_hash).delete()
+    db.session.commit()
+
+
+def serve_report_file(report, as_attachment=False):
+    """Response sending a report's file, or None if the file is missing
     
-    # Sort by frequency (most used first), limit to 7
-    sorted_suggestions = sorted(suggestions.items(), key=lambda x: x[1], reverse=True)[:7]
+    Served from Python, send_file answers Range (206), If-None-Match and
+    If-Modified-Since itself. Offloaded to the front proxy or redirected to
+    a remote store, those handle the headers instead.
+    """
+    mimetype = report.content_type or mimetypes.guess_type(report.filename)[0] or 'application/octet-stream'
+    upload_root = os.path.abspath(app.config['UPLOAD_FOLDER'])
     
-    return jsonify([item[0] for item in sorted_suggestions])
+    if report.content_hash:
+        url = storage.url(report.content_hash, report.filename, mimetype, as_attachment)
+        if url is not None:
+            return redirect(url)
+        filepath = storage.path(report.content_hash)
+    else:
+        # Uploaded before content-addressed storage: stored under its own name
+        filepath = safe_join(upload_root, report.filename)
+    
+    if filepath is None or not os.path.isfile(filepath):
+        return None
+    
+    mode = app.config['REPORT_OFFLOAD']
+    if mode in ('x-accel-redirect', 'x-sendfile'):
+        response = app.response_class()
+        response.mimetype = mimetype
+        disposition = 'attachment' if as_attachment else 'inline'
+        response.headers['Content-Disposition'] = f'{disposition}; filename="{report.filename}"'
+        if mode == 'x-accel-redirect':
+            relative = os.path.relpath(filepath, upload_root).replace(os.sep, '/')
+            response.headers['X-Accel-Redirect'] = app.config['REPORT_OFFLOAD_PREFIX'].rstrip('/') + '/' + quote(relative)
+        else:
+            response.headers['X-Sendfile'] = filepath
+    else:
+        # A blob never changes, so its hash makes a strong ETag
+        response = send_file(filepath, mimetype=mimetype, as_attachment=as_attachment,
+                             download_name=report.filename, conditional=True,
+                             etag=report.content_hash or True, max_age=app.config['REPORT_MAX_AGE'])
+    
+    # Reports are behind a login; never let shared caches keep them
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
 
 
-@app.route('/view-report/<filename>')
+@app.route('/view-report/<int:report_id>')
 @login_required
-def view_report(filename):
+def view_report(report_id):
     """View medical report in browser instead of downloading"""
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    
-    if not os.path.exists(filepath):
+    report = find_report(report_id)
+    response = serve_report_file(report) if report else None
+    if response is None:
         flash('File not found', 'error')
         return redirect(url_for('patient_dashboard'))
     
-    # Check if user has access to this file
-    report = MedicalReport.query.filter_by(filename=filename).first()
-    if current_user.role == 'patient' and report and report.user_id != current_user.id:
-        flash('Access denied', 'error')
-        return redirect(url_for('patient_dashboard'))
-    
-    return send_file(filepath)
+    return response
 
 
-@app.route('/download/<filename>')
+@app.route('/report-preview/<int:report_id>/<kind>')
 @login_required
-def download_file(filename):
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+def report_preview(report_id, kind):
+    """Thumbnail or first-page preview of a report as a small JPEG"""
+    report = find_report(report_id)
+    if report is None or not report.preview_ready or kind not in previews.PREVIEW_KINDS:
+        return '', 404
+    
+    name = previews.derived_name(kind)
+    url = storage.derived_url(report.content_hash, name, previews.PREVIEW_CONTENT_TYPE)
+    if url is not None:
+        return redirect(url)
     
-    # Security check
-    if not os.path.exists(filepath):
+    response = send_file(storage.derived_path(report.content_hash, name),
+                         mimetype=previews.PREVIEW_CONTENT_TYPE, conditional=True,
+                         etag=f'{report.content_hash}-{kind}', max_age=app.config['REPORT_MAX_AGE'])
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+
+@app.route('/download/<int:report_id>')
+@login_required
+def download_file(report_id):
+    report = find_report(report_id)
+    response = serve_report_file(report, as_attachment=True) if report else None
+    if response is None:
         flash('File not found', 'error')
         return redirect(url_for('patient_dashboard'))
     
-    return send_file(filepath, as_attachment=True)
+    return response
 
 
 # Initialize database
 with app.app_context():
+    new_database = not db.inspect(db.engine).has_table(User.__tablename__)
     db.create_all()
+    if new_database:
+        # Whatever the shared cache holds came from a database that is gone
+        identity_cache.clear()
     logger.info('Database initialized')
 
 if __name__ == '__main__':
@@ -0,0 +1,24 @@
+"""
+Rebuild the SmokingDailyRollup table from the raw smoking logs
+Run once after upgrading, or any time the rollup needs to be recomputed.
+
+Usage: python backfill_rollups.py [user_id]
+"""
+import sys
+from app import app
+from models import db
+from rollups import rebuild_rollups
+
+with app.app_context():
+    user_id = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    db.create_all()
+
+    try:
+        rows = rebuild_rollups(user_id)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    target = f"user {user_id}" if user_id is not None else "all users"
+    print(f"Rebuilt {rows} rollup rows for {target}")
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite: latency and throughput of the main pages on synthetic data
+
+Seeds a throwaway SQLite database (or the empty database given with
+--database-url, e.g. PostgreSQL) with datagen.py, then measures each
+scenario in two phases using the Flask test client, so the numbers cover
+the app and database without a web server in front:
+
+    sequential  one request at a time: p50/p95/p99 latency and SQL
+                statements per request
+    concurrent  --concurrency threads with their own sessions sending a
+                weighted mix for --duration seconds: throughput, and latency
+                under contention for the database and caches
+
+Results are written as JSON (--output, default benchmarks/results/) with
+the commit, settings and dataset size; compare.py compares two of them.
+For whole-server numbers under gunicorn, see loadtest.py.
+
+Usage: python benchmarks/bench.py [--scenarios view_patient_data,login]
+           [--iterations 200] [--concurrency 8] [--duration 15]
+           [--database-url URL] [datagen.py options, e.g. --patients 50]
+"""
+import argparse
+import atexit
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import datagen
+
+REPO_DIR = datagen.REPO_DIR
+sys.path.insert(0, REPO_DIR)
+from loadtest import percentile
+RESULTS_DIR = os.path.join(REPO_DIR, 'benchmarks', 'results')
+AUTOCOMPLETE_PREFIXES = {'location': ['', 'h', 'wo', 'c'], 'trigger': ['', 's', 'co', 'af', 'b'],
+                         'emotion': ['', 'a', 'st', 're'], 'who_with': ['', 'a', 'fr']}
+
+
+class Session:
+    """Logged-in test clients of one benchmark thread"""
+
+    def __init__(self, app, dataset, rng):
+        self.app = app
+        self.dataset = dataset
+        self.rng = rng
+        self.doctor = self.login(rng.choice(dataset['doctors']))
+        self.admin = self.login(rng.choice(dataset['admins']))
+        with_reports = [username for _, username in dataset['patients'] if dataset['reports'].get(username)]
+        self.patient_username = rng.choice(with_reports or [username for _, username in dataset['patients']])
+        self.patient = self.login(self.patient_username)
+
+    def login(self, username):
+        client = self.app.test_client()
+        response = client.post('/login', data={'login': username, 'password': datagen.PASSWORD})
+        response.close()
+        if response.status_code != 302:
+            raise RuntimeError(f'Could not log in as {username}: HTTP {response.status_code}')
+        return client
+
+
+# Each scenario sends one request and returns (response, expected status)
+
+def login(session):
+    _, username = session.rng.choice(session.dataset['patients'])
+    client = session.app.test_client()
+    return client.post('/login', data={'login': username, 'password': datagen.PASSWORD}), 302
+
+
+def view_patient_data(session):
+    patient_id, _ = session.rng.choice(session.dataset['patients'])
+    return session.doctor.get(f'/doctor/patient/{patient_id}'), 200
+
+
+def get_autocomplete_suggestions(session):
+    field = session.rng.choice(list(AUTOCOMPLETE_PREFIXES))
+    prefix = session.rng.choice(AUTOCOMPLETE_PREFIXES[field])
+    return session.patient.get(f'/autocomplete/{field}?q={prefix}'), 200
+
+
+def doctor_dashboard(session):
+    if session.rng.random() < 0.3:
+        return session.doctor.get(f'/doctor/dashboard?q={session.rng.choice(datagen.LAST_NAMES)}'), 200
+    sort = session.rng.choice(['name', 'last_log', 'resist_rate'])
+    return session.doctor.get(f'/doctor/dashboard?sort={sort}&page={session.rng.randint(1, 3)}'), 200
+
+
+def admin_dashboard(session):
+    return session.admin.get('/admin/dashboard'), 200
+
+
+def upload_report(session):
+    extension, body = datagen.report_file(session.rng, 256 * 1024)
+    data = {'report_name': 'Benchmark upload', 'file': (io.BytesIO(body), f'benchmark.{extension}')}
+    return session.patient.post('/patient/upload-report', data=data, content_type='multipart/form-data'), 302
+
+
+def download_file(session):
+    report_ids = session.dataset['reports'].get(session.patient_username) or [0]
+    return session.patient.get(f'/download/{session.rng.choice(report_ids)}'), 200
+
+
+# name (the Flask endpoint): (function, share of the sequential iterations, weight in the concurrent mix).
+# Logins and uploads are expensive by design (password hash, file write), so they run less often.
+SCENARIOS = {
+    'view_patient_data': (view_patient_data, 1.0, 20),
+    'get_autocomplete_suggestions': (get_autocomplete_suggestions, 1.0, 30),
+    'doctor_dashboard': (doctor_dashboard, 1.0, 10),
+    'admin_dashboard': (admin_dashboard, 1.0, 3),
+    'login': (login, 0.1, 2),
+    'upload_report': (upload_report, 0.1, 2),
+    'download_file': (download_file, 1.0, 10),
+}
+
+
+def timed(scenario, session, results):
+    started = time.perf_counter()
+    response, expected = SCENARIOS[scenario][0](session)
+    response.get_data()  # read streamed bodies (downloads) to the end
+    response.close()
+    results.setdefault(scenario, []).append((time.perf_counter() - started, response.status_code == expected))
+
+
+def query_counts(registry):
+    """{endpoint: [requests, SQL statements]} recorded so far in this process"""
+    counts = {}
+    if registry is None:
+        return counts
+    for name, labels, value in registry.samples():
+        if name in ('http_requests_total', 'db_queries_total'):
+            entry = counts.setdefault(dict(labels)['endpoint'], [0, 0])
+            entry[name == 'db_queries_total'] += value
+    return counts
+
+
+def summarize(results, elapsed, queries_before=None, queries_after=None):
+    summary = {}
+    for scenario, samples in results.items():
+        latencies = sorted(latency for latency, ok in samples if ok)
+        entry = {
+            'requests': len(samples),
+            'errors': sum(1 for _, ok in samples if not ok),
+            'throughput_rps': len(samples) / elapsed[scenario],
+            'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        }
+        if queries_after:
+            requests, statements = [after - before for after, before in
+                                    zip(queries_after.get(scenario, [0, 0]), queries_before.get(scenario, [0, 0]))]
+            entry['queries_per_request'] = statements / requests if requests else None
+        summary[scenario] = entry
+    return summary
+
+
+def run_sequential(app, registry, dataset, scenarios, args):
+    session = Session(app, dataset, random.Random(args.seed))
+    results, elapsed = {}, {}
+    before = query_counts(registry)
+    for scenario in scenarios:
+        iterations = max(10, int(args.iterations * SCENARIOS[scenario][1]))
+        for _ in range(args.warmup):
+            timed(scenario, session, {})
+        started = time.perf_counter()
+        for _ in range(iterations):
+            timed(scenario, session, results)
+        elapsed[scenario] = time.perf_counter() - started
+    after = query_counts(registry)
+    return summarize(results, elapsed, before, after)
+
+
+def run_concurrent(app, registry, dataset, scenarios, args):
+    weights = [SCENARIOS[scenario][2] for scenario in scenarios]
+    sessions = [Session(app, dataset, random.Random(args.seed + number + 1)) for number in range(args.concurrency)]
+    results = [{} for _ in sessions]
+    before = query_counts(registry)
+    deadline = time.monotonic() + args.duration
+
+    def worker(session, thread_results):
+        while time.monotonic() < deadline:
+            timed(session.rng.choices(scenarios, weights)[0], session, thread_results)
+
+    threads = [threading.Thread(target=worker, args=(session, thread_results))
+               for session, thread_results in zip(sessions, results)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    merged = {}
+    for thread_results in results:
+        for scenario, samples in thread_results.items():
+            merged.setdefault(scenario, []).extend(samples)
+    summary = summarize(merged, {scenario: elapsed for scenario in merged}, before, query_counts(registry))
+    total = sum(len(samples) for samples in merged.values())
+    return {'concurrency': args.concurrency, 'duration_s': elapsed, 'requests': total,
+            'throughput_rps': total / elapsed, 'scenarios': summary}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(title, summary):
+    print(f'\n{title}')
+    print(f'{"scenario":30} {"requests":>8} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+          f'{"queries":>7} {"errors":>6}')
+    for scenario, entry in summary.items():
+        queries = entry.get('queries_per_request')
+        print(f'{scenario:30} {entry["requests"]:8d} {entry["throughput_rps"]:8.1f} {entry["p50_ms"]:8.1f} '
+              f'{entry["p95_ms"]:8.1f} {entry["p99_ms"]:8.1f} '
+              f'{queries if queries is not None else float("nan"):7.1f} {entry["errors"]:6d}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the main pages on synthetic data')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated; default: all')
+    parser.add_argument('--iterations', type=int, default=200, help='sequential requests per scenario')
+    parser.add_argument('--warmup', type=int, default=5, help='unmeasured requests per scenario first')
+    parser.add_argument('--concurrency', type=int, default=8, help='threads in the concurrent phase (0: skip it)')
+    parser.add_argument('--duration', type=float, default=15, help='seconds of the concurrent phase')
+    parser.add_argument('--output', help='JSON results file (default: benchmarks/results/<time>.json)')
+    parser.add_argument('--keep-data', action='store_true', help='keep the temporary data directory')
+    datagen.add_arguments(parser)
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(unknown)} (choose from {", ".join(SCENARIOS)})')
+    output = os.path.abspath(args.output or os.path.join(RESULTS_DIR, f'{datetime.now():%Y%m%d-%H%M%S}.json'))
+
+    # Report files, caches and the default SQLite database live in a throwaway directory
+    data_dir = tempfile.mkdtemp(prefix='medical-bench-')
+    os.environ['DATABASE_URL'] = args.database_url or f'sqlite:///{os.path.join(data_dir, "bench.db")}'
+    os.environ['PREVIEW_WORKERS'] = '0'
+    os.chdir(data_dir)
+    metrics_registry = None
+    try:
+        from app import app, metrics_registry
+        from models import User
+        logging.getLogger().setLevel(logging.WARNING)  # request logs would dominate the timings
+
+        with app.app_context():
+            if User.query.first() is not None:
+                sys.exit('The benchmark database must start empty.')
+            started = time.perf_counter()
+            dataset = datagen.generate_from_args(args)
+            print(f'Seeded {len(dataset["patients"])} patients, {dataset["logs"]} logs and '
+                  f'{sum(map(len, dataset["reports"].values()))} reports in {time.perf_counter() - started:.1f}s')
+
+        sequential = run_sequential(app, metrics_registry, dataset, scenarios, args)
+        print_table('Sequential', sequential)
+        concurrent = None
+        if args.concurrency:
+            concurrent = run_concurrent(app, metrics_registry, dataset, scenarios, args)
+            print_table(f'Concurrent ({args.concurrency} threads, {concurrent["throughput_rps"]:.1f} req/s total)',
+                        concurrent['scenarios'])
+
+        from sqlalchemy.engine import make_url
+        results = {
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': make_url(os.environ['DATABASE_URL']).render_as_string(hide_password=True),
+            'settings': {key: app.config[key] for key in
+                         ('PASSWORD_HASH_METHOD', 'PASSWORD_HASH_WORKERS', 'CACHE_BACKEND', 'STORAGE_BACKEND')},
+            'args': vars(args),
+            'dataset': {'patients': len(dataset['patients']), 'doctors': len(dataset['doctors']),
+                        'admins': len(dataset['admins']), 'logs': dataset['logs'],
+                        'reports': sum(map(len, dataset['reports'].values())),
+                        'report_bytes': dataset['report_bytes']},
+            'sequential': sequential,
+            'concurrent': concurrent,
+        }
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nResults written to {output}')
+    finally:
+        os.chdir(REPO_DIR)
+        if metrics_registry is not None:
+            atexit.unregister(metrics_registry.flush)  # its directory is about to go
+        if args.keep_data:
+            print(f'Data kept in {data_dir}')
+        else:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Compare two benchmark result files written by bench.py
+
+Usage: python benchmarks/compare.py OLD.json NEW.json
+
+Prints p50/p95/p99 latency, throughput and SQL statements per request of
+every scenario in both phases, with the change from OLD to NEW. Only compare
+runs made with the same dataset options on the same machine.
+"""
+import json
+import sys
+
+COLUMNS = ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'queries_per_request')
+
+
+def change(old, new):
+    if old is None or new is None:
+        return ''
+    if not old:
+        return '' if not new else '(new)'
+    return f'({(new - old) / old * 100:+.0f}%)'
+
+
+def number(value):
+    return '-' if value is None else f'{value:.1f}'
+
+
+def compare_phase(title, old, new):
+    print(f'\n{title}')
+    print(f'{"scenario":30} ' + ' '.join(f'{column:^28}' for column in COLUMNS))
+    for scenario in list(new) + [name for name in old if name not in new]:
+        before, after = old.get(scenario, {}), new.get(scenario, {})
+        cells = []
+        for column in COLUMNS:
+            a, b = before.get(column), after.get(column)
+            cells.append(f'{number(a):>8} -> {number(b):<8} {change(a, b):>7}')
+        print(f'{scenario:30} ' + ' '.join(cells))
+
+
+def main():
+    if len(sys.argv) != 3:
+        sys.exit(__doc__.strip())
+    with open(sys.argv[1]) as f:
+        old = json.load(f)
+    with open(sys.argv[2]) as f:
+        new = json.load(f)
+
+    print(f'OLD {old["commit"]} {old["started_at"]} {old["database"].split(":")[0]}: {old["dataset"]}')
+    print(f'NEW {new["commit"]} {new["started_at"]} {new["database"].split(":")[0]}: {new["dataset"]}')
+    if old['dataset'] != new['dataset']:
+        print('Warning: the datasets differ, so the numbers are not directly comparable')
+
+    compare_phase('Sequential', old['sequential'], new['sequential'])
+    if old.get('concurrent') and new.get('concurrent'):
+        compare_phase(f'Concurrent ({old["concurrent"]["concurrency"]} -> {new["concurrent"]["concurrency"]} threads, '
+                      f'{old["concurrent"]["throughput_rps"]:.1f} -> {new["concurrent"]["throughput_rps"]:.1f} req/s)',
+                      old['concurrent']['scenarios'], new['concurrent']['scenarios'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Synthetic data for benchmarks
+
+Fills an empty database with doctors, admins and patients whose smoking
+logs look like real ones: heavy-tailed log counts per patient, cravings
+clustered around waking, lunch and the evening (later on weekends), each
+patient with their own favourite triggers, locations that follow the time
+of day, urge levels that rise with stress and alcohol, a resist rate that
+improves over the weeks, and some free-text and oddly cased values. Patients
+also get PDF/JPEG/PNG medical reports of realistic sizes, a few uploaded
+twice. The same --seed always produces the same data (relative to today).
+
+Usage: python benchmarks/datagen.py --database-url URL [--patients 50]
+           [--logs-per-patient 300] [--reports-per-patient 2] [--seed 1]
+
+Without --database-url the app's DATABASE_URL (or medical_app.db) is used.
+Report files go to the app's storage, relative to the working directory.
+Every generated account has the password PASSWORD.
+"""
+import argparse
+import io
+import math
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = 'benchmark1'
+USERNAME_PREFIX = 'bench_'
+
+FIRST_NAMES = ['Alex', 'Sam', 'Jordan', 'Maria', 'Chen', 'Priya', 'Tom', 'Fatima', 'Luca', 'Ana', 'Kofi', 'Yuki']
+LAST_NAMES = ['Smith', 'Garcia', 'Nguyen', 'Patel', 'Kowalski', 'Okafor', 'Rossi', 'Berg', 'Silva', 'Kim']
+TRIGGERS = ['Stress', 'Coffee', 'After meal', 'Boredom', 'Alcohol', 'Social', 'Craving', 'Work break',
+            'Driving', 'Phone call', 'Waking up', 'Argument']
+RARE_TRIGGERS = ['Saw someone smoking', 'Deadline', 'Bad news', 'Waiting for the bus', 'Long meeting',
+                 'Traffic jam', 'Celebration', 'Could not sleep']
+EMOTIONS = ['Anxious', 'Stressed', 'Bored', 'Calm', 'Happy', 'Tired', 'Sad', 'Irritable', 'Relaxed']
+TRIGGER_EMOTIONS = {
+    'Stress': ['Stressed', 'Anxious', 'Irritable'],
+    'Argument': ['Irritable', 'Sad', 'Stressed'],
+    'Alcohol': ['Happy', 'Relaxed'],
+    'Social': ['Happy', 'Relaxed', 'Anxious'],
+    'Boredom': ['Bored', 'Tired'],
+    'Waking up': ['Tired', 'Calm'],
+}
+URGE_BONUS = {'Stress': 0.75, 'Argument': 1.0, 'Alcohol': 0.5, 'Craving': 0.75, 'Coffee': 0.25}
+FEELINGS = {'Smoked': ['Relieved', 'Guilty', 'Satisfied', 'Disappointed'],
+            'Resisted': ['Proud', 'Restless', 'Irritable', 'Relieved']}
+NOTES = ['Hard day', 'Used nicotine gum', 'Went for a walk instead', 'Only half', 'Friend offered one',
+         'Drank water and waited', 'Almost gave in']
+# (mean hour, spread, weight) of the craving peaks
+WEEKDAY_PEAKS = [(7.5, 1.0, 0.30), (13.0, 1.5, 0.20), (18.0, 1.5, 0.30), (21.5, 1.2, 0.20)]
+REPORT_NAMES = ['Blood test', 'Lung function test', 'Chest X-ray', 'Cholesterol panel', 'CO breath test',
+                'ECG', 'Liver panel', 'Spirometry']
+REPORT_KINDS = [('pdf', b'%PDF-1.4\n', 0.7), ('jpg', b'\xff\xd8\xff\xe0', 0.2), ('png', b'\x89PNG\r\n\x1a\n', 0.1)]
+
+
+def lognormal(rng, mean, sigma):
+    """A lognormal sample with the given mean"""
+    return rng.lognormvariate(math.log(mean) - sigma * sigma / 2, sigma)
+
+
+def weighted_choice(rng, weights):
+    return rng.choices(list(weights), list(weights.values()))[0]
+
+
+def log_hour(rng, weekend):
+    if rng.random() < 0.05:
+        return rng.uniform(0, 24)
+    mean, spread, _ = rng.choices(WEEKDAY_PEAKS, [weight for _, _, weight in WEEKDAY_PEAKS])[0]
+    if weekend:
+        mean += 1.5
+    return min(max(rng.gauss(mean, spread), 5.0), 23.99)
+
+
+def log_location(rng, hour, weekend):
+    if not weekend and 9 <= hour < 17:
+        weights = {'Work': 60, 'Outside': 20, 'Car': 10, 'Home': 10}
+    elif hour >= 19:
+        weights = {'Home': 45, 'Bar': 25 if weekend else 10, 'Outside': 15, "Friend's place": 15}
+    else:
+        weights = {'Home': 50, 'Car': 20, 'Outside': 20, 'Work': 5, "Friend's place": 5}
+    return weighted_choice(rng, weights)
+
+
+def log_company(rng, location):
+    weights = {'Work': {'Coworkers': 60, 'Alone': 40},
+               'Bar': {'Friends': 80, 'Alone': 20},
+               "Friend's place": {'Friends': 90, 'Partner': 10},
+               'Home': {'Alone': 50, 'Partner': 35, 'Family': 15}}.get(location, {'Alone': 80, 'Friends': 20})
+    return weighted_choice(rng, weights)
+
+
+def patient_logs(rng, user_id, count, days, end):
+    """count SmokingLog rows for one patient, spread over up to days days before end"""
+    from models import SmokingLog
+
+    # Each patient has their own favourite triggers (a Zipf law over a shuffled list)
+    triggers = TRIGGERS[:]
+    rng.shuffle(triggers)
+    trigger_weights = {trigger: 1 / (rank + 1) for rank, trigger in enumerate(triggers)}
+    daily_rate = min(max(lognormal(rng, 10, 0.5), 1), 40)
+    span = min(days, max(7, math.ceil(count / daily_rate)))
+    base_urge = rng.gauss(3, 0.6)  # urge levels run 1-5, like the log form
+    resist_bias = rng.gauss(-0.5, 0.7)  # how hard the patient tries at first
+    progress = rng.uniform(0, 2)  # how much resisting improves over the span
+
+    logs = []
+    for _ in range(count):
+        day = end - timedelta(days=rng.randrange(span))
+        weekend = day.weekday() >= 5
+        hour = log_hour(rng, weekend)
+        logged_at = day + timedelta(hours=int(hour), minutes=rng.randrange(60))
+
+        trigger = rng.choice(RARE_TRIGGERS) if rng.random() < 0.03 else weighted_choice(rng, trigger_weights)
+        emotion = rng.choice(TRIGGER_EMOTIONS.get(trigger) or EMOTIONS)
+        location = log_location(rng, hour, weekend)
+        if rng.random() < 0.05:
+            location = location.lower()  # typed by hand
+        urge = round(base_urge + URGE_BONUS.get(trigger, 0) + rng.gauss(0, 0.9))
+        urge = min(max(urge, 1), 5)
+
+        elapsed = 1 - (end - day).days / span
+        resist_odds = resist_bias + progress * elapsed - 0.9 * (urge - 3)
+        action = 'Resisted' if rng.random() < 1 / (1 + math.exp(-resist_odds)) else 'Smoked'
+
+        logs.append(SmokingLog(
+            user_id=user_id, date=logged_at.strftime('%Y-%m-%d'), time=logged_at.strftime('%H:%M'),
+            logged_at=logged_at, location=location, trigger=trigger, emotion=emotion,
+            who_with=log_company(rng, location), urge_level=urge, smoke_or_resist=action,
+            how_it_felt=rng.choice(FEELINGS[action]) if rng.random() < 0.6 else None,
+            notes=rng.choice(NOTES) if rng.random() < 0.1 else None,
+            client_id=f'{rng.getrandbits(64):016x}' if rng.random() < 0.2 else None,  # synced from offline
+            created_at=logged_at
+        ))
+    return logs
+
+
+def report_file(rng, mean_size):
+    """(extension, bytes) of a scanned report"""
+    extension, magic, _ = rng.choices(REPORT_KINDS, [weight for _, _, weight in REPORT_KINDS])[0]
+    size = int(min(max(lognormal(rng, mean_size, 1.0), 10 * 1024), 8 * 1024 * 1024))
+    return extension, magic + rng.randbytes(size - len(magic))
+
+
+def generate(patients=50, doctors=3, admins=1, logs_per_patient=300, reports_per_patient=2,
+             report_size=256 * 1024, days=180, seed=1, progress=None):
+    """Create the benchmark users, logs and reports; needs an app context
+
+    Returns the dataset as load_dataset() describes it.
+    """
+    from werkzeug.security import generate_password_hash
+    from app import app, add_report, store_blob
+    from models import db, User
+    from rollups import record_logs
+    from suggestions import record_suggestions
+
+    rng = random.Random(seed)
+    end = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    password_hash = generate_password_hash(PASSWORD, app.config['PASSWORD_HASH_METHOD'])
+
+    def add_user(role, number):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        user = User(username=f'{USERNAME_PREFIX}{role}{number}', email=f'{role}{number}@bench.example.com',
+                    name=f'{first} {last}', role=role, password_hash=password_hash,
+                    created_at=end - timedelta(days=rng.randrange(days)))
+        db.session.add(user)
+        return user
+
+    for number in range(doctors):
+        add_user('doctor', number)
+    for number in range(admins):
+        add_user('admin', number)
+    db.session.commit()
+
+    previous_report = None
+    for number in range(patients):
+        user = add_user('patient', number)
+        db.session.flush()
+
+        count = max(1, round(lognormal(rng, logs_per_patient, 0.8))) if logs_per_patient else 0
+        logs = patient_logs(rng, user.id, count, days, end)
+        db.session.add_all(logs)
+        record_logs(logs)
+        record_suggestions(logs)
+
+        for _ in range(rng.randint(0, 2 * reports_per_patient)):
+            if previous_report is not None and rng.random() < 0.05:
+                extension, body = previous_report  # the same scan uploaded twice
+            else:
+                extension, body = previous_report = report_file(rng, report_size)
+            content_hash, size = store_blob(io.BytesIO(body))
+            add_report(user.id, rng.choice(REPORT_NAMES), f'scan_{number}.{extension}', content_hash, size)
+        db.session.commit()
+        if progress:
+            progress(number + 1, patients)
+
+    return load_dataset()
+
+
+def load_dataset():
+    """The benchmark users and reports in the database; needs an app context
+
+    {'doctors': [usernames], 'admins': [usernames], 'patients': [(id, username)],
+     'reports': {patient username: [report ids]}, 'logs': count, 'report_bytes': total size}
+    """
+    from models import db, User, MedicalReport, SmokingLog
+
+    users = User.query.filter(User.username.startswith(USERNAME_PREFIX)).order_by(User.id).all()
+    patients = [(user.id, user.username) for user in users if user.role == 'patient']
+    usernames = {user.id: user.username for user in users}
+    reports = {}
+    report_rows = db.session.query(MedicalReport.user_id, MedicalReport.id)\
+        .filter(MedicalReport.user_id.in_([patient_id for patient_id, _ in patients]))
+    for user_id, report_id in report_rows:
+        reports.setdefault(usernames[user_id], []).append(report_id)
+    patient_ids = [patient_id for patient_id, _ in patients]
+    return {
+        'doctors': [user.username for user in users if user.role == 'doctor'],
+        'admins': [user.username for user in users if user.role == 'admin'],
+        'patients': patients,
+        'reports': reports,
+        'logs': SmokingLog.query.filter(SmokingLog.user_id.in_(patient_ids)).count(),
+        'report_bytes': db.session.query(db.func.coalesce(db.func.sum(MedicalReport.size), 0))
+                                  .filter(MedicalReport.user_id.in_(patient_ids)).scalar(),
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument('--database-url', help='database to fill (default: DATABASE_URL)')
+    parser.add_argument('--patients', type=int, default=50)
+    parser.add_argument('--doctors', type=int, default=3)
+    parser.add_argument('--admins', type=int, default=1)
+    parser.add_argument('--logs-per-patient', type=int, default=300, help='mean; the counts are heavy-tailed')
+    parser.add_argument('--reports-per-patient', type=int, default=2, help='mean')
+    parser.add_argument('--report-size', type=int, default=256 * 1024, help='mean report size in bytes')
+    parser.add_argument('--days', type=int, default=180, help='longest span of a patient\'s logs')
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def generate_from_args(args, progress=None):
+    return generate(args.patients, args.doctors, args.admins, args.logs_per_patient, args.reports_per_patient,
+                    args.report_size, args.days, args.seed, progress)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fill a database with synthetic benchmark data')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    os.environ.setdefault('PREVIEW_WORKERS', '0')
+    sys.path.insert(0, REPO_DIR)
+    from app import app
+    from models import User
+
+    with app.app_context():
+        if User.query.filter(User.username.startswith(USERNAME_PREFIX)).first() is not None:
+            sys.exit('This database already has benchmark users; use an empty one.')
+        dataset = generate_from_args(args, lambda done, total: print(f'\r{done}/{total} patients', end=''))
+    print(f'\nCreated {len(dataset["doctors"])} doctors, {len(dataset["admins"])} admins, '
+          f'{len(dataset["patients"])} patients, {dataset["logs"]} logs and '
+          f'{sum(map(len, dataset["reports"].values()))} reports ({dataset["report_bytes"] / 1e6:.1f} MB). '
+          f'Password: {PASSWORD}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+"""
+Running blocking work from request handlers
+
+Under the gevent worker profile all requests in a process share one OS
+thread and only yield to each other on network I/O. CPU-bound or blocking
+C calls (password hashing, hashing a stored file, resizing an image) would
+stall every other request in the process, so run_blocking hands them to
+gevent's native thread pool. Under sync and gthread workers it simply calls
+the function.
+
+Never pass it anything that reads the request stream: gevent sockets can
+only be used from the thread that owns them.
+"""
+
+
+def gevent_active():
+    """True when gevent has monkey-patched this process (gevent worker)"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+
+def run_blocking(fn, *args, **kwargs):
+    """Call fn(*args, **kwargs) without blocking other greenlets"""
+    if gevent_active():
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+    return fn(*args, **kwargs)
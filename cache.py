@@ -0,0 +1,282 @@
+"""
+Caching helpers
+
+LRUCache is a per-process cache. SQLiteCache is a small key/value store in a
+local SQLite file, so every gunicorn worker on the host shares it without
+needing Redis. TieredCache puts the two together for per-entity data such as a
+patient's dashboard analytics:
+
+    generation = analytics_cache.generation(patient_id)
+    analytics_cache.get(patient_id, variant=today, generation=generation)
+    analytics_cache.set(patient_id, value, variant=today, generation=generation)
+    analytics_cache.invalidate(patient_id)
+
+Invalidation bumps a generation number for the entity in the shared tier.
+Lookups include the current generation in the key, so every worker stops
+seeing the old entries immediately, and those entries age out through normal
+eviction. A value computed after a miss must be stored under the generation
+read before computing it: if the entity was invalidated meanwhile, the value
+then lands under the old generation, where nobody looks any more, instead of
+being served as current.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with an optional per-entry TTL"""
+
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteConnections:
+    """One connection per thread to a SQLite file, reopened after a fork
+
+    Call the instance to get the current thread's connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def __call__(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+class SQLiteCache:
+    """Key/value cache in a SQLite file shared by all worker processes
+
+    Values are stored as JSON. Expired entries are purged, and the oldest
+    entries evicted past max_entries, every EVICT_EVERY writes.
+    """
+
+    EVICT_EVERY = 100
+
+    def __init__(self, path, max_entries=10000, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._connect = SQLiteConnections(path)
+        self._writes = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_entry ("
+                         "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                         "stored_at REAL NOT NULL, expires_at REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_cache_entry_stored_at ON cache_entry (stored_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_generation ("
+                         "key TEXT PRIMARY KEY, generation INTEGER NOT NULL)")
+
+    def get(self, key, default=None):
+        row = self._connect().execute(
+            "SELECT value, expires_at FROM cache_entry WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return default
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache_entry (key, value, stored_at, expires_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now, now + ttl if ttl else None)
+        )
+        self._writes += 1
+        if self._writes % self.EVICT_EVERY == 0:
+            self.evict()
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM cache_entry WHERE key = ?", (key,))
+
+    def evict(self):
+        """Drop expired entries, then the oldest ones beyond max_entries"""
+        conn = self._connect()
+        conn.execute("DELETE FROM cache_entry WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM cache_entry WHERE key IN ("
+            "SELECT key FROM cache_entry ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def generation(self, key):
+        row = self._connect().execute(
+            "SELECT generation FROM cache_generation WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def bump_generation(self, key):
+        self._connect().execute(
+            "INSERT INTO cache_generation (key, generation) VALUES (?, 1) "
+            "ON CONFLICT(key) DO UPDATE SET generation = generation + 1",
+            (key,)
+        )
+
+    def clear(self):
+        conn = self._connect()
+        conn.execute("DELETE FROM cache_entry")
+        conn.execute("DELETE FROM cache_generation")
+
+
+class TieredCache:
+    """Per-entity cache: in-process LRU in front of an optional shared SQLite tier
+
+    Either tier may be None. Without a shared tier, generations live in this
+    process only, so other workers see an invalidation only when their local
+    TTL expires.
+    """
+
+    def __init__(self, namespace, local=None, shared=None):
+        self.namespace = namespace
+        self.local = local
+        self.shared = shared
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.counters = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'sets': 0, 'invalidations': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _generation_key(self, entity):
+        return f'{self.namespace}:{entity}'
+
+    def generation(self, entity):
+        """The entity's current generation, to pass to get() and set()"""
+        if self.shared is not None:
+            return self.shared.generation(self._generation_key(entity))
+        return self._generations.get(entity, 0)
+
+    def _key(self, entity, variant, generation):
+        return f'{self.namespace}:{entity}:{generation}:{variant}'
+
+    def get(self, entity, variant='', default=None, generation=None):
+        if generation is None:
+            generation = self.generation(entity)
+        key = self._key(entity, variant, generation)
+
+        if self.local is not None:
+            value = self.local.get(key)
+            if value is not None:
+                self._count('local_hits')
+                return value
+
+        if self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self._count('shared_hits')
+                if self.local is not None:
+                    self.local.set(key, value)
+                return value
+
+        self._count('misses')
+        return default
+
+    def set(self, entity, value, variant='', generation=None):
+        """Store value under generation, the one read before computing it"""
+        if generation is None:
+            generation = self.generation(entity)
+        key = self._key(entity, variant, generation)
+        if self.local is not None:
+            self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+        self._count('sets')
+
+    def invalidate(self, entity):
+        if self.shared is not None:
+            self.shared.bump_generation(self._generation_key(entity))
+        else:
+            with self._lock:
+                self._generations[entity] = self._generations.get(entity, 0) + 1
+        self._count('invalidations')
+
+    def clear(self):
+        """Drop this process's entries and the whole shared tier (every namespace)"""
+        if self.local is not None:
+            self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+        with self._lock:
+            self._generations.clear()
+
+    def stats(self):
+        """Hit/miss counters for this worker process"""
+        with self._lock:
+            stats = dict(self.counters)
+        lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['local_hits'] + stats['shared_hits']) / lookups if lookups else 0
+        stats['local_entries'] = len(self.local) if self.local is not None else 0
+        return stats
+
+
+def make_cache(namespace, config, local_ttl=None, shared_ttl=None):
+    """Build a TieredCache from the CACHE_* settings in config
+
+    CACHE_BACKEND is 'tiered' (LRU + shared SQLite), 'memory', 'sqlite' or
+    'none'. local_ttl/shared_ttl override the configured TTLs for this cache.
+    """
+    backend = config.get('CACHE_BACKEND', 'tiered')
+    local = shared = None
+
+    if backend in ('tiered', 'memory'):
+        local = LRUCache(config.get('CACHE_LOCAL_MAX_ENTRIES', 512),
+                         local_ttl or config.get('CACHE_LOCAL_TTL', 60))
+    if backend in ('tiered', 'sqlite'):
+        shared = SQLiteCache(config['CACHE_SQLITE_PATH'],
+                             config.get('CACHE_SHARED_MAX_ENTRIES', 10000),
+                             shared_ttl or config.get('CACHE_SHARED_TTL', 3600))
+    elif backend not in ('memory', 'none'):
+        raise ValueError(f'Unknown CACHE_BACKEND: {backend}')
+
+    return TieredCache(namespace, local, shared)
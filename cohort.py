@@ -0,0 +1,177 @@
+"""
+Cohort analytics across many patients for doctors
+
+A cohort is every patient, or the patients whose name or email matches a
+search. Its figures are aggregated in SQL from the tables that are already
+maintained on write: per-patient smoked/resisted counts from
+SmokingDailyRollup, trigger/location/emotion counts from SmokingLogSuggestion,
+and the urge level distribution with one GROUP BY over SmokingLog. No
+per-patient Python work is done.
+
+The result is cached with the highest SmokingLog id it includes (the
+watermark). Logs are only ever appended, so refresh_cohort() brings a cached
+result up to date by folding in the logs above the watermark, usually a
+handful of rows. build_cohort() recomputes everything; callers do that when
+the cached result is older than COHORT_REBUILD_AFTER, which also corrects any
+ids that committed out of order. The rollup and suggestion tables carry no
+log ids, so build_cohort() reads the watermark and every aggregate in one
+snapshot instead; otherwise a log committed in between could be counted by
+the aggregates and again by the next refresh.
+"""
+import copy
+import statistics
+import time
+from contextlib import contextmanager
+from sqlalchemy import func
+from models import db, SmokingDailyRollup, SmokingLog, SmokingLogSuggestion, User
+
+COHORT_FIELDS = ('trigger', 'location', 'emotion')
+TOP_VALUES = 10
+RESIST_RATE_BUCKETS = 10
+
+
+def cohort_members(search=''):
+    """SELECT of the patient ids in the cohort"""
+    query = db.select(User.id).where(User.role == 'patient')
+    if search:
+        query = query.where(User.name.icontains(search, autoescape=True) |
+                            User.email.icontains(search, autoescape=True))
+    return query
+
+
+def _latest_log_id():
+    return db.session.query(func.coalesce(func.max(SmokingLog.id), 0)).scalar()
+
+
+@contextmanager
+def _snapshot():
+    """A connection whose reads all see the database as of the first one"""
+    with db.engine.connect() as conn:
+        if conn.dialect.name == 'sqlite':
+            # pysqlite does not begin a transaction before a SELECT, and
+            # without one every statement reads the latest commit
+            conn.exec_driver_sql('BEGIN')
+        else:
+            conn = conn.execution_options(isolation_level='REPEATABLE READ')
+        try:
+            yield conn
+        finally:
+            conn.rollback()
+
+
+def build_cohort(search=''):
+    """Aggregate the cohort from scratch; returns the cacheable (JSON) raw result"""
+    members = cohort_members(search)
+    with _snapshot() as conn:
+        watermark = conn.execute(db.select(func.coalesce(func.max(SmokingLog.id), 0))).scalar()
+        data = {
+            'watermark': watermark,
+            'built_at': time.time(),
+            'per_patient': {},
+            'categories': {field: {} for field in COHORT_FIELDS},
+            'urge_levels': {},
+        }
+
+        rows = conn.execute(db.select(SmokingDailyRollup.user_id,
+                                      func.sum(SmokingDailyRollup.smoked_count),
+                                      func.sum(SmokingDailyRollup.resisted_count))
+                            .where(SmokingDailyRollup.user_id.in_(members))
+                            .group_by(SmokingDailyRollup.user_id))
+        for user_id, smoked, resisted in rows:
+            data['per_patient'][str(user_id)] = [int(smoked), int(resisted)]
+
+        rows = conn.execute(db.select(SmokingLogSuggestion.field, SmokingLogSuggestion.value_lower,
+                                      func.max(SmokingLogSuggestion.value), func.sum(SmokingLogSuggestion.count))
+                            .where(SmokingLogSuggestion.user_id.in_(members),
+                                   SmokingLogSuggestion.field.in_(COHORT_FIELDS))
+                            .group_by(SmokingLogSuggestion.field, SmokingLogSuggestion.value_lower))
+        for field, value_lower, label, count in rows:
+            data['categories'][field][value_lower] = [label, int(count)]
+
+        rows = conn.execute(db.select(SmokingLog.urge_level, func.count(SmokingLog.id))
+                            .where(SmokingLog.user_id.in_(members), SmokingLog.id <= watermark)
+                            .group_by(SmokingLog.urge_level))
+        for level, count in rows:
+            data['urge_levels'][str(level)] = count
+
+    return data
+
+
+def refresh_cohort(data, search=''):
+    """A copy of data with the logs added since it was built folded in, or None if there are none
+
+    data itself is left alone, since other threads may be reading it from the
+    in-process cache.
+    """
+    watermark = _latest_log_id()
+    if watermark <= data['watermark']:
+        return None
+    data = copy.deepcopy(data)
+
+    rows = db.session.query(SmokingLog.user_id, SmokingLog.logged_at, SmokingLog.smoke_or_resist,
+                            SmokingLog.urge_level, *[getattr(SmokingLog, field) for field in COHORT_FIELDS])\
+        .filter(SmokingLog.id > data['watermark'], SmokingLog.id <= watermark,
+                SmokingLog.user_id.in_(cohort_members(search)))
+    for user_id, logged_at, action, urge_level, *values in rows:
+        # Same rules as record_logs() and record_suggestions()
+        if logged_at is not None and action in ('Smoked', 'Resisted'):
+            counts = data['per_patient'].setdefault(str(user_id), [0, 0])
+            counts[0 if action == 'Smoked' else 1] += 1
+        for field, value in zip(COHORT_FIELDS, values):
+            if value and value.strip():
+                entry = data['categories'][field].setdefault(value.strip().lower(), [value, 0])
+                entry[0] = max(entry[0], value)  # same spelling build_cohort() picks
+                entry[1] += 1
+        key = str(urge_level)
+        data['urge_levels'][key] = data['urge_levels'].get(key, 0) + 1
+
+    data['watermark'] = watermark
+    return data
+
+
+def _share(count, total):
+    return count / total if total else 0
+
+
+def cohort_summary(data, patient_count):
+    """Figures for the cohort page and API from a raw result"""
+    entries = sum(data['urge_levels'].values())
+    smoked = sum(counts[0] for counts in data['per_patient'].values())
+    resisted = sum(counts[1] for counts in data['per_patient'].values())
+
+    rates = [r / (s + r) for s, r in data['per_patient'].values() if s + r]
+    histogram = [0] * RESIST_RATE_BUCKETS
+    for rate in rates:
+        histogram[min(int(rate * RESIST_RATE_BUCKETS), RESIST_RATE_BUCKETS - 1)] += 1
+
+    categories = {}
+    for field in COHORT_FIELDS:
+        values = sorted(data['categories'][field].values(), key=lambda entry: (-entry[1], entry[0]))
+        total = sum(count for _, count in values)
+        categories[field] = [(label, count, _share(count, total)) for label, count in values[:TOP_VALUES]]
+
+    urge_levels = sorted((int(level), count) for level, count in data['urge_levels'].items())
+    urge_total = sum(count for _, count in urge_levels)
+
+    return {
+        'patients': patient_count,
+        'active_patients': len(rates),
+        'entries': entries,
+        'smoked': smoked,
+        'resisted': resisted,
+        'resist_rate': _share(resisted, smoked + resisted),
+        'median_patient_resist_rate': statistics.median(rates) if rates else None,
+        'resist_rate_histogram': [
+            (f'{i * 100 // RESIST_RATE_BUCKETS}-{(i + 1) * 100 // RESIST_RATE_BUCKETS}%', count)
+            for i, count in enumerate(histogram)
+        ],
+        'categories': categories,
+        'urge_levels': [(level, count, _share(count, urge_total)) for level, count in urge_levels],
+        'avg_urge_level': _share(sum(level * count for level, count in urge_levels), urge_total),
+        'watermark': data['watermark'],
+    }
+
+
+def cohort_patient_count(search=''):
+    """Number of patients in the cohort, with or without logs"""
+    return db.session.query(func.count()).select_from(cohort_members(search).subquery()).scalar()
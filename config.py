@@ -1,15 +1,140 @@
 import os
 from datetime import timedelta
+from database import database_uri, engine_options
+
 
 class Config:
     """Base configuration"""
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production-please'
-    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///medical_app.db'
+    SQLALCHEMY_DATABASE_URI = database_uri(os.environ.get('DATABASE_URL'))
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     UPLOAD_FOLDER = 'uploads'
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
     ALLOWED_EXTENSIONS = {'pdf', 'jpg', 'jpeg', 'png'}
     
+    # Resumable uploads: reports up to MAX_REPORT_SIZE are sent in chunks of
+    # UPLOAD_CHUNK_SIZE, so no single request exceeds MAX_CONTENT_LENGTH
+    MAX_REPORT_SIZE = 256 * 1024 * 1024  # 256MB
+    UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # 4MB
+    UPLOAD_TMP_FOLDER = os.environ.get('UPLOAD_TMP_FOLDER')  # default: UPLOAD_FOLDER/partial
+    UPLOAD_SESSION_TTL = 24 * 3600  # seconds an idle upload is kept before it is discarded
+    
+    # Report storage: 'local' (content-addressed tree, default UPLOAD_FOLDER/blobs)
+    # or 's3' (any S3-compatible store; needs boto3)
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND') or 'local'
+    STORAGE_ROOT = os.environ.get('STORAGE_ROOT')
+    S3_BUCKET = os.environ.get('S3_BUCKET')
+    S3_PREFIX = os.environ.get('S3_PREFIX', '')
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+    
+    # Thumbnails/previews of reports, generated in the background by
+    # PREVIEW_WORKERS threads per process (0: leave it to preview_worker.py)
+    PREVIEW_WORKERS = int(os.environ.get('PREVIEW_WORKERS', 2))
+    PREVIEW_SIZES = {'thumb': 160, 'preview': 1024}  # longest side in pixels
+    PREVIEW_MAX_ATTEMPTS = 3
+    PREVIEW_STALE_AFTER = 600  # seconds before a running job is assumed dead and retried
+    PREVIEW_POLL_INTERVAL = 5  # seconds preview_worker.py sleeps when idle
+    
+    # Report serving. REPORT_OFFLOAD hands the transfer to a front proxy once
+    # access is checked: '' (serve from Python), 'x-accel-redirect' (nginx) or
+    # 'x-sendfile' (Apache/lighttpd)
+    REPORT_OFFLOAD = os.environ.get('REPORT_OFFLOAD', '')
+    REPORT_OFFLOAD_PREFIX = os.environ.get('REPORT_OFFLOAD_PREFIX') or '/protected-uploads/'
+    REPORT_MAX_AGE = 3600  # seconds browsers may reuse a report before revalidating
+    
+    # Password hashing: werkzeug method string ('scrypt:N:r:p' or
+    # 'pbkdf2:sha256:iterations'). Existing hashes are upgraded on the next
+    # login after a change. Hashes run in PASSWORD_HASH_WORKERS processes per
+    # web worker (0: in the request thread); logins are turned away with
+    # "busy" once PASSWORD_HASH_MAX_PENDING more are waiting.
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'scrypt:32768:8:1'
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 1))
+    PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 8))
+    
+    # Login throttling, checked before any password is hashed: attempts per
+    # account and per client IP within LOGIN_THROTTLE_WINDOW seconds.
+    # Successful logins don't count against the IP.
+    LOGIN_THROTTLE_PATH = os.environ.get('LOGIN_THROTTLE_PATH') or 'cache/login_throttle.sqlite3'
+    LOGIN_THROTTLE_WINDOW = 15 * 60
+    LOGIN_MAX_ATTEMPTS_PER_ACCOUNT = 5
+    LOGIN_MAX_ATTEMPTS_PER_IP = 30
+    # Number of reverse proxies in front of the app whose X-Forwarded-For
+    # gives the client IP (0: use the connecting address)
+    PROXY_COUNT = int(os.environ.get('PROXY_COUNT', 0))
+    
+    # Offline log sync: entries accepted per /api/smoking-logs/batch request
+    LOG_BATCH_MAX_SIZE = 200
+    
+    # Doctor dashboard patient list
+    PATIENTS_PAGE_SIZE = 25
+    
+    # Admin dashboard user list
+    USERS_PAGE_SIZE = 50
+    
+    # Patient log table pagination
+    LOG_PAGE_SIZE = 50
+    LOG_PAGE_MAX_SIZE = 200
+    
+    # Cohort analytics are brought up to date from new logs on every view
+    # and recomputed from scratch once the cached result is this old (seconds)
+    COHORT_REBUILD_AFTER = 3600
+    
+    # Smoking patterns: combinations must cover this many logs to be reported
+    PATTERN_MIN_SUPPORT = 3
+    PATTERN_RULE_LIMIT = 10
+    # and the memoized counts are recounted from scratch once this old (seconds)
+    PATTERN_REBUILD_AFTER = 3600
+    
+    # Analytics cache: 'tiered' (in-process LRU + SQLite file shared by all
+    # workers), 'memory', 'sqlite' or 'none'
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND') or 'tiered'
+    CACHE_SQLITE_PATH = os.environ.get('CACHE_SQLITE_PATH') or 'cache/cache.sqlite3'
+    CACHE_LOCAL_MAX_ENTRIES = 512
+    CACHE_LOCAL_TTL = 60  # seconds
+    CACHE_SHARED_MAX_ENTRIES = 10000
+    CACHE_SHARED_TTL = 3600  # seconds
+    IDENTITY_CACHE_TTL = 300  # seconds; login identities, invalidated on admin changes
+    
+    # Autocomplete lookup cache (per worker process)
+    AUTOCOMPLETE_CACHE_SIZE = 1024
+    AUTOCOMPLETE_CACHE_TTL = 60  # seconds; bounds staleness across workers
+    
+    # Request metrics served at /metrics in Prometheus text format. Every
+    # worker of a server writes its samples to METRICS_DIR, which they must
+    # share. /metrics requires "Authorization: Bearer METRICS_TOKEN" when
+    # that is set, and otherwise only answers direct requests from localhost.
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+    METRICS_DIR = os.environ.get('METRICS_DIR') or 'cache/metrics'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_SLOW_REQUEST = float(os.environ.get('METRICS_SLOW_REQUEST', 1.0))  # seconds; logged with their queries
+    
+    # Development/CI: with QUERY_DEBUG=1 every request is checked against its
+    # query budget (QUERY_BUDGETS by endpoint, else QUERY_BUDGET_DEFAULT) and
+    # for statements run QUERY_REPEAT_THRESHOLD or more times with different
+    # parameters (N+1), and problems are logged; see querydebug.py
+    QUERY_DEBUG = os.environ.get('QUERY_DEBUG') == '1'
+    QUERY_BUDGET_DEFAULT = 20
+    QUERY_BUDGETS = {
+        # Cold caches: the doctor's identity, the patient, the first page of
+        # logs, the reports and nine aggregates for the analytics
+        'view_patient_data': 13,
+    }
+    QUERY_REPEAT_THRESHOLD = 5
+    QUERY_SLOW_STATEMENT = 0.1  # seconds
+    
+    # Serving profile, set for gunicorn_config.py (see there), and a database
+    # pool to match. DB_POOL_SIZE/DB_MAX_OVERFLOW override the per-profile
+    # sizes; DB_POOL_RECYCLE (seconds) applies to network databases.
+    WORKER_PROFILE = os.environ.get('GUNICORN_PROFILE', 'sync')
+    WORKER_THREADS = int(os.environ.get('GUNICORN_THREADS', 8))
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(
+        SQLALCHEMY_DATABASE_URI, WORKER_PROFILE, WORKER_THREADS,
+        extra_connections=PREVIEW_WORKERS,
+        pool_size=int(os.environ['DB_POOL_SIZE']) if os.environ.get('DB_POOL_SIZE') else None,
+        max_overflow=int(os.environ['DB_MAX_OVERFLOW']) if os.environ.get('DB_MAX_OVERFLOW') else None,
+        pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    )
+    
     # Flask-Login settings
     REMEMBER_COOKIE_DURATION = timedelta(days=30)
     SESSION_COOKIE_HTTPONLY = True
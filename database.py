@@ -0,0 +1,84 @@
+"""
+Database engine settings
+
+database_uri() turns DATABASE_URL into a SQLAlchemy URI and engine_options()
+builds SQLALCHEMY_ENGINE_OPTIONS for the gunicorn worker profile. Both are
+used by config.py.
+
+Importing this module also registers a connect hook that puts every SQLite
+connection in WAL mode with synchronous=NORMAL. Readers then no longer wait
+for a writer, and a commit no longer fsyncs the whole database: only a power
+loss (not an application crash) can drop the last few commits. Writers
+still take turns; busy_timeout makes them wait for the lock instead of
+failing with "database is locked". Deployments with many concurrent writers
+should use PostgreSQL.
+"""
+import sqlite3
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_URI = 'sqlite:///medical_app.db'
+SQLITE_BUSY_TIMEOUT_MS = 15000
+
+
+def database_uri(url):
+    """SQLAlchemy URI for DATABASE_URL, defaulting to the local SQLite file
+
+    Hosting providers (Render, Heroku) hand out postgres:// URLs, which
+    SQLAlchemy no longer accepts. PostgreSQL URLs without a driver are pinned
+    to psycopg2, the driver in requirements.txt, since newer SQLAlchemy
+    releases default to psycopg 3.
+    """
+    if not url:
+        return DEFAULT_URI
+    for scheme in ('postgres://', 'postgresql://'):
+        if url.startswith(scheme):
+            return 'postgresql+psycopg2://' + url[len(scheme):]
+    return url
+
+
+def engine_options(uri, profile, threads, extra_connections=0,
+                   pool_size=None, max_overflow=None, pool_recycle=1800, pool_timeout=30):
+    """Connection pool settings for one worker process
+
+    sync serves one request per process and gthread one per thread. gevent
+    can hold far more requests than the database should see, so greenlets
+    share a fixed pool and wait up to pool_timeout for a free connection.
+    extra_connections covers background threads (preview generation).
+    pool_size/max_overflow override the per-profile defaults.
+
+    Network databases also get pre_ping, so connections the server dropped
+    are replaced instead of failing the request, and pool_recycle, so none
+    outlives server-side idle timeouts.
+    """
+    if uri.startswith('sqlite') and (':memory:' in uri or uri.rstrip('/') == 'sqlite:'):
+        return {}  # in-memory SQLite keeps a single connection per thread
+
+    if profile == 'gevent':
+        size, overflow = 10, 20
+    elif profile == 'gthread':
+        size, overflow = threads, 2
+    else:
+        size, overflow = 1, 2
+    options = {
+        'pool_size': (size if pool_size is None else pool_size) + extra_connections,
+        'max_overflow': overflow if max_overflow is None else max_overflow,
+        'pool_timeout': pool_timeout,
+    }
+
+    if not uri.startswith('sqlite'):
+        options['pool_pre_ping'] = True
+        options['pool_recycle'] = pool_recycle
+    return options
+
+
+@event.listens_for(Engine, 'connect')
+def configure_sqlite(dbapi_connection, connection_record):
+    """WAL, relaxed fsync and a busy timeout for every new SQLite connection"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+    cursor.close()
@@ -6,11 +6,29 @@ import os
 bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
 backlog = 2048
 
-# Worker processes
-workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "sync"
-worker_connections = 1000
-timeout = 120
+# Worker processes. GUNICORN_PROFILE picks how each process serves requests:
+#   sync    - one request at a time per process (default)
+#   gthread - GUNICORN_THREADS requests at once per process on OS threads
+#   gevent  - up to worker_connections requests per process on greenlets;
+#             needs `pip install gevent`
+# config.py reads the same variables to size the database pool to match.
+profile = os.environ.get('GUNICORN_PROFILE', 'sync')
+if profile not in ('sync', 'gthread', 'gevent'):
+    raise ValueError(f'Unknown GUNICORN_PROFILE: {profile}')
+
+worker_class = profile
+if profile == 'sync':
+    workers = multiprocessing.cpu_count() * 2 + 1
+    # A sync worker misses heartbeats while it serves a long upload/download
+    timeout = 120
+else:
+    # Concurrency comes from threads/greenlets, so fewer processes are needed,
+    # and the heartbeat keeps running while a slow request is in progress
+    workers = multiprocessing.cpu_count() + 1
+    timeout = 30
+workers = int(os.environ.get('GUNICORN_WORKERS', workers))
+threads = int(os.environ.get('GUNICORN_THREADS', 8)) if profile == 'gthread' else 1
+worker_connections = int(os.environ.get('GUNICORN_CONNECTIONS', 1000))
 keepalive = 5
 
 # Logging
@@ -18,6 +36,10 @@ accesslog = "-"
 errorlog = "-"
 loglevel = "info"
 
+# Directory the workers share their /metrics samples through (METRICS_DIR
+# in config.py, relative to the working directory)
+metrics_dir = os.environ.get('METRICS_DIR') or 'cache/metrics'
+
 # Process naming
 proc_name = "medical-tracker"
 
@@ -41,9 +63,12 @@ preload_app = False
 # Server hooks
 def on_starting(server):
     print("Starting Medical Tracker application...")
+    # Start /metrics from zero rather than from the last run's worker files
+    import metrics
+    metrics.clear_directory(metrics_dir)
 
 def when_ready(server):
-    print(f"Medical Tracker is ready. Spawning {server.WORKERS} workers")
+    print(f"Medical Tracker is ready. Spawning {server.WORKERS} {profile} workers")
 
 def on_reload(server):
     print("Reloading Medical Tracker application...")
@@ -56,6 +81,14 @@ def pre_fork(server, worker):
 
 def post_fork(server, worker):
     server.log.info("Worker spawned (pid: %s)", worker.pid)
+    if profile == 'gevent':
+        # psycopg2 blocks the whole process on queries unless told to yield
+        try:
+            from psycogreen.gevent import patch_psycopg
+        except ImportError:
+            pass
+        else:
+            patch_psycopg()
 
 def post_worker_init(worker):
     worker.log.info("Worker initialized (pid: %s)", worker.pid)
@@ -63,3 +96,8 @@ def post_worker_init(worker):
 def worker_abort(worker):
     worker.log.info("Worker received SIGABRT signal")
 
+def child_exit(server, worker):
+    # Keep an exited worker's counts in /metrics (max_requests recycles workers)
+    import metrics
+    metrics.archive_process(metrics_dir, worker.pid)
+
@@ -0,0 +1,62 @@
+"""
+Entry module for the password hashing pool processes
+
+multiprocessing starts each child by importing the parent program's
+__main__ again, which re-runs app startup under `python app.py` and fails in
+scripts without an `if __name__ == '__main__':` guard. Processes from
+get_context() are forked from a fork server that has imported only this
+module, and they run this module as their __main__ instead of the program's.
+Nothing in the parent changes while they start, so request threads are not
+affected.
+
+get_context() returns None where the fork server is unavailable (Windows).
+"""
+import io
+import multiprocessing
+import os
+import sys
+
+# Loaded once in the fork server, so pool processes start with it imported
+import werkzeug.security  # noqa: F401
+
+if sys.platform != 'win32':
+    from multiprocessing import context, forkserver, reduction, spawn, util
+    from multiprocessing.popen_forkserver import Popen as ForkServerPopen
+
+    class _Popen(ForkServerPopen):
+        def _launch(self, process_obj):
+            # popen_forkserver.Popen._launch, with this module as __main__
+            prep_data = spawn.get_preparation_data(process_obj._name)
+            prep_data.pop('init_main_from_path', None)
+            prep_data['init_main_from_name'] = __name__
+            buf = io.BytesIO()
+            context.set_spawning_popen(self)
+            try:
+                reduction.dump(prep_data, buf)
+                reduction.dump(process_obj, buf)
+            finally:
+                context.set_spawning_popen(None)
+
+            self.sentinel, w = forkserver.connect_to_new_process(self._fds)
+            _parent_w = os.dup(w)
+            self.finalizer = util.Finalize(self, util.close_fds, (_parent_w, self.sentinel))
+            with open(w, 'wb', closefd=True) as f:
+                f.write(buf.getbuffer())
+            self.pid = forkserver.read_signed(self.sentinel)
+
+    class _Process(context.ForkServerProcess):
+        @staticmethod
+        def _Popen(process_obj):
+            return _Popen(process_obj)
+
+    class _Context(context.ForkServerContext):
+        Process = _Process
+
+
+def get_context():
+    """A multiprocessing context whose processes start from this module"""
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return None
+    ctx = _Context()
+    ctx.set_forkserver_preload([__name__])
+    return ctx
@@ -0,0 +1,56 @@
+"""
+Cached identities for Flask-Login's user_loader
+
+load_user runs on every authenticated request. Instead of a full User row it
+returns a SessionUser built from the few columns needed for authorisation and
+display, cached per user id and row version. Sessions carry the version the
+row had at login ('<id>:<version>'), and every write to the row replaces it,
+so an identity is only ever served for the row it was read from: a changed,
+deleted or re-created user no longer matches and the session ends. Admin
+changes also invalidate the entry through the cache's shared generation
+stamp.
+"""
+from flask_login import UserMixin
+from models import db, User
+
+IDENTITY_COLUMNS = (User.id, User.username, User.email, User.name, User.role, User.version)
+
+
+class SessionUser(UserMixin):
+    """Read-only stand-in for the logged-in User"""
+
+    def __init__(self, id, username, email, name, role, version):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.name = name
+        self.role = role
+        self.version = version
+
+    def get_id(self):
+        return f'{self.id}:{self.version}'
+
+    def __repr__(self):
+        return f'<SessionUser {self.username}>'
+
+
+def load_identity(session_id, cache):
+    """SessionUser for a session's '<id>:<version>' from the cache or one narrow query
+
+    None if the row is gone or has changed since the session was made.
+    """
+    user_id, _, version = session_id.partition(':')
+    if not user_id.isdigit() or not version:
+        return None  # a session from before versions; log in again
+    user_id = int(user_id)
+
+    generation = cache.generation(user_id)
+    identity = cache.get(user_id, variant=version, generation=generation)
+    if identity is None:
+        row = db.session.query(*IDENTITY_COLUMNS)\
+            .filter(User.id == user_id, User.version == version).first()
+        if row is None:
+            return None
+        identity = dict(row._mapping)
+        cache.set(user_id, identity, variant=version, generation=generation)
+    return SessionUser(**identity)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Load test: compare gunicorn worker profiles
+
+Starts the app under gunicorn once per GUNICORN_PROFILE against a throwaway
+SQLite database, drives it with concurrent clients for a fixed time and
+prints throughput and latency for each profile.
+
+Usage: python loadtest.py [--profiles sync,gthread,gevent] [--clients 32]
+                          [--duration 20] [--workers 2] [--port 5055]
+
+Each client logs in as its own patient and loops over the dashboard, an
+autocomplete lookup and a report download, logging in again (a password
+hash) every tenth round. Profiles whose worker class is not installed
+(gevent) are skipped.
+"""
+import argparse
+import http.cookiejar
+import io
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'loadtest1'
+
+
+def seed(data_dir, clients):
+    """Create one patient per client with logs and a report; returns {username: report id}"""
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(data_dir, "loadtest.db")}'
+    os.environ['PREVIEW_WORKERS'] = '0'
+    os.chdir(data_dir)
+    sys.path.insert(0, REPO_DIR)
+    from werkzeug.security import generate_password_hash
+    from app import app, add_report, store_blob
+    from models import db, User, SmokingLog
+    from rollups import record_logs
+    from suggestions import record_suggestions
+
+    password_hash = generate_password_hash(PASSWORD)
+    report_body = b'%PDF-1.4\n' + os.urandom(256 * 1024)
+    reports = {}
+    with app.app_context():
+        for i in range(clients):
+            user = User(username=f'load{i}', email=f'load{i}@example.com', name=f'Load {i}',
+                        role='patient', password_hash=password_hash)
+            db.session.add(user)
+            db.session.flush()
+
+            logs = []
+            for _ in range(200):
+                logged_at = datetime.now() - timedelta(minutes=random.randint(0, 60 * 24 * 60))
+                logs.append(SmokingLog(
+                    user_id=user.id, date=logged_at.strftime('%Y-%m-%d'), time=logged_at.strftime('%H:%M'),
+                    logged_at=logged_at, location=random.choice(['Home', 'Work', 'Car', 'Bar']),
+                    trigger=random.choice(['Stress', 'Coffee', 'Boredom']),
+                    emotion=random.choice(['Anxious', 'Calm', 'Tired']), who_with='Alone',
+                    urge_level=random.randint(1, 5), smoke_or_resist=random.choice(['Smoked', 'Resisted'])
+                ))
+            db.session.add_all(logs)
+            record_logs(logs)
+            record_suggestions(logs)
+
+            content_hash, size = store_blob(io.BytesIO(report_body))
+            report = add_report(user.id, 'Blood test', 'blood.pdf', content_hash, size)
+            db.session.commit()
+            reports[user.username] = report.id
+    return reports
+
+
+def start_server(profile, data_dir, workers, port):
+    env = dict(os.environ, GUNICORN_PROFILE=profile, GUNICORN_WORKERS=str(workers), PORT=str(port))
+    log = open(os.path.join(data_dir, f'gunicorn-{profile}.log'), 'w')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--config', os.path.join(REPO_DIR, 'gunicorn_config.py'),
+         '--pythonpath', REPO_DIR, 'app:app'],
+        cwd=data_dir, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            return None
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=2).read()
+            return server
+        except (urllib.error.URLError, ConnectionError, OSError):
+            time.sleep(0.3)
+    server.terminate()
+    return None
+
+
+def client(base_url, username, report, deadline, results):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    login_body = urllib.parse.urlencode({'login': username, 'password': PASSWORD}).encode()
+    requests = [
+        ('dashboard', '/patient/dashboard', None),
+        ('autocomplete', '/autocomplete/location?q=h', None),
+        ('download', f'/download/{report}', None),
+    ]
+
+    def timed(name, path, body):
+        started = time.perf_counter()
+        try:
+            with opener.open(base_url + path, data=body, timeout=30) as response:
+                response.read()
+                # A refused or expired login ends on the login page after the redirects
+                ok = 200 <= response.status < 300 and \
+                    urllib.parse.urlsplit(response.geturl()).path != '/login'
+        except (urllib.error.URLError, ConnectionError, OSError):
+            ok = False
+        results.append((name, time.perf_counter() - started, ok))
+
+    timed('login', '/login', login_body)
+    rounds = 0
+    while time.monotonic() < deadline:
+        for name, path, body in requests:
+            timed(name, path, body)
+        rounds += 1
+        if rounds % 10 == 0:
+            timed('login', '/login', login_body)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def run_profile(profile, args, data_dir, reports):
+    server = start_server(profile, data_dir, args.workers, args.port)
+    if server is None:
+        with open(os.path.join(data_dir, f'gunicorn-{profile}.log')) as log:
+            errors = [line for line in log.read().splitlines() if 'Error' in line] or ['see gunicorn output']
+        print(f'{profile:8} skipped, server did not start: {errors[-1].strip()}')
+        return
+
+    results = []
+    deadline = time.monotonic() + args.duration
+    threads = [threading.Thread(target=client, args=(f'http://127.0.0.1:{args.port}', username, report,
+                                                     deadline, results))
+               for username, report in reports.items()]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    server.terminate()
+    server.wait()
+
+    latencies = sorted(latency for _, latency, ok in results if ok)
+    errors = sum(1 for _, _, ok in results if not ok)
+    print(f'{profile:8} {len(results):8d} {len(results) / elapsed:8.1f} '
+          f'{percentile(latencies, 0.50) * 1000:8.1f} {percentile(latencies, 0.95) * 1000:8.1f} '
+          f'{percentile(latencies, 0.99) * 1000:8.1f} {errors:7d}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare gunicorn worker profiles under load')
+    parser.add_argument('--profiles', default='sync,gthread,gevent')
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=20, help='seconds per profile')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn processes per profile')
+    parser.add_argument('--port', type=int, default=5055)
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix='medical-loadtest-')
+    try:
+        reports = seed(data_dir, args.clients)
+        print(f'{args.clients} clients, {args.workers} workers, {args.duration:.0f}s per profile\n')
+        print(f'{"profile":8} {"requests":>8} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>7}')
+        for profile in args.profiles.split(','):
+            run_profile(profile.strip(), args, data_dir, reports)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Streaming export of a patient's smoking logs
+
+Rows are read with yield_per, so PostgreSQL hands them over from a
+server-side cursor in batches and only one batch is held in memory at a
+time, however long the history is. Each batch is formatted and sent before
+the next is fetched.
+
+    rows = export_rows(patient_id, start, end)
+    Response(stream_with_context(iter_csv(rows)), mimetype='text/csv')
+"""
+import csv
+import io
+import json
+from models import db, SmokingLog
+
+EXPORT_FIELDS = ('id', 'date', 'time', 'logged_at', 'location', 'trigger', 'emotion', 'who_with',
+                 'urge_level', 'smoke_or_resist', 'how_it_felt', 'notes', 'created_at')
+EXPORT_BATCH_SIZE = 1000
+# Spreadsheets run a cell starting with one of these as a formula
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def export_rows(patient_id, start=None, end=None, batch_size=EXPORT_BATCH_SIZE):
+    """Batches of row tuples (EXPORT_FIELDS) for a patient, oldest first
+
+    start/end are datetimes bounding logged_at (end exclusive). Filtering
+    and ordering both follow the (user_id, logged_at) index.
+    """
+    columns = [getattr(SmokingLog, name) for name in EXPORT_FIELDS]
+    query = db.select(*columns).where(SmokingLog.user_id == patient_id)
+    if start is not None:
+        query = query.where(SmokingLog.logged_at >= start)
+    if end is not None:
+        query = query.where(SmokingLog.logged_at < end)
+    query = query.order_by(SmokingLog.logged_at, SmokingLog.id)
+
+    result = db.session.execute(query.execution_options(yield_per=batch_size))
+    for batch in result.partitions():
+        yield batch
+
+
+def _text(value):
+    return value.isoformat(sep=' ') if hasattr(value, 'isoformat') else value
+
+
+def _cell(value):
+    """A CSV cell for value; text that would start a formula gets a leading quote"""
+    value = _text(value)
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def iter_csv(batches):
+    """CSV text with a header row, one chunk per batch"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    yield buffer.getvalue()
+
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([_cell(value) for value in row] for row in batch)
+        yield buffer.getvalue()
+
+
+def iter_ndjson(batches):
+    """One JSON object per line, one chunk per batch"""
+    for batch in batches:
+        yield ''.join(json.dumps(dict(zip(EXPORT_FIELDS, map(_text, row)))) + '\n' for row in batch)
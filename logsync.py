@@ -0,0 +1,50 @@
+"""
+Batch ingestion of smoking logs from offline clients
+
+A client gives every entry its own client_id and may resend a batch as often
+as it likes: (user_id, client_id) is unique, so entries already stored are
+reported as duplicates instead of being inserted again. New entries go in as
+one multi-row INSERT, and the rollup and suggestion tables are updated in the
+same transaction.
+"""
+from models import db, SmokingLog
+from rollups import UPSERT_INSERTS, record_logs
+from suggestions import record_suggestions
+
+
+def insert_log_batch(user_id, entries):
+    """Insert validated entries ({client_id: column values}) for a user; the caller commits
+
+    Returns {client_id: (log id, created)}.
+    """
+    results = {}
+    if not entries:
+        return results
+
+    existing = db.session.query(SmokingLog.client_id, SmokingLog.id)\
+        .filter(SmokingLog.user_id == user_id, SmokingLog.client_id.in_(list(entries)))
+    for client_id, log_id in existing:
+        results[client_id] = (log_id, False)
+
+    rows = [dict(fields, user_id=user_id, client_id=client_id)
+            for client_id, fields in entries.items() if client_id not in results]
+    if not rows:
+        return results
+
+    insert = UPSERT_INSERTS.get(db.session.get_bind().dialect.name)
+    if insert is None:
+        db.session.execute(db.insert(SmokingLog), rows)
+        created = {row['client_id'] for row in rows}
+    else:
+        # A concurrent retry of the same batch may get there first
+        stmt = insert(SmokingLog).on_conflict_do_nothing(index_elements=['user_id', 'client_id'])
+        created = set(db.session.execute(stmt.returning(SmokingLog.client_id), rows).scalars())
+
+    new_logs = [SmokingLog(**row) for row in rows if row['client_id'] in created]
+    record_logs(new_logs)
+    record_suggestions(new_logs)
+
+    for client_id, log_id in db.session.query(SmokingLog.client_id, SmokingLog.id)\
+            .filter(SmokingLog.user_id == user_id, SmokingLog.client_id.in_([row['client_id'] for row in rows])):
+        results[client_id] = (log_id, client_id in created)
+    return results
@@ -0,0 +1,327 @@
+"""
+Request metrics in the Prometheus text format
+
+MetricsMiddleware wraps the WSGI app and records for every request:
+
+    http_requests_total{endpoint,method,status}
+    http_request_duration_seconds{endpoint}   histogram, until the last byte is sent
+    http_response_bytes_total{endpoint}
+    db_queries_total{endpoint}, db_query_seconds_total{endpoint}
+    template_renders_total{template}, template_render_seconds_total{template}
+
+SQL statements are timed with SQLAlchemy cursor events and templates with
+Flask's render signals; both are attributed to the request being handled
+through RequestStats in the WSGI environ, so queries run while a streamed
+response is sent still count. Requests slower than slow_request seconds are
+logged with their slowest statements. With capture_parameters (QUERY_DEBUG)
+statement parameters are kept too, for querydebug.py's N+1 checks.
+
+Every sample is a counter or a histogram bucket, so samples from several
+processes can simply be added up. Each worker writes its own to
+METRICS_DIR/metrics-<pid>.json at most every flush_interval seconds and on
+exit, and render() sums the files of all workers, so a scrape of /metrics
+covers the whole gunicorn server whichever worker answers it. The gunicorn
+master folds the files of exited workers into metrics-archive.json
+(archive_process) and clears the directory at startup (clear_directory).
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from flask import before_render_template, has_request_context, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FAMILIES = {
+    'http_requests_total': ('counter', 'Requests handled'),
+    'http_request_duration_seconds': ('histogram', 'Time from receiving a request to sending its last byte'),
+    'http_response_bytes_total': ('counter', 'Response body bytes sent'),
+    'db_queries_total': ('counter', 'SQL statements executed while handling requests'),
+    'db_query_seconds_total': ('counter', 'Time spent in SQL statements while handling requests'),
+    'template_renders_total': ('counter', 'Templates rendered'),
+    'template_render_seconds_total': ('counter', 'Time spent rendering templates'),
+}
+ENVIRON_KEY = 'metrics.request'
+ARCHIVE_FILE = 'metrics-archive.json'
+MAX_RECORDED_QUERIES = 500
+SLOW_QUERIES_LOGGED = 5
+
+logger = logging.getLogger(__name__)
+
+
+class RequestStats:
+    """Queries and template renders of one request"""
+
+    def __init__(self, capture_parameters=False):
+        self.started = time.perf_counter()
+        self.endpoint = None
+        self.capture_parameters = capture_parameters
+        self.query_count = 0
+        self.query_time = 0.0
+        # (statement, seconds, parameters or None), the first MAX_RECORDED_QUERIES
+        self.queries = []
+        self.templates = []  # (name, seconds)
+        self._template_started = []
+
+    def add_query(self, statement, parameters, seconds):
+        self.query_count += 1
+        self.query_time += seconds
+        if len(self.queries) < MAX_RECORDED_QUERIES:
+            self.queries.append((statement, seconds, parameters if self.capture_parameters else None))
+
+
+def current_stats():
+    """RequestStats of the request being handled in this context, or None"""
+    if has_request_context():
+        return request.environ.get(ENVIRON_KEY)
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('metrics_query_started')
+    if not started:
+        return
+    seconds = time.perf_counter() - started.pop()
+    stats = current_stats()
+    if stats is not None:
+        stats.add_query(statement, parameters, seconds)
+
+
+def _template_started(app, template, context, **extra):
+    stats = current_stats()
+    if stats is not None:
+        stats._template_started.append(time.perf_counter())
+
+
+def _template_finished(app, template, context, **extra):
+    stats = current_stats()
+    if stats is not None and stats._template_started:
+        stats.templates.append((template.name, time.perf_counter() - stats._template_started.pop()))
+
+
+def _labels(**labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _sort_key(sample):
+    """Group a family's samples by labels, with histogram buckets in le order"""
+    name, labels, _ = sample
+    le = dict(labels).get('le')
+    return tuple(item for item in labels if item[0] != 'le'), name, float(le) if le else 0
+
+
+def _read_samples(path):
+    try:
+        with open(path) as f:
+            return [(name, tuple(map(tuple, labels)), value) for name, labels, value in json.load(f)]
+    except (OSError, ValueError):
+        return []  # a worker replaced it mid-read or it is being archived
+
+
+def _write_samples(path, samples):
+    """Write [(name, labels, value)] atomically so readers never see half a file"""
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump([[name, labels, value] for name, labels, value in samples], f)
+    os.replace(tmp_path, path)
+
+
+def _add_up(sample_lists):
+    totals = {}
+    for samples in sample_lists:
+        for name, labels, value in samples:
+            totals[(name, labels)] = totals.get((name, labels), 0) + value
+    return totals
+
+
+class MetricsRegistry:
+    """This process's samples, and the view across all worker processes"""
+
+    def __init__(self, directory, flush_interval=1.0):
+        self.directory = os.path.abspath(directory)  # flushed at exit, maybe from another cwd
+        self.flush_interval = flush_interval
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+        os.makedirs(directory, exist_ok=True)
+        atexit.register(self.flush)
+
+    def inc(self, name, labels, value=1):
+        with self._lock:
+            self._samples[(name, labels)] = self._samples.get((name, labels), 0) + value
+
+    def observe(self, name, labels, value, buckets=DURATION_BUCKETS):
+        with self._lock:
+            for bound in buckets:
+                if value <= bound:
+                    key = (f'{name}_bucket', labels + (('le', repr(bound)),))
+                    self._samples[key] = self._samples.get(key, 0) + 1
+            key = (f'{name}_bucket', labels + (('le', '+Inf'),))
+            self._samples[key] = self._samples.get(key, 0) + 1
+            self._samples[(f'{name}_sum', labels)] = self._samples.get((f'{name}_sum', labels), 0) + value
+            self._samples[(f'{name}_count', labels)] = self._samples.get((f'{name}_count', labels), 0) + 1
+
+    def samples(self):
+        with self._lock:
+            return [(name, labels, value) for (name, labels), value in self._samples.items()]
+
+    def _path(self):
+        return os.path.join(self.directory, f'metrics-{os.getpid()}.json')
+
+    def flush(self):
+        samples = self.samples()
+        if samples:  # scripts importing the app have nothing to share
+            _write_samples(self._path(), samples)
+        self._last_flush = time.monotonic()
+
+    def maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def render(self):
+        """Prometheus text exposition of every worker's samples added up"""
+        own = self._path()
+        files = [path for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')) if path != own]
+        totals = _add_up([_read_samples(path) for path in files] + [self.samples()])
+
+        lines = []
+        for family, (kind, help_text) in FAMILIES.items():
+            family_samples = sorted(((name, labels, value) for (name, labels), value in totals.items()
+                                     if re.sub(r'_(bucket|sum|count)$', '', name) == family
+                                     and (kind == 'histogram' or name == family)), key=_sort_key)
+            if not family_samples:
+                continue
+            lines.append(f'# HELP {family} {help_text}')
+            lines.append(f'# TYPE {family} {kind}')
+            for name, labels, value in family_samples:
+                label_text = ','.join(f'{key}="{_escape(val)}"' for key, val in labels)
+                lines.append(f'{name}{{{label_text}}} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def clear_directory(directory):
+    """Remove the samples of a previous server run (gunicorn on_starting)"""
+    for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+        os.remove(path)
+
+
+def archive_process(directory, pid):
+    """Fold an exited worker's samples into the archive file (gunicorn child_exit)"""
+    path = os.path.join(directory, f'metrics-{pid}.json')
+    if not os.path.exists(path):
+        return
+    archive = os.path.join(directory, ARCHIVE_FILE)
+    totals = _add_up([_read_samples(archive), _read_samples(path)])
+    _write_samples(archive, [(name, labels, value) for (name, labels), value in totals.items()])
+    os.remove(path)
+
+
+class MetricsMiddleware:
+    """WSGI middleware recording request, SQL and template metrics into a registry"""
+
+    def __init__(self, app, registry, slow_request=None, capture_parameters=False):
+        self.wsgi_app = app.wsgi_app
+        self.registry = registry  # None: only RequestStats are wanted (QUERY_DEBUG)
+        self.slow_request = slow_request
+        self.capture_parameters = capture_parameters
+
+        @app.before_request
+        def _note_endpoint():
+            stats = current_stats()
+            if stats is not None:
+                stats.endpoint = request.endpoint
+
+        before_render_template.connect(_template_started, app)
+        template_rendered.connect(_template_finished, app)
+
+    def __call__(self, environ, start_response):
+        stats = environ[ENVIRON_KEY] = RequestStats(self.capture_parameters)
+        response = {}
+
+        def capture(status, headers, exc_info=None):
+            response['status'] = status.split(' ', 1)[0]
+            response['length'] = next((int(value) for key, value in headers
+                                       if key.lower() == 'content-length'), None)
+            return start_response(status, headers, exc_info)
+
+        body = self.wsgi_app(environ, capture)
+
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            # Left unwrapped so the server can still use sendfile
+            self.record(stats, environ, response, response.get('length') or 0)
+            return body
+        return _CountingBody(body, lambda sent: self.record(stats, environ, response, sent))
+
+    def record(self, stats, environ, response, sent):
+        duration = time.perf_counter() - stats.started
+        endpoint = stats.endpoint or 'none'
+        if self.registry is not None:
+            self.record_metrics(stats, environ, response, sent, duration, endpoint)
+
+        if self.slow_request is not None and duration >= self.slow_request:
+            slowest = sorted(stats.queries, key=lambda query: query[1], reverse=True)[:SLOW_QUERIES_LOGGED]
+            details = ''.join(f'\n  {seconds * 1000:.1f} ms  {" ".join(statement.split())[:300]}'
+                              for statement, seconds, _ in slowest)
+            logger.warning(f'Slow request: {environ.get("REQUEST_METHOD")} {environ.get("PATH_INFO")} '
+                           f'({endpoint}) took {duration * 1000:.0f} ms, {stats.query_count} queries in '
+                           f'{stats.query_time * 1000:.0f} ms, '
+                           f'{sum(seconds for _, seconds in stats.templates) * 1000:.0f} ms rendering'
+                           f'{details}')
+
+    def record_metrics(self, stats, environ, response, sent, duration, endpoint):
+        by_endpoint = _labels(endpoint=endpoint)
+        registry = self.registry
+
+        registry.inc('http_requests_total', _labels(endpoint=endpoint, method=environ.get('REQUEST_METHOD', ''),
+                                                    status=response.get('status', '')))
+        registry.observe('http_request_duration_seconds', by_endpoint, duration)
+        registry.inc('http_response_bytes_total', by_endpoint, sent)
+        registry.inc('db_queries_total', by_endpoint, stats.query_count)
+        registry.inc('db_query_seconds_total', by_endpoint, stats.query_time)
+        for name, seconds in stats.templates:
+            registry.inc('template_renders_total', _labels(template=name))
+            registry.inc('template_render_seconds_total', _labels(template=name), seconds)
+        registry.maybe_flush()
+
+
+class _CountingBody:
+    """Response iterable that counts bytes and calls on_close(sent) once sent"""
+
+    def __init__(self, body, on_close):
+        self.body = body
+        self.on_close = on_close
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.on_close(self.sent)
@@ -0,0 +1,32 @@
+# Migration: add client_id to SmokingLog and the unique (user_id, client_id)
+# index that makes offline batch sync idempotent. Existing rows keep a NULL
+# client_id, which the unique index allows any number of times.
+from app import app
+from models import db, SmokingLog
+from sqlalchemy import inspect, text
+
+TABLE_NAME = 'smoking_log'
+
+with app.app_context():
+    inspector = inspect(db.engine)
+
+    if not inspector.has_table(TABLE_NAME):
+        print(f"Table {TABLE_NAME} not found. Creating all tables...")
+        db.create_all()
+        print("Created tables with client_id column.")
+        raise SystemExit(0)
+
+    cols = [col['name'] for col in inspector.get_columns(TABLE_NAME)]
+    with db.engine.begin() as conn:
+        if 'client_id' in cols:
+            print("Column client_id already exists")
+        else:
+            column_type = SmokingLog.__table__.c.client_id.type.compile(dialect=db.engine.dialect)
+            conn.execute(text(f"ALTER TABLE {TABLE_NAME} ADD COLUMN client_id {column_type}"))
+            print("Added column client_id to smoking_log")
+
+    for index in SmokingLog.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    print("Ensured index uq_smoking_log_user_client exists")
+
+    print("\nMigration complete!")
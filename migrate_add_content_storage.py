@@ -0,0 +1,71 @@
+# Migration: add content_hash/size/content_type to MedicalReport and move
+# existing uploads into content-addressed storage. Files are copied; the
+# originals in UPLOAD_FOLDER are only removed with --delete-originals.
+#
+# Usage: python migrate_add_content_storage.py [--delete-originals]
+import os
+import sys
+import mimetypes
+from app import app, storage
+from models import db, MedicalReport
+from sqlalchemy import inspect, text
+
+TABLE_NAME = 'medical_report'
+NEW_COLUMNS = ('content_hash', 'size', 'content_type')
+DELETE_ORIGINALS = '--delete-originals' in sys.argv[1:]
+
+with app.app_context():
+    inspector = inspect(db.engine)
+
+    if not inspector.has_table(TABLE_NAME):
+        print(f"Table {TABLE_NAME} not found. Creating all tables...")
+        db.create_all()
+        print("Created tables with content storage columns; nothing to move.")
+        raise SystemExit(0)
+
+    # Add any missing columns
+    cols = [col['name'] for col in inspector.get_columns(TABLE_NAME)]
+    with db.engine.begin() as conn:
+        for name in NEW_COLUMNS:
+            if name in cols:
+                print(f"Column {name} already exists")
+                continue
+            column_type = MedicalReport.__table__.c[name].type.compile(dialect=db.engine.dialect)
+            conn.execute(text(f"ALTER TABLE {TABLE_NAME} ADD COLUMN {name} {column_type}"))
+            print(f"Added column {name} to {TABLE_NAME}")
+
+    for index in MedicalReport.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+    # Move legacy files, one report per commit so a failure loses nothing.
+    # Only the columns this migration knows about are read and written:
+    # later migrations (preview_ready) may not have run yet.
+    table = MedicalReport.__table__
+    upload_root = os.path.abspath(app.config['UPLOAD_FOLDER'])
+    moved = 0
+    missing = 0
+    with db.engine.connect() as conn:
+        reports = conn.execute(db.select(table.c.id, table.c.filename)
+                               .where(table.c.content_hash.is_(None)).order_by(table.c.id)).all()
+    for report_id, filename in reports:
+        filepath = os.path.join(upload_root, filename)
+        if not os.path.isfile(filepath):
+            missing += 1
+            print(f"  missing file for report {report_id}: {filename}")
+            continue
+
+        with open(filepath, 'rb') as f:
+            content_hash, size = storage.save(f)
+        with db.engine.begin() as conn:
+            conn.execute(table.update().where(table.c.id == report_id)
+                         .values(content_hash=content_hash, size=size,
+                                 content_type=mimetypes.guess_type(filename)[0]))
+        moved += 1
+
+        if DELETE_ORIGINALS:
+            os.remove(filepath)
+
+    if missing:
+        print(f"{missing} reports have no file; they were left unchanged.")
+
+    print(f"\nMigration complete! Moved {moved} reports into content-addressed storage.")
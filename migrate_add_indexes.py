@@ -0,0 +1,25 @@
+# Migration: create any index declared on the models that the database is missing.
+# db.create_all() only creates indexes together with new tables, so existing
+# databases need this after upgrading. Safe to run repeatedly.
+#
+# Indexes on columns that a later migration adds (username_lower, client_id)
+# are skipped here; that migration creates them.
+from app import app
+from models import db
+from sqlalchemy import inspect
+
+with app.app_context():
+    db.create_all()
+    inspector = inspect(db.engine)
+
+    for table in db.metadata.sorted_tables:
+        existing = {col['name'] for col in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            missing = [col.name for col in index.columns if col.name not in existing]
+            if missing:
+                print(f"Skipped index {index.name} on {table.name}: no column {', '.join(missing)} yet")
+                continue
+            index.create(db.engine, checkfirst=True)
+            print(f"Ensured index {index.name} on {table.name}")
+
+    print("\nMigration complete!")
@@ -0,0 +1,75 @@
+# Migration: add typed logged_at column to SmokingLog, backfill it in batches
+# and create the (user_id, logged_at) index used by dashboard range queries.
+#
+# Usage: python migrate_add_logged_at.py [batch_size]
+import sys
+from app import app
+from models import db, SmokingLog
+from sqlalchemy import inspect, text
+
+TABLE_NAME = 'smoking_log'
+BATCH_SIZE = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+with app.app_context():
+    inspector = inspect(db.engine)
+
+    if not inspector.has_table(TABLE_NAME):
+        print(f"Table {TABLE_NAME} not found. Creating all tables...")
+        db.create_all()
+        print("Created tables with logged_at column; nothing to backfill.")
+        raise SystemExit(0)
+
+    # Add the column if it is missing
+    cols = [col['name'] for col in inspector.get_columns(TABLE_NAME)]
+    with db.engine.begin() as conn:
+        if 'logged_at' in cols:
+            print("Column logged_at already exists; backfilling any empty rows.")
+        else:
+            column_type = SmokingLog.__table__.c.logged_at.type.compile(dialect=db.engine.dialect)
+            conn.execute(text(f"ALTER TABLE {TABLE_NAME} ADD COLUMN logged_at {column_type}"))
+            print("Added column logged_at to smoking_log")
+
+    # Backfill in id-ordered chunks so memory and lock time stay bounded
+    last_id = 0
+    converted = 0
+    skipped = 0
+    while True:
+        with db.engine.begin() as conn:
+            rows = conn.execute(
+                text(f"SELECT id, date, time FROM {TABLE_NAME} "
+                     "WHERE logged_at IS NULL AND id > :last_id ORDER BY id LIMIT :limit"),
+                {"last_id": last_id, "limit": BATCH_SIZE}
+            ).fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for row_id, date, time in rows:
+                logged_at = SmokingLog.parse_logged_at(date, time)
+                if logged_at is None:
+                    skipped += 1
+                else:
+                    updates.append({"id": row_id, "logged_at": logged_at})
+
+            if updates:
+                conn.execute(
+                    SmokingLog.__table__.update()
+                    .where(SmokingLog.__table__.c.id == db.bindparam('row_id'))
+                    .values(logged_at=db.bindparam('new_logged_at')),
+                    [{"row_id": u["id"], "new_logged_at": u["logged_at"]} for u in updates]
+                )
+            converted += len(updates)
+            last_id = rows[-1][0]
+        print(f"  ...converted {converted} rows (up to id {last_id})")
+
+    if skipped:
+        print(f"Skipped {skipped} rows with unparseable date/time; they keep logged_at NULL.")
+
+    # Create the composite index; the other SmokingLog indexes belong to
+    # their own migrations (uq_smoking_log_user_client needs client_id)
+    for index in SmokingLog.__table__.indexes:
+        if index.name == 'ix_smoking_log_user_logged_at':
+            index.create(db.engine, checkfirst=True)
+    print("Ensured index ix_smoking_log_user_logged_at exists")
+
+    print(f"\nMigration complete! Converted {converted} rows.")
@@ -0,0 +1,31 @@
+# Migration: add preview_ready to MedicalReport, create the preview_job table
+# and queue preview generation for every report already in content storage.
+# Run after migrate_add_content_storage.py, then process the queue with
+# python preview_worker.py --once
+from app import app
+from models import db, MedicalReport
+from sqlalchemy import inspect, text
+import previews
+
+TABLE_NAME = 'medical_report'
+
+with app.app_context():
+    inspector = inspect(db.engine)
+    db.create_all()
+
+    cols = [col['name'] for col in inspector.get_columns(TABLE_NAME)]
+    if 'preview_ready' in cols:
+        print("Column preview_ready already exists")
+    else:
+        with db.engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {TABLE_NAME} ADD COLUMN preview_ready BOOLEAN NOT NULL DEFAULT FALSE"))
+        print(f"Added column preview_ready to {TABLE_NAME}")
+
+    queued = 0
+    for report in MedicalReport.query.filter(MedicalReport.content_hash.isnot(None),
+                                             MedicalReport.preview_ready.is_(False)).all():
+        if previews.enqueue(report) is not None:
+            queued += 1
+    db.session.commit()
+
+    print(f"\nMigration complete! {queued} reports awaiting previews; run python preview_worker.py --once to process them.")
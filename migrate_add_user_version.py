@@ -0,0 +1,41 @@
+# Migration: add the version token to user. Sessions now carry the token
+# the user's row had at login, so everyone has to log in once more after this.
+from app import app, identity_cache
+from models import db, User, new_version
+from sqlalchemy import inspect, text
+
+TABLE_NAME = 'user'
+
+with app.app_context():
+    inspector = inspect(db.engine)
+
+    if not inspector.has_table(TABLE_NAME):
+        print(f"Table {TABLE_NAME} not found. Creating all tables...")
+        db.create_all()
+        print("Created tables with version column.")
+        raise SystemExit(0)
+
+    table = User.__table__
+    cols = [col['name'] for col in inspector.get_columns(TABLE_NAME)]
+    with db.engine.begin() as conn:
+        if 'version' in cols:
+            print("Column version already exists")
+        else:
+            column_type = table.c.version.type.compile(dialect=db.engine.dialect)
+            conn.execute(text(f'ALTER TABLE "{TABLE_NAME}" ADD COLUMN version {column_type}'))
+            print("Added column version to user")
+
+        ids = [row_id for (row_id,) in conn.execute(db.select(table.c.id).where(table.c.version.is_(None)))]
+        if ids:
+            conn.execute(
+                table.update()
+                .where(table.c.id == db.bindparam('row_id'))
+                .values(version=db.bindparam('new_version')),
+                [{"row_id": row_id, "new_version": new_version()} for row_id in ids]
+            )
+        print(f"Set version for {len(ids)} users")
+
+    identity_cache.clear()
+    print("Cleared cached identities")
+
+    print("\nMigration complete!")
@@ -0,0 +1,86 @@
+# Migration: add the lowercased username_lower column to user, lowercase
+# stored emails, and create the unique index login looks usernames up by.
+#
+# Usernames become unique regardless of case, so accounts whose usernames (or
+# emails) differ only in case are listed and the index is not created until
+# an admin renames one of each pair; then run this again.
+import sys
+from app import app
+from models import db, User
+from sqlalchemy import inspect, text
+
+TABLE_NAME = 'user'
+
+with app.app_context():
+    inspector = inspect(db.engine)
+
+    if not inspector.has_table(TABLE_NAME):
+        print(f"Table {TABLE_NAME} not found. Creating all tables...")
+        db.create_all()
+        print("Created tables with username_lower column.")
+        raise SystemExit(0)
+
+    table = User.__table__
+    cols = [col['name'] for col in inspector.get_columns(TABLE_NAME)]
+    with db.engine.begin() as conn:
+        if 'username_lower' in cols:
+            print("Column username_lower already exists; refreshing its values.")
+        else:
+            column_type = table.c.username_lower.type.compile(dialect=db.engine.dialect)
+            conn.execute(text(f'ALTER TABLE "{TABLE_NAME}" ADD COLUMN username_lower {column_type}'))
+            print("Added column username_lower to user")
+
+    # Update through the table as it is in the database: the model's version
+    # column (with its onupdate) only exists after migrate_add_user_version.py
+    stored = db.Table(TABLE_NAME, db.MetaData(), autoload_with=db.engine)
+    with db.engine.connect() as conn:
+        rows = conn.execute(db.select(stored.c.id, stored.c.username, stored.c.email)).fetchall()
+
+    # Find values that would collide once lowercased
+    collisions = []
+    for column, position in (('username', 1), ('email', 2)):
+        seen = {}
+        for row in rows:
+            seen.setdefault(row[position].lower(), []).append(row)
+        for value, group in seen.items():
+            if len(group) > 1:
+                collisions.append((column, value, group))
+
+    with db.engine.begin() as conn:
+        conn.execute(
+            stored.update()
+            .where(stored.c.id == db.bindparam('row_id'))
+            .values(username_lower=db.bindparam('new_username_lower')),
+            [{"row_id": row_id, "new_username_lower": username.lower()} for row_id, username, _ in rows]
+        )
+        changed_emails = [{"row_id": row_id, "new_email": email.lower()}
+                          for row_id, _, email in rows if email != email.lower()]
+        if changed_emails and not any(column == 'email' for column, _, _ in collisions):
+            conn.execute(
+                stored.update()
+                .where(stored.c.id == db.bindparam('row_id'))
+                .values(email=db.bindparam('new_email')),
+                changed_emails
+            )
+            print(f"Lowercased {len(changed_emails)} emails")
+    print(f"Filled username_lower for {len(rows)} users")
+
+    with_at = [row for row in rows if '@' in row[1]]
+    if with_at:
+        print("\nThese usernames contain @ and can only log in with their email:")
+        for row_id, username, email in with_at:
+            print(f"  user {row_id}: {username} ({email})")
+
+    if collisions:
+        print("\nThese accounts differ only in case. Rename or merge one of each group")
+        print("(Admin Dashboard > user > Update), then run this migration again:")
+        for column, value, group in collisions:
+            users = ', '.join(f"user {row_id} ({username})" for row_id, username, _ in group)
+            print(f"  {column} '{value}': {users}")
+        sys.exit(1)
+
+    for index in table.indexes:
+        index.create(db.engine, checkfirst=True)
+    print("Ensured unique index ix_user_username_lower exists")
+
+    print("\nMigration complete!")
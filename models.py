@@ -1,18 +1,38 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime
+import secrets
 
 db = SQLAlchemy()
 
 
+def new_version():
+    return secrets.token_hex(8)
+
+
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
-    email = db.Column(db.String(120), unique=True, nullable=False)
+    # Lowercased username, set whenever username is; login looks it up, and its
+    # unique index keeps usernames unique regardless of case
+    username_lower = db.Column(db.String(80), unique=True, index=True)
+    email = db.Column(db.String(120), unique=True, nullable=False)  # stored lowercase
     name = db.Column(db.String(120), nullable=False)
-    role = db.Column(db.String(20), nullable=False)  # 'patient', 'doctor', or 'admin'
+    role = db.Column(db.String(20), nullable=False, index=True)  # 'patient', 'doctor', or 'admin'
     password_hash = db.Column(db.String(255), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    # Random token replaced on every write to the row. Sessions store it with
+    # the user id (get_id), so they and the identities cached for them end
+    # when the row changes, is deleted, or comes from a different database.
+    version = db.Column(db.String(32), nullable=False, default=new_version, onupdate=new_version)
+    
+    def get_id(self):
+        return f'{self.id}:{self.version}'
+    
+    @db.validates('username')
+    def _normalize_username(self, key, username):
+        self.username_lower = username.lower() if username is not None else None
+        return username
     
     def __repr__(self):
         return f'<User {self.username}>'
@@ -20,19 +40,32 @@ class User(db.Model, UserMixin):
 
 class MedicalReport(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     report_name = db.Column(db.String(200), nullable=False)
     filename = db.Column(db.String(255), nullable=False)
+    # SHA-256 of the stored blob; NULL for uploads made before content-addressed storage
+    content_hash = db.Column(db.String(64), index=True)
+    size = db.Column(db.Integer)
+    content_type = db.Column(db.String(100))
+    preview_ready = db.Column(db.Boolean, nullable=False, default=False)  # thumbnail/preview images exist
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     user = db.relationship('User', backref=db.backref('medical_reports', lazy=True))
 
 
 class SmokingLog(db.Model):
+    __table_args__ = (
+        db.Index('ix_smoking_log_user_logged_at', 'user_id', 'logged_at'),
+        db.Index('ix_smoking_log_user_date_time', 'user_id', 'date', 'time', 'id'),
+        db.Index('uq_smoking_log_user_client', 'user_id', 'client_id', unique=True),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     date = db.Column(db.String(20), nullable=False)
     time = db.Column(db.String(20), nullable=False)
+    logged_at = db.Column(db.DateTime)  # date + time combined, used for range queries
+    client_id = db.Column(db.String(64))  # id chosen by an offline client, makes batch sync retries idempotent
     location = db.Column(db.String(200))
     trigger = db.Column(db.String(200))
     emotion = db.Column(db.String(200))
@@ -44,4 +77,65 @@ class SmokingLog(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     user = db.relationship('User', backref=db.backref('smoking_logs', lazy=True))
+    
+    @staticmethod
+    def parse_logged_at(date, time):
+        """Combine the form's date and time strings, or None if they don't parse"""
+        for fmt in ('%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S'):
+            try:
+                return datetime.strptime(f'{date} {time}', fmt)
+            except (TypeError, ValueError):
+                continue
+        return None
+
+
+
+class SmokingDailyRollup(db.Model):
+    """Smoked/resisted counts per user, day and hour, maintained on write"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    hour = db.Column(db.Integer, primary_key=True)  # 0-23
+    smoked_count = db.Column(db.Integer, nullable=False, default=0)
+    resisted_count = db.Column(db.Integer, nullable=False, default=0)
+    urge_sum = db.Column(db.Integer, nullable=False, default=0)
+
 
+class SmokingLogSuggestion(db.Model):
+    """Autocomplete values per user and SmokingLog field, maintained on insert"""
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'field', 'value', name='uq_suggestion_user_field_value'),
+        db.Index('ix_suggestion_user_field_prefix', 'user_id', 'field', 'value_lower'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    field = db.Column(db.String(20), nullable=False)  # 'location', 'trigger', 'emotion' or 'who_with'
+    value = db.Column(db.String(200), nullable=False)
+    value_lower = db.Column(db.String(200), nullable=False)  # used for prefix lookups
+    count = db.Column(db.Integer, nullable=False, default=0)
+    last_used = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class UploadSession(db.Model):
+    """A resumable report upload that has not been finalized yet"""
+    id = db.Column(db.String(32), primary_key=True)  # random token used in the upload URLs
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    report_name = db.Column(db.String(200), nullable=False)
+    original_filename = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.Integer, nullable=False)  # declared total size in bytes
+    received = db.Column(db.Integer, nullable=False, default=0)  # bytes written so far
+    checksum = db.Column(db.String(64))  # expected SHA-256, if given when the upload started
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+class PreviewJob(db.Model):
+    """Thumbnail/preview generation for one stored blob, run in the background"""
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(64), unique=True, nullable=False)
+    content_type = db.Column(db.String(100), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True)  # pending, running, done or failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -0,0 +1,138 @@
+"""
+Password hashing and login throttling
+
+Password hashes are deliberately expensive. PasswordHasher runs them in a
+small process pool owned by each web worker, so a burst of logins uses at
+most `workers` extra cores per worker and never holds the worker's GIL. At
+most max_pending hashes may wait for the pool; past that, hash() and verify()
+raise HasherBusy at once instead of queueing requests behind each other.
+Under the gevent worker profile the hashes go to gevent's thread pool
+instead (see blocking.py), since waiting on a process pool would stall the
+event loop.
+
+Pool processes start from hashworker.py rather than the program's
+__main__, so callers need no `if __name__ == '__main__':` guard. Where
+hashworker has no fork server (Windows), hashes run on run_blocking's
+threads instead.
+
+The method is a werkzeug method string such as 'scrypt:32768:8:1' or
+'pbkdf2:sha256:600000'. needs_rehash() spots hashes made with other
+parameters so login can replace them while it has the plain password.
+
+LoginThrottle counts login attempts per key (account, client IP) in a SQLite
+file shared by every worker on the host, so bursts are turned away before
+any hash is computed.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import check_password_hash, generate_password_hash
+from blocking import gevent_active, run_blocking
+from cache import SQLiteConnections
+import hashworker
+
+
+class HasherBusy(Exception):
+    """Too many password hashes are already waiting in this worker"""
+
+
+class PasswordHasher:
+    """Bounded, offloaded password hashing with a configurable method"""
+
+    def __init__(self, method, workers=1, max_pending=8):
+        self.method = method
+        self.workers = workers
+        # Hashing an empty password once validates the method and gives the
+        # exact prefix werkzeug writes for it
+        self.prefix = generate_password_hash('', method).split('$', 1)[0]
+        self._slots = threading.BoundedSemaphore(max(workers, 1) + max_pending)
+        self._lock = threading.Lock()
+        self._context = hashworker.get_context() if workers else None
+        self._executor = None
+        self._pid = None
+
+    def _pool(self):
+        """The process pool, started on first use in each worker process"""
+        if self._executor is None or self._pid != os.getpid():
+            # Not fork: forking a threaded worker could copy held locks
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=self._context)
+            self._pid = os.getpid()
+        return self._executor
+
+    def _submit(self, fn, *args):
+        with self._lock:
+            return self._pool().submit(fn, *args)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            if self._context is None or gevent_active():
+                return run_blocking(fn, *args)
+            try:
+                return self._submit(fn, *args).result()
+            except BrokenProcessPool:
+                with self._lock:
+                    self._executor = None  # a child died; start a fresh pool next time
+                raise
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True if password_hash was made with another method or cost"""
+        return password_hash.split('$', 1)[0] != self.prefix
+
+
+class LoginThrottle:
+    """Fixed-window attempt counters in a SQLite file shared by all workers
+
+    attempt() counts an attempt and returns 0 if it is allowed, or the
+    seconds until the key's window ends once it is over its limit.
+    """
+
+    PURGE_EVERY = 200
+
+    def __init__(self, path, window=900):
+        self.path = path
+        self.window = window
+        self._connect = SQLiteConnections(path)
+        self._hits = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connect().execute("CREATE TABLE IF NOT EXISTS login_attempt ("
+                                "key TEXT PRIMARY KEY, count INTEGER NOT NULL, "
+                                "window_start REAL NOT NULL)")
+
+    def attempt(self, key, limit):
+        now = time.time()
+        expired = now - self.window
+        count, window_start = self._connect().execute(
+            "INSERT INTO login_attempt (key, count, window_start) VALUES (?, 1, ?) "
+            "ON CONFLICT(key) DO UPDATE SET "
+            "count = CASE WHEN window_start <= ? THEN 1 ELSE count + 1 END, "
+            "window_start = CASE WHEN window_start <= ? THEN excluded.window_start ELSE window_start END "
+            "RETURNING count, window_start",
+            (key, now, expired, expired)
+        ).fetchone()
+
+        self._hits += 1
+        if self._hits % self.PURGE_EVERY == 0:
+            self._connect().execute("DELETE FROM login_attempt WHERE window_start <= ?", (expired,))
+
+        if count > limit:
+            return max(1, int(window_start + self.window - now))
+        return 0
+
+    def release(self, key):
+        """Take back one attempt, e.g. one that turned out to be a successful login"""
+        self._connect().execute("UPDATE login_attempt SET count = count - 1 WHERE key = ? AND count > 0", (key,))
+
+    def reset(self, key):
+        self._connect().execute("DELETE FROM login_attempt WHERE key = ?", (key,))
@@ -0,0 +1,157 @@
+"""
+Association patterns between a patient's circumstances and smoking
+
+Every log is turned into a transaction of integer item ids, one per
+trigger, emotion, location, who_with and time of day (3-hour blocks), so the
+mining works on small sorted int tuples instead of strings. Each item
+combination of up to MAX_ITEMSET_SIZE items is packed into one integer key
+and counted together with how many of its logs were smoked. Transactions
+hold at most five items, so enumerating their subsets directly finds every
+frequent itemset without Apriori's candidate passes.
+
+From those counts association_rules() reports, for each combination seen at
+least min_support times, the chance of smoking and its lift (that chance
+divided by the patient's overall smoking rate).
+
+Counts only ever grow, so the per-patient memo is updated by counting the
+logs above its watermark (highest log id seen) rather than recounting.
+Callers recount from scratch once the memo's built_at is older than
+PATTERN_REBUILD_AFTER, which picks up logs whose ids committed out of order.
+"""
+import copy
+import time
+from itertools import combinations
+from models import db, SmokingLog
+
+PATTERN_FIELDS = ('trigger', 'emotion', 'location', 'who_with')
+ITEM_FIELDS = PATTERN_FIELDS + ('hour',)
+HOUR_BLOCK = 3
+MAX_ITEMSET_SIZE = 3
+ID_BITS = 20
+ID_MASK = (1 << ID_BITS) - 1
+BATCH_SIZE = 1000
+
+
+def pack(item_ids):
+    """One integer key for a sorted tuple of item ids"""
+    key = 0
+    for item_id in item_ids:
+        key = (key << ID_BITS) | (item_id + 1)
+    return key
+
+
+def unpack(key):
+    item_ids = []
+    while key:
+        item_ids.append((key & ID_MASK) - 1)
+        key >>= ID_BITS
+    return item_ids[::-1]
+
+
+def hour_label(hour):
+    start = hour - hour % HOUR_BLOCK
+    return f'{start:02d}:00-{start + HOUR_BLOCK:02d}:00'
+
+
+def new_memo():
+    """Empty per-patient memo; JSON-serialisable so it can live in a TieredCache
+
+    items lists [field, normalised value, label] by item id, and counts maps
+    str(packed itemset) to [logs, smoked].
+    """
+    return {'watermark': 0, 'built_at': time.time(), 'total': 0, 'smoked': 0, 'items': [], 'counts': {}}
+
+
+def count_logs(memo, rows):
+    """Add (id, logged_at, smoke_or_resist, *PATTERN_FIELDS) rows to memo in place"""
+    index = {(field, key): item_id for item_id, (field, key, _) in enumerate(memo['items'])}
+    counts = memo['counts']
+
+    def item_id(field, key, label):
+        found = index.get((field, key))
+        if found is None:
+            found = index[(field, key)] = len(memo['items'])
+            memo['items'].append([field, key, label])
+        return found
+
+    for log_id, logged_at, action, *values in rows:
+        items = []
+        for field, value in zip(PATTERN_FIELDS, values):
+            if value and value.strip():
+                items.append(item_id(field, value.strip().lower(), value.strip()))
+        if logged_at is not None:
+            label = hour_label(logged_at.hour)
+            items.append(item_id('hour', label, label))
+        items.sort()
+
+        smoked = 1 if action == 'Smoked' else 0
+        memo['total'] += 1
+        memo['smoked'] += smoked
+        memo['watermark'] = max(memo['watermark'], log_id)
+        for size in range(1, min(len(items), MAX_ITEMSET_SIZE) + 1):
+            for itemset in combinations(items, size):
+                entry = counts.setdefault(str(pack(itemset)), [0, 0])
+                entry[0] += 1
+                entry[1] += smoked
+
+
+def update_patterns(patient_id, memo=None):
+    """A memo covering all of a patient's logs, or None if memo is already current
+
+    memo is never modified, since other threads may be reading it from the
+    in-process cache. Without one, every log is counted.
+    """
+    query = db.select(SmokingLog.id, SmokingLog.logged_at, SmokingLog.smoke_or_resist,
+                      *[getattr(SmokingLog, field) for field in PATTERN_FIELDS])\
+        .where(SmokingLog.user_id == patient_id)
+    if memo is not None:
+        latest = db.session.query(db.func.max(SmokingLog.id))\
+            .filter(SmokingLog.user_id == patient_id).scalar()
+        if latest is None or latest <= memo['watermark']:
+            return None
+        memo = copy.deepcopy(memo)
+        query = query.where(SmokingLog.id > memo['watermark'])
+    else:
+        memo = new_memo()
+
+    result = db.session.execute(query.order_by(SmokingLog.id).execution_options(yield_per=BATCH_SIZE))
+    for batch in result.partitions():
+        count_logs(memo, batch)
+    return memo
+
+
+def association_rules(memo, min_support=3, limit=10):
+    """Item combinations most and least associated with smoking
+
+    Returns {'logs', 'smoke_rate', 'risky', 'protective'}; each rule lists its
+    items as [field, label] pairs with its support (logs), smoke probability
+    and lift. Risky rules have lift above 1, protective ones below.
+    """
+    total = memo['total']
+    base_rate = memo['smoked'] / total if total else 0
+    items = memo['items']
+
+    rules = []
+    for key, (count, smoked) in memo['counts'].items():
+        if count < min_support or not base_rate:
+            continue  # lift is undefined for a patient who never smoked
+        probability = smoked / count
+        lift = probability / base_rate
+        rules.append({
+            'items': sorted(([items[item_id][0], items[item_id][2]] for item_id in unpack(int(key))),
+                            key=lambda item: ITEM_FIELDS.index(item[0])),
+            'support': count,
+            'smoke_probability': probability,
+            'lift': lift,
+        })
+
+    risky = sorted((rule for rule in rules if rule['lift'] > 1),
+                   key=lambda rule: (-rule['lift'], -rule['support'], len(rule['items'])))
+    protective = sorted((rule for rule in rules if rule['lift'] < 1),
+                        key=lambda rule: (rule['lift'], -rule['support'], len(rule['items'])))
+    return {
+        'logs': total,
+        'smoke_rate': base_rate,
+        'risky': risky[:limit],
+        'protective': protective[:limit],
+    }
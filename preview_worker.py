@@ -0,0 +1,39 @@
+# Background worker for report thumbnails/previews.
+# The web process runs new jobs on its own threads (PREVIEW_WORKERS); run this
+# to work through a backlog, retry failed jobs, or do all the work when
+# PREVIEW_WORKERS=0.
+#
+# Usage: python preview_worker.py [--once] [--retry-failed]
+#   --once          exit when the queue is empty instead of polling
+#   --retry-failed  put failed jobs back in the queue first
+import sys
+import time
+from app import app, storage
+from models import db, PreviewJob
+import previews
+
+ONCE = '--once' in sys.argv[1:]
+RETRY_FAILED = '--retry-failed' in sys.argv[1:]
+
+with app.app_context():
+    if RETRY_FAILED:
+        retried = PreviewJob.query.filter_by(status='failed').update(
+            {'status': 'pending', 'attempts': 0, 'error': None})
+        db.session.commit()
+        print(f"Requeued {retried} failed jobs")
+
+    produced = 0
+    while True:
+        job_ids = previews.runnable_job_ids(app.config['PREVIEW_STALE_AFTER'])
+        for job_id in job_ids:
+            if previews.run_job(job_id, storage, app.config):
+                produced += 1
+                print(f"  ...job {job_id} done")
+
+        if not job_ids:
+            if ONCE:
+                break
+            time.sleep(app.config['PREVIEW_POLL_INTERVAL'])
+
+    failed = PreviewJob.query.filter_by(status='failed').count()
+    print(f"\nProcessed {produced} jobs; {failed} failed (see preview_job.error).")
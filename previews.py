@@ -0,0 +1,225 @@
+"""
+Thumbnail and preview images for medical reports
+
+Storing a report enqueues a PreviewJob in the same transaction. A small
+thread pool in the web process runs the job right after the commit, and
+preview_worker.py picks up anything left over (pool disabled, crash,
+restart). Both claim a job with a conditional UPDATE, so a job never runs
+twice at once.
+
+Images are derived from the stored blob and saved beside it, keyed by the
+content hash, so duplicate uploads share them:
+
+    thumb.jpg    small image for the report lists
+    preview.jpg  larger image to look at before opening the original
+
+JPG/PNG are resized with Pillow; the first page of a PDF is rendered with
+pdftoppm (poppler-utils). Either tool may be missing, in which case those
+jobs fail with a message and can be retried later. Images over
+MAX_IMAGE_PIXELS are refused before they are decoded (a small PNG can claim
+to be enormous) and their jobs fail at once, since retrying cannot help.
+"""
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta
+from models import db, MedicalReport, PreviewJob
+from blocking import run_blocking
+from rollups import UPSERT_INSERTS
+
+PREVIEW_KINDS = ('thumb', 'preview')
+PREVIEW_CONTENT_TYPE = 'image/jpeg'
+IMAGE_TYPES = ('image/jpeg', 'image/png')
+PDF_TYPE = 'application/pdf'
+JPEG_QUALITY = 80
+MAX_IMAGE_PIXELS = 50_000_000  # well above any phone photo or scan
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+else:
+    # Pillow only warns between its limit and twice that; refuse those too
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    warnings.simplefilter('error', Image.DecompressionBombWarning)
+
+
+class PreviewRejected(Exception):
+    """The file can never be previewed, so its job fails without retrying"""
+
+
+def derived_name(kind):
+    return f'{kind}.jpg'
+
+
+def enqueue(report):
+    """Queue preview generation for a report's blob; the caller commits
+
+    Returns the job id to hand to the thread pool after the commit, or None
+    when there is nothing to do.
+    """
+    if not report.content_hash or report.content_type not in IMAGE_TYPES + (PDF_TYPE,):
+        return None
+
+    job = PreviewJob.query.filter_by(content_hash=report.content_hash).first()
+    if job is None:
+        insert = UPSERT_INSERTS.get(db.session.get_bind().dialect.name)
+        values = {'content_hash': report.content_hash, 'content_type': report.content_type,
+                  'status': 'pending', 'attempts': 0,
+                  'created_at': datetime.utcnow(), 'updated_at': datetime.utcnow()}
+        if insert is None:
+            db.session.add(PreviewJob(**values))
+        else:
+            # Two uploads of the same file may race here; one job is enough
+            db.session.execute(insert(PreviewJob.__table__).values(**values)
+                               .on_conflict_do_nothing(index_elements=['content_hash']))
+        job = PreviewJob.query.filter_by(content_hash=report.content_hash).first()
+    elif job.status == 'done':
+        # Same file uploaded before: its previews already exist
+        report.preview_ready = True
+        return None
+    return job.id
+
+
+def claim(job_id, stale_after):
+    """Mark a job running if it is pending or its worker died; True if claimed"""
+    now = datetime.utcnow()
+    result = db.session.execute(
+        db.update(PreviewJob)
+        .where(PreviewJob.id == job_id)
+        .where(db.or_(PreviewJob.status == 'pending',
+                      db.and_(PreviewJob.status == 'running',
+                              PreviewJob.updated_at < now - timedelta(seconds=stale_after))))
+        .values(status='running', attempts=PreviewJob.attempts + 1, updated_at=now)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def runnable_job_ids(stale_after, limit=100):
+    """Jobs waiting for a worker, oldest first"""
+    cutoff = datetime.utcnow() - timedelta(seconds=stale_after)
+    rows = db.session.query(PreviewJob.id).filter(db.or_(
+        PreviewJob.status == 'pending',
+        db.and_(PreviewJob.status == 'running', PreviewJob.updated_at < cutoff)
+    )).order_by(PreviewJob.id).limit(limit).all()
+    return [row.id for row in rows]
+
+
+def run_job(job_id, storage, config):
+    """Claim and run one job; returns True if previews were produced"""
+    if not claim(job_id, config['PREVIEW_STALE_AFTER']):
+        return False
+    job = db.session.get(PreviewJob, job_id)
+
+    try:
+        with local_copy(storage, job.content_hash) as path:
+            for kind in PREVIEW_KINDS:
+                data = run_blocking(render, path, job.content_type, config['PREVIEW_SIZES'][kind])
+                storage.save_derived(job.content_hash, derived_name(kind), data)
+    except Exception as e:
+        db.session.rollback()
+        retry = not isinstance(e, PreviewRejected) and job.attempts < config['PREVIEW_MAX_ATTEMPTS']
+        job.status = 'pending' if retry else 'failed'
+        job.error = str(e)[:255]
+        job.updated_at = datetime.utcnow()
+        db.session.commit()
+        return False
+
+    job.status = 'done'
+    job.error = None
+    job.updated_at = datetime.utcnow()
+    db.session.execute(
+        db.update(MedicalReport)
+        .where(MedicalReport.content_hash == job.content_hash)
+        .values(preview_ready=True)
+    )
+    db.session.commit()
+    return True
+
+
+@contextmanager
+def local_copy(storage, digest):
+    """A local file path for a blob, downloading it first for remote backends"""
+    path = storage.path(digest)
+    if path is not None:
+        yield path
+        return
+
+    fd, tmp_path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as out, closing(storage.open(digest)) as blob:
+            shutil.copyfileobj(blob, out)
+        yield tmp_path
+    finally:
+        os.remove(tmp_path)
+
+
+def render(path, content_type, size):
+    """JPEG bytes of the file scaled to fit within size x size pixels"""
+    if content_type == PDF_TYPE:
+        return render_pdf(path, size)
+    return render_image(path, size)
+
+
+def render_image(path, size):
+    if Image is None:
+        raise RuntimeError('Pillow is not installed (pip install Pillow)')
+    try:
+        image = Image.open(path)
+    except (Image.DecompressionBombError, Image.DecompressionBombWarning) as e:
+        raise PreviewRejected(str(e))
+    with image:
+        # Only the header has been read so far
+        width, height = image.size
+        if width * height > MAX_IMAGE_PIXELS:
+            raise PreviewRejected(f'Image is too large to preview ({width}x{height} pixels)')
+        # Let the JPEG decoder skip straight to roughly the target size
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        out = io.BytesIO()
+        image.convert('RGB').save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+def render_pdf(path, size):
+    pdftoppm = shutil.which('pdftoppm')
+    if pdftoppm is None:
+        raise RuntimeError('pdftoppm is not installed (poppler-utils)')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prefix = os.path.join(tmp_dir, 'page')
+        subprocess.run(
+            [pdftoppm, '-f', '1', '-l', '1', '-singlefile', '-jpeg',
+             '-jpegopt', f'quality={JPEG_QUALITY}', '-scale-to', str(size), path, prefix],
+            check=True, capture_output=True, timeout=60
+        )
+        with open(prefix + '.jpg', 'rb') as f:
+            return f.read()
+
+
+class PreviewPool:
+    """Runs preview jobs on a few background threads of the web process"""
+
+    def __init__(self, app, storage, workers):
+        self.app = app
+        self.storage = storage
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='preview') if workers else None
+
+    def submit(self, job_id):
+        if self.executor is not None and job_id is not None:
+            self.executor.submit(self._run, job_id)
+
+    def _run(self, job_id):
+        with self.app.app_context():
+            try:
+                run_job(job_id, self.storage, self.app.config)
+            except Exception:
+                self.app.logger.exception(f'Preview job {job_id} crashed')
+            finally:
+                db.session.remove()
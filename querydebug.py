@@ -0,0 +1,135 @@
+"""
+N+1 and query budget checks for development and CI
+
+With QUERY_DEBUG on, MetricsMiddleware keeps the parameters of every
+statement a request runs, and QueryDebugger checks the request's
+RequestStats when its context is torn down (after a streamed response has
+been sent). A request is reported when:
+
+    - it ran more statements than its endpoint's budget
+      (QUERY_BUDGETS[endpoint], else QUERY_BUDGET_DEFAULT);
+    - one statement ran repeat_threshold or more times with different
+      parameters, the signature of a template or loop loading a lazy
+      relationship (user.smoking_logs, user.medical_reports) row by row;
+    - a single statement took slow_statement seconds or more.
+
+Reports are logged as warnings. In tests, assert_query_budget() turns them
+into assertion failures for the requests made inside it:
+
+    with assert_query_budget():               # the configured budgets
+        client.get('/doctor/patient/2')
+    with assert_query_budget(budget=8):       # or an explicit one
+        client.get('/doctor/dashboard')
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from metrics import current_stats
+
+logger = logging.getLogger(__name__)
+_recording = threading.local()  # reports collected by assert_query_budget()
+
+
+def _statement(statement, limit=300):
+    return ' '.join(statement.split())[:limit]
+
+
+def repeated_statements(queries, threshold):
+    """[(statement, runs, distinct parameter sets)] for statements run with
+    threshold or more different parameter sets, most repeated first"""
+    runs = {}
+    for statement, _, parameters in queries:
+        entry = runs.setdefault(statement, [0, set()])
+        entry[0] += 1
+        entry[1].add(repr(parameters))
+    repeated = [(statement, count, len(distinct)) for statement, (count, distinct) in runs.items()
+                if len(distinct) >= threshold]
+    return sorted(repeated, key=lambda item: -item[1])
+
+
+class QueryReport:
+    """What QueryDebugger found in one request"""
+
+    def __init__(self, endpoint, query_count, budget, repeated, slow):
+        self.endpoint = endpoint
+        self.query_count = query_count
+        self.budget = budget
+        self.repeated = repeated
+        self.slow = slow
+
+    @property
+    def over_budget(self):
+        return self.budget is not None and self.query_count > self.budget
+
+    def problems(self):
+        problems = []
+        if self.over_budget:
+            problems.append(f'{self.query_count} queries, budget {self.budget}')
+        for statement, count, distinct in self.repeated:
+            problems.append(f'N+1: ran {count} times with {distinct} different parameters: {_statement(statement)}')
+        for statement, seconds in self.slow:
+            problems.append(f'slow statement ({seconds * 1000:.0f} ms): {_statement(statement)}')
+        return problems
+
+    def __str__(self):
+        return f'{self.endpoint}: ' + '; '.join(self.problems())
+
+
+class QueryDebugger:
+    """Checks finished requests against query budgets and for N+1 patterns"""
+
+    def __init__(self, app, budgets=None, default_budget=None, repeat_threshold=5, slow_statement=None):
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+        self.repeat_threshold = repeat_threshold
+        self.slow_statement = slow_statement
+
+        @app.teardown_request
+        def _check_request(error=None):
+            stats = current_stats()
+            if stats is not None:
+                self.check(stats)
+
+    def budget_for(self, endpoint):
+        return self.budgets.get(endpoint, self.default_budget)
+
+    def report(self, stats):
+        endpoint = stats.endpoint or 'none'
+        slow = []
+        if self.slow_statement is not None:
+            slow = [(statement, seconds) for statement, seconds, _ in stats.queries
+                    if seconds >= self.slow_statement]
+        return QueryReport(endpoint, stats.query_count, self.budget_for(endpoint),
+                           repeated_statements(stats.queries, self.repeat_threshold), slow)
+
+    def check(self, stats):
+        report = self.report(stats)
+        if report.problems():
+            logger.warning(f'Query check failed for {report}')
+        reports = getattr(_recording, 'reports', None)
+        if reports is not None:
+            reports.append(report)
+        return report
+
+
+@contextmanager
+def assert_query_budget(budget=None):
+    """Fail the calling test if a request made in the block went over its query
+    budget (or budget, if given) or ran an N+1 pattern
+
+    Read streamed responses inside the block; their queries are checked
+    once they have been sent.
+    """
+    outer = getattr(_recording, 'reports', None)
+    reports = _recording.reports = []
+    try:
+        yield reports
+    finally:
+        _recording.reports = outer
+    if not reports:
+        raise RuntimeError('No request was checked; assert_query_budget() needs the app running with QUERY_DEBUG=1')
+    for report in reports:
+        if budget is not None:
+            report.budget = budget
+        # Slow statements depend on the machine running the tests, so they are only logged
+        assert not (report.over_budget or report.repeated), f'Query check failed for {report}'
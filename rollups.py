@@ -0,0 +1,98 @@
+"""
+Maintenance of the SmokingDailyRollup table
+
+record_logs() is called inside the same transaction that inserts SmokingLog
+rows, so the rollup never drifts from the raw log. rebuild_rollups() recomputes
+it from scratch and is used by backfill_rollups.py.
+"""
+from sqlalchemy import Integer, cast, extract, func
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import db, SmokingDailyRollup, SmokingLog
+
+COUNTER_COLUMNS = ('smoked_count', 'resisted_count', 'urge_sum')
+UPSERT_INSERTS = {'sqlite': sqlite_insert, 'postgresql': postgresql_insert}
+
+
+def _increments(logs):
+    """Sum the counter deltas for each (user_id, day, hour) key"""
+    deltas = {}
+    for log in logs:
+        if log.logged_at is None:
+            continue
+        key = (log.user_id, log.logged_at.date(), log.logged_at.hour)
+        delta = deltas.setdefault(key, dict.fromkeys(COUNTER_COLUMNS, 0))
+        if log.smoke_or_resist == 'Smoked':
+            delta['smoked_count'] += 1
+        else:
+            delta['resisted_count'] += 1
+        delta['urge_sum'] += log.urge_level
+    return deltas
+
+
+def upsert_counter_rows(model, key_names, rows, delta_names, assign_names=()):
+    """Add each row's deltas to the row with the same keys, creating it if needed
+
+    Every row holds values for key_names, delta_names and assign_names;
+    assign columns are written as-is rather than added to. All rows go to
+    the database as one executemany. The caller commits.
+    """
+    if not rows:
+        return
+    insert = UPSERT_INSERTS.get(db.session.get_bind().dialect.name)
+
+    if insert is None:
+        for values in rows:
+            keys = {name: values[name] for name in key_names}
+            row = db.session.query(model).filter_by(**keys).first()
+            if row is None:
+                db.session.add(model(**values))
+                continue
+            for name in delta_names:
+                setattr(row, name, getattr(row, name) + values[name])
+            for name in assign_names:
+                setattr(row, name, values[name])
+        return
+
+    table = model.__table__
+    stmt = insert(table)
+    set_ = {name: table.c[name] + stmt.excluded[name] for name in delta_names}
+    set_.update({name: stmt.excluded[name] for name in assign_names})
+    db.session.execute(stmt.on_conflict_do_update(index_elements=list(key_names), set_=set_), rows)
+
+
+def record_logs(logs):
+    """Fold new SmokingLog rows into the rollup; the caller commits"""
+    rows = [dict(user_id=user_id, day=day, hour=hour, **delta)
+            for (user_id, day, hour), delta in _increments(logs).items()]
+    upsert_counter_rows(SmokingDailyRollup, ['user_id', 'day', 'hour'], rows, COUNTER_COLUMNS)
+
+
+def rebuild_rollups(user_id=None):
+    """Recompute rollup rows from SmokingLog for one user, or everyone"""
+    delete = SmokingDailyRollup.__table__.delete()
+    if user_id is not None:
+        delete = delete.where(SmokingDailyRollup.user_id == user_id)
+    db.session.execute(delete)
+
+    day = func.date(SmokingLog.logged_at)
+    hour = cast(extract('hour', SmokingLog.logged_at), Integer)
+    grouped = db.select(
+        SmokingLog.user_id,
+        day,
+        hour,
+        func.sum(db.case((SmokingLog.smoke_or_resist == 'Smoked', 1), else_=0)),
+        func.sum(db.case((SmokingLog.smoke_or_resist == 'Smoked', 0), else_=1)),
+        func.sum(SmokingLog.urge_level)
+    ).where(SmokingLog.logged_at.isnot(None))
+    if user_id is not None:
+        grouped = grouped.where(SmokingLog.user_id == user_id)
+    grouped = grouped.group_by(SmokingLog.user_id, day, hour)
+
+    result = db.session.execute(
+        SmokingDailyRollup.__table__.insert().from_select(
+            ['user_id', 'day', 'hour', 'smoked_count', 'resisted_count', 'urge_sum'],
+            grouped
+        )
+    )
+    return result.rowcount
@@ -64,7 +64,7 @@ def create_admin(username='admin', email='admin@medical.com', password='admin123
             existing_admin.email = email
             existing_admin.name = 'Admin User'
             existing_admin.role = 'admin'
-            existing_admin.password_hash = generate_password_hash(password)
+            existing_admin.password_hash = generate_password_hash(password, app.config['PASSWORD_HASH_METHOD'])
             db.session.commit()
             print(f"✓ Updated existing admin user '{username}'")
         else:
@@ -74,7 +74,7 @@ def create_admin(username='admin', email='admin@medical.com', password='admin123
                 email=email,
                 name='Admin User',
                 role='admin',
-                password_hash=generate_password_hash(password)
+                password_hash=generate_password_hash(password, app.config['PASSWORD_HASH_METHOD'])
             )
             db.session.add(admin)
             db.session.commit()
@@ -0,0 +1,213 @@
+"""
+Content-addressed storage for uploaded medical reports
+
+Blobs are keyed by the SHA-256 of their contents and kept under a sharded
+path (ab/cd/abcd...), so the same PDF uploaded twice is stored once. Each
+MedicalReport points at its blob through content_hash; the number of rows
+sharing a hash is the blob's reference count, and the blob is deleted when
+the last of them goes.
+
+    storage = make_storage(app.config)
+    digest, size = storage.save(file.stream)
+    storage.path(digest)   # local file to send, or None for remote backends
+    storage.url(digest, filename, content_type)  # presigned URL, or None
+
+Files derived from a blob, such as preview images, are stored beside it
+under the same key with a suffix (save_derived/derived_path/derived_url)
+and are deleted with it.
+"""
+import glob
+import hashlib
+import os
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+
+
+def shard_key(digest):
+    """Relative storage key for a hex digest: ab/cd/abcd..."""
+    return f'{digest[:2]}/{digest[2:4]}/{digest}'
+
+
+def copy_hashing(stream, out):
+    """Copy stream into out in chunks; returns (sha256 hex digest, size)"""
+    sha = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        sha.update(chunk)
+        out.write(chunk)
+        size += len(chunk)
+    return sha.hexdigest(), size
+
+
+class LocalStorage:
+    """Blobs in a sharded directory tree on the local filesystem
+
+    Uploads are written to a temporary file in the same tree while being
+    hashed, then renamed into place, so a blob is never seen half-written.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, *shard_key(digest).split('/'))
+
+    def exists(self, digest):
+        return os.path.isfile(self.path(digest))
+
+    def save(self, stream):
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                digest, size = copy_hashing(stream, out)
+            target = self.path(digest)
+            if os.path.exists(target):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest, size
+
+    def open(self, digest):
+        return open(self.path(digest), 'rb')
+
+    def url(self, digest, filename, content_type, as_attachment=False):
+        return None
+
+    def derived_path(self, digest, name):
+        return f'{self.path(digest)}.{name}'
+
+    def save_derived(self, digest, name, data):
+        target = self.derived_path(digest, name)
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        with os.fdopen(fd, 'wb') as out:
+            out.write(data)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(tmp_path, target)
+
+    def derived_url(self, digest, name, content_type):
+        return None
+
+    def delete(self, digest):
+        path = self.path(digest)
+        for name in [path] + glob.glob(glob.escape(path) + '.*'):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+
+class S3Storage:
+    """Blobs in an S3-compatible bucket (AWS S3, MinIO, ...)
+
+    client may be anything with boto3's put_object/get_object/head_object/
+    delete_object/list_objects_v2/generate_presigned_url methods, such as a
+    local stand-in. By default a boto3 client is built, so boto3 is only
+    needed when this backend is in use. Reports are served by redirecting to a short-lived
+    presigned URL, which leaves Range requests to the object store.
+    """
+
+    def __init__(self, bucket, prefix='', client=None, url_expires=300,
+                 spool_size=8 * 1024 * 1024, **client_kwargs):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise RuntimeError('STORAGE_BACKEND=s3 requires boto3 (pip install boto3)')
+            client = boto3.client('s3', **client_kwargs)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.url_expires = url_expires
+        self.spool_size = spool_size
+
+    def key(self, digest):
+        return self.prefix + shard_key(digest)
+
+    def path(self, digest):
+        return None
+
+    def exists(self, digest):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(digest))
+        except Exception as e:
+            code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+            if code in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def save(self, stream):
+        # The key is only known once the whole upload is hashed, so spool it
+        # (in memory up to spool_size, then on disk) before sending
+        with tempfile.SpooledTemporaryFile(max_size=self.spool_size) as spool:
+            digest, size = copy_hashing(stream, spool)
+            if not self.exists(digest):
+                spool.seek(0)
+                self.client.put_object(Bucket=self.bucket, Key=self.key(digest),
+                                       Body=spool, ContentLength=size)
+        return digest, size
+
+    def open(self, digest):
+        return self.client.get_object(Bucket=self.bucket, Key=self.key(digest))['Body']
+
+    def url(self, digest, filename, content_type, as_attachment=False):
+        disposition = 'attachment' if as_attachment else 'inline'
+        return self.client.generate_presigned_url('get_object', Params={
+            'Bucket': self.bucket,
+            'Key': self.key(digest),
+            'ResponseContentType': content_type,
+            'ResponseContentDisposition': f'{disposition}; filename="{filename}"',
+        }, ExpiresIn=self.url_expires)
+
+    def derived_path(self, digest, name):
+        return None
+
+    def save_derived(self, digest, name, data):
+        self.client.put_object(Bucket=self.bucket, Key=f'{self.key(digest)}.{name}',
+                               Body=data, ContentLength=len(data))
+
+    def derived_url(self, digest, name, content_type):
+        return self.client.generate_presigned_url('get_object', Params={
+            'Bucket': self.bucket,
+            'Key': f'{self.key(digest)}.{name}',
+            'ResponseContentType': content_type,
+        }, ExpiresIn=self.url_expires)
+
+    def delete(self, digest):
+        key = self.key(digest)
+        listing = self.client.list_objects_v2(Bucket=self.bucket, Prefix=key + '.')
+        for obj in listing.get('Contents', []):
+            self.client.delete_object(Bucket=self.bucket, Key=obj['Key'])
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+
+def make_storage(config):
+    """Build the report storage backend from the STORAGE_* settings in config"""
+    backend = config.get('STORAGE_BACKEND', 'local')
+
+    if backend == 'local':
+        storage = LocalStorage(config.get('STORAGE_ROOT') or os.path.join(config['UPLOAD_FOLDER'], 'blobs'))
+        # X-Accel-Redirect paths are relative to UPLOAD_FOLDER, the directory
+        # the nginx location is aliased to
+        upload_root = os.path.abspath(config['UPLOAD_FOLDER'])
+        if config.get('REPORT_OFFLOAD') == 'x-accel-redirect' and \
+                os.path.commonpath([storage.root, upload_root]) != upload_root:
+            raise ValueError('REPORT_OFFLOAD=x-accel-redirect needs STORAGE_ROOT inside UPLOAD_FOLDER')
+        return storage
+    if backend == 's3':
+        client_kwargs = {}
+        if config.get('S3_ENDPOINT_URL'):
+            client_kwargs['endpoint_url'] = config['S3_ENDPOINT_URL']
+        return S3Storage(config['S3_BUCKET'], config.get('S3_PREFIX', ''), **client_kwargs)
+    raise ValueError(f'Unknown STORAGE_BACKEND: {backend}')
@@ -0,0 +1,102 @@
+"""
+Autocomplete suggestions for the smoking log form
+
+Values are counted per user and field in SmokingLogSuggestion as logs are
+inserted, so a lookup is an index prefix scan over that user's distinct values.
+Results are kept in a small LRU; each user's entries are dropped by bumping a
+per-user generation when they add a log.
+"""
+import itertools
+from datetime import datetime
+from sqlalchemy import func
+from cache import LRUCache
+from models import db, SmokingLog, SmokingLogSuggestion
+from rollups import upsert_counter_rows
+
+SUGGESTION_FIELDS = ('location', 'trigger', 'emotion', 'who_with')
+SUGGESTION_LIMIT = 7
+
+
+class SuggestionService:
+    """Cached prefix lookups over SmokingLogSuggestion"""
+
+    def __init__(self, max_entries=1024, ttl=60):
+        self.cache = LRUCache(max_entries, ttl)
+        self._generations = {}
+        self._counter = itertools.count(1)
+
+    def lookup(self, user_id, field, prefix=''):
+        """Most used values of field starting with prefix (case-insensitive)"""
+        prefix = prefix.strip().lower()
+        key = (user_id, self._generations.get(user_id, 0), field, prefix)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        query = db.session.query(SmokingLogSuggestion.value)\
+            .filter(SmokingLogSuggestion.user_id == user_id,
+                    SmokingLogSuggestion.field == field)
+        if prefix:
+            # Range bounds rather than LIKE so the index is used on every backend
+            query = query.filter(SmokingLogSuggestion.value_lower >= prefix,
+                                 SmokingLogSuggestion.value_lower < prefix + '\uffff')
+        values = [value for (value,) in query
+                  .order_by(SmokingLogSuggestion.count.desc(), SmokingLogSuggestion.last_used.desc())
+                  .limit(SUGGESTION_LIMIT)]
+
+        self.cache.set(key, values)
+        return values
+
+    def invalidate(self, user_id):
+        """Forget cached lookups for a user; call after their logs commit"""
+        self._generations[user_id] = next(self._counter)
+
+
+def record_suggestions(logs):
+    """Count the autocomplete values of new SmokingLog rows; the caller commits"""
+    now = datetime.utcnow()
+    counts = {}
+    for log in logs:
+        for field in SUGGESTION_FIELDS:
+            value = getattr(log, field)
+            if value and value.strip():
+                key = (log.user_id, field, value)
+                counts[key] = counts.get(key, 0) + 1
+
+    rows = [{'user_id': user_id, 'field': field, 'value': value, 'count': count,
+             'value_lower': value.strip().lower(), 'last_used': now}
+            for (user_id, field, value), count in counts.items()]
+    upsert_counter_rows(SmokingLogSuggestion, ['user_id', 'field', 'value'], rows,
+                        ['count'], ['value_lower', 'last_used'])
+
+
+def rebuild_suggestions(user_id=None):
+    """Recompute SmokingLogSuggestion from SmokingLog for one user, or everyone"""
+    delete = SmokingLogSuggestion.__table__.delete()
+    if user_id is not None:
+        delete = delete.where(SmokingLogSuggestion.user_id == user_id)
+    db.session.execute(delete)
+
+    rows = 0
+    for field in SUGGESTION_FIELDS:
+        column = getattr(SmokingLog, field)
+        grouped = db.select(
+            SmokingLog.user_id,
+            db.literal(field),
+            column,
+            func.lower(func.trim(column)),
+            func.count(SmokingLog.id),
+            func.max(SmokingLog.created_at)
+        ).where(column.isnot(None), func.trim(column) != '')
+        if user_id is not None:
+            grouped = grouped.where(SmokingLog.user_id == user_id)
+        grouped = grouped.group_by(SmokingLog.user_id, column)
+
+        result = db.session.execute(
+            SmokingLogSuggestion.__table__.insert().from_select(
+                ['user_id', 'field', 'value', 'value_lower', 'count', 'last_used'],
+                grouped
+            )
+        )
+        rows += result.rowcount
+    return rows
@@ -0,0 +1,105 @@
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+
+# app.py reads its configuration when it is imported, so point it at a
+# throwaway database and cache directory first
+_tmp = tempfile.mkdtemp(prefix='medical-tracker-tests-')
+os.environ.update({
+    'DATABASE_URL': f'sqlite:///{os.path.join(_tmp, "test.db")}',
+    'CACHE_SQLITE_PATH': os.path.join(_tmp, 'cache.sqlite3'),
+    'LOGIN_THROTTLE_PATH': os.path.join(_tmp, 'login_throttle.sqlite3'),
+    'METRICS_DIR': os.path.join(_tmp, 'metrics'),
+    'STORAGE_ROOT': os.path.join(_tmp, 'blobs'),
+    'UPLOAD_TMP_FOLDER': os.path.join(_tmp, 'partial'),
+    'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+    'PASSWORD_HASH_WORKERS': '0',
+    'PREVIEW_WORKERS': '0',
+    'QUERY_DEBUG': '1',
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PASSWORD = 'secret1'
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import app, password_hasher
+    from models import db, User, SmokingLog
+    from rollups import record_logs
+    from suggestions import record_suggestions
+
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with app.app_context():
+        password_hash = password_hasher.hash(PASSWORD)
+        for username, role in (('doctor', 'doctor'), ('patient', 'patient'), ('admin', 'admin')):
+            db.session.add(User(username=username, email=f'{username}@example.com', name=username.title(),
+                                role=role, password_hash=password_hash))
+        db.session.commit()
+
+        patient = User.query.filter_by(username='patient').one()
+        now = datetime.utcnow()
+        logs = []
+        for i in range(200):
+            logged_at = now - timedelta(hours=7 * i)
+            logs.append(SmokingLog(user_id=patient.id, date=logged_at.strftime('%Y-%m-%d'),
+                                   time=logged_at.strftime('%H:%M'), logged_at=logged_at,
+                                   location=('Home', 'Work', 'Car')[i % 3], trigger=('Stress', 'Coffee')[i % 2],
+                                   emotion=('Anxious', 'Calm')[i % 2], who_with='Alone', urge_level=i % 5 + 1,
+                                   smoke_or_resist=('Smoked', 'Resisted')[i % 3 == 0]))
+        db.session.add_all(logs)
+        record_logs(logs)
+        record_suggestions(logs)
+        db.session.commit()
+    return app
+
+
+def login(app, username):
+    client = app.test_client()
+    response = client.post('/login', data={'login': username, 'password': PASSWORD})
+    assert response.status_code == 302, f'login as {username} failed'
+    return client
+
+
+@pytest.fixture
+def patient_client(app):
+    return login(app, 'patient')
+
+
+@pytest.fixture
+def doctor_client(app):
+    return login(app, 'doctor')
+
+
+@pytest.fixture
+def admin_client(app):
+    return login(app, 'admin')
+
+
+@pytest.fixture
+def new_patient(app):
+    """Create a patient with no logs; returns (user id, logged-in client)"""
+    from app import password_hasher
+    from models import db, User
+    created = []
+
+    def create():
+        username = f'patient{len(created)}_{os.urandom(4).hex()}'
+        with app.app_context():
+            user = User(username=username, email=f'{username}@example.com', name=username.title(),
+                        role='patient', password_hash=password_hasher.hash(PASSWORD))
+            db.session.add(user)
+            db.session.commit()
+            created.append(user.id)
+        return created[-1], login(app, username)
+    return create
+
+
+@pytest.fixture
+def patient_id(app):
+    from models import User
+    with app.app_context():
+        return User.query.filter_by(username='patient').one().id
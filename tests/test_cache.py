@@ -0,0 +1,72 @@
+"""Generation-based invalidation in TieredCache"""
+import pytest
+
+from cache import LRUCache, SQLiteCache, TieredCache
+
+
+@pytest.fixture
+def shared_path(tmp_path):
+    return str(tmp_path / 'cache.sqlite3')
+
+
+def tiered(shared_path, namespace='analytics'):
+    """One worker's view: its own LRU in front of the shared file"""
+    return TieredCache(namespace, LRUCache(16, 60), SQLiteCache(shared_path))
+
+
+def test_invalidate_hides_stored_values(shared_path):
+    cache = tiered(shared_path)
+    cache.set(1, {'logs': 3}, variant='2024-05-01')
+    assert cache.get(1, variant='2024-05-01') == {'logs': 3}
+
+    cache.invalidate(1)
+    assert cache.get(1, variant='2024-05-01') is None
+    assert cache.stats()['invalidations'] == 1
+
+
+def test_invalidation_is_per_entity(shared_path):
+    cache = tiered(shared_path)
+    cache.set(1, 'one')
+    cache.set(2, 'two')
+    cache.invalidate(1)
+    assert cache.get(1) is None
+    assert cache.get(2) == 'two'
+
+
+def test_value_computed_before_an_invalidation_is_not_served(shared_path):
+    cache = tiered(shared_path)
+    generation = cache.generation(1)
+    assert cache.get(1, generation=generation) is None
+    stale = {'logs': 3}  # computed from the database as it was
+    cache.invalidate(1)  # a write lands while it is being computed
+    cache.set(1, stale, generation=generation)
+
+    assert cache.get(1) is None
+
+
+def test_other_workers_see_the_invalidation(shared_path):
+    first, second = tiered(shared_path), tiered(shared_path)
+    first.set(1, 'old')
+    assert second.get(1) == 'old'  # now also in second's local tier
+
+    first.invalidate(1)
+    assert second.get(1) is None
+    second.set(1, 'new')
+    assert first.get(1) == 'new'
+
+
+def test_namespaces_do_not_share_entries(shared_path):
+    analytics, patterns = tiered(shared_path, 'analytics'), tiered(shared_path, 'patterns')
+    analytics.set(1, 'a')
+    assert patterns.get(1) is None
+    analytics.invalidate(1)
+    patterns.set(1, 'p')
+    assert patterns.get(1) == 'p'
+
+
+def test_local_only_cache_counts_generations_in_process():
+    cache = TieredCache('identity', LRUCache(16, 60))
+    cache.set(7, 'x')
+    cache.invalidate(7)
+    assert cache.get(7) is None
+    assert cache.generation(7) == 1
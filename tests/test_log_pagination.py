@@ -0,0 +1,66 @@
+"""Keyset (cursor) pagination of a patient's smoking logs"""
+from models import db, SmokingLog
+
+# Several logs share a date, and two share date and time, so the id breaks ties
+STAMPS = [('2024-05-01', '08:00'), ('2024-05-01', '08:00'), ('2024-05-01', '21:15'),
+          ('2024-05-02', '07:30'), ('2024-04-30', '23:59'), ('2024-05-02', '07:30'),
+          ('2024-05-03', '12:00')]
+
+
+def add_logs(app, user_id):
+    with app.app_context():
+        for date, time in STAMPS:
+            db.session.add(SmokingLog(user_id=user_id, date=date, time=time,
+                                      logged_at=SmokingLog.parse_logged_at(date, time),
+                                      urge_level=3, smoke_or_resist='Smoked'))
+        db.session.commit()
+        logs = SmokingLog.query.filter_by(user_id=user_id).all()
+        return [log.id for log in sorted(logs, key=lambda log: (log.date, log.time, log.id), reverse=True)]
+
+
+def test_pages_cover_every_log_once_newest_first(app, new_patient, doctor_client):
+    user_id, _ = new_patient()
+    expected = add_logs(app, user_id)
+
+    seen = []
+    cursor = None
+    pages = 0
+    while True:
+        query = {'limit': 3} if cursor is None else {'limit': 3, 'cursor': cursor}
+        body = doctor_client.get(f'/doctor/patient/{user_id}/logs', query_string=query).get_json()
+        assert len(body['logs']) <= 3
+        seen += [log['id'] for log in body['logs']]
+        pages += 1
+        cursor = body['next_cursor']
+        if cursor is None:
+            break
+
+    assert seen == expected
+    assert pages == 3
+
+
+def test_logs_added_meanwhile_do_not_shift_later_pages(app, new_patient, doctor_client):
+    user_id, _ = new_patient()
+    expected = add_logs(app, user_id)
+    first = doctor_client.get(f'/doctor/patient/{user_id}/logs', query_string={'limit': 3}).get_json()
+
+    # A new log sorts first; an offset-based second page would repeat a row
+    with app.app_context():
+        db.session.add(SmokingLog(user_id=user_id, date='2024-06-01', time='10:00',
+                                  urge_level=2, smoke_or_resist='Resisted'))
+        db.session.commit()
+
+    second = doctor_client.get(f'/doctor/patient/{user_id}/logs',
+                               query_string={'limit': 3, 'cursor': first['next_cursor']}).get_json()
+    assert [log['id'] for log in second['logs']] == expected[3:6]
+
+
+def test_invalid_cursor(new_patient, doctor_client):
+    user_id, _ = new_patient()
+    response = doctor_client.get(f'/doctor/patient/{user_id}/logs', query_string={'cursor': 'not-a-cursor'})
+    assert response.status_code == 400
+
+
+def test_patients_cannot_page_logs(new_patient):
+    user_id, client = new_patient()
+    assert client.get(f'/doctor/patient/{user_id}/logs').status_code == 403
@@ -0,0 +1,56 @@
+"""Streaming log export"""
+import csv
+import io
+from datetime import datetime
+
+from logexport import EXPORT_FIELDS, iter_csv
+
+
+def row(**values):
+    defaults = dict.fromkeys(EXPORT_FIELDS)
+    defaults.update(id=1, date='2024-05-01', time='08:00', logged_at=datetime(2024, 5, 1, 8),
+                    urge_level=3, smoke_or_resist='Smoked')
+    defaults.update(values)
+    return tuple(defaults[field] for field in EXPORT_FIELDS)
+
+
+def parse(chunks):
+    return list(csv.DictReader(io.StringIO(''.join(chunks))))
+
+
+def test_formula_cells_are_escaped():
+    rows = parse(iter_csv([[row(location='=HYPERLINK("http://x","y")', trigger='+1', emotion='-2',
+                                who_with='@SUM(A1)', notes='\tindented', how_it_felt='\rreturn')]]))
+    assert rows[0]['location'] == '\'=HYPERLINK("http://x","y")'
+    assert rows[0]['trigger'] == "'+1"
+    assert rows[0]['emotion'] == "'-2"
+    assert rows[0]['who_with'] == "'@SUM(A1)"
+    assert rows[0]['notes'] == "'\tindented"
+    assert rows[0]['how_it_felt'] == "'\rreturn"
+
+
+def test_ordinary_values_are_unchanged():
+    rows = parse(iter_csv([[row(location='Home', notes='felt ok - mostly', urge_level=5)]]))
+    assert rows[0]['location'] == 'Home'
+    assert rows[0]['notes'] == 'felt ok - mostly'
+    assert rows[0]['urge_level'] == '5'
+    assert rows[0]['logged_at'] == '2024-05-01 08:00:00'
+    assert rows[0]['emotion'] == ''
+
+
+def test_one_chunk_per_batch_after_the_header():
+    chunks = list(iter_csv([[row(id=1), row(id=2)], [row(id=3)]]))
+    assert len(chunks) == 3
+    assert chunks[0].strip() == ','.join(EXPORT_FIELDS)
+    assert [r['id'] for r in parse(chunks)] == ['1', '2', '3']
+
+
+def test_export_endpoint_escapes_patient_text(new_patient, doctor_client):
+    user_id, client = new_patient()
+    client.post('/api/smoking-logs/batch', json={'entries': [
+        {'client_id': 'f', 'date': '2024-05-01', 'time': '08:00', 'smoke_or_resist': 'Smoked',
+         'urge_level': 3, 'notes': '=cmd|"/c calc"!A1'}]})
+    response = doctor_client.get(f'/doctor/patient/{user_id}/export.csv')
+    assert response.status_code == 200
+    rows = parse([response.get_data(as_text=True)])
+    assert rows[0]['notes'].startswith("'=")
@@ -0,0 +1,75 @@
+"""Batch sync of smoking logs recorded offline"""
+from models import SmokingLog
+
+
+def entry(client_id, **fields):
+    values = {'client_id': client_id, 'date': '2024-03-01', 'time': '08:30',
+              'smoke_or_resist': 'Smoked', 'urge_level': 3}
+    values.update(fields)
+    return values
+
+
+def sync(client, *entries):
+    response = client.post('/api/smoking-logs/batch', json={'entries': list(entries)})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def log_count(app, user_id):
+    with app.app_context():
+        return SmokingLog.query.filter_by(user_id=user_id).count()
+
+
+def test_retried_batch_is_not_stored_twice(app, new_patient):
+    user_id, client = new_patient()
+    first = sync(client, entry('a'), entry('b', time='09:00'))
+    assert first['created'] == 2
+    assert [result['status'] for result in first['results']] == ['created', 'created']
+
+    retry = sync(client, entry('a'), entry('b', time='09:00'), entry('c'))
+    assert retry['created'] == 1
+    assert [result['status'] for result in retry['results']] == ['duplicate', 'duplicate', 'created']
+    assert [result['id'] for result in retry['results'][:2]] == [result['id'] for result in first['results']]
+    assert log_count(app, user_id) == 3
+
+
+def test_client_ids_are_per_patient(app, new_patient):
+    first_id, first = new_patient()
+    second_id, second = new_patient()
+    assert sync(first, entry('shared'))['created'] == 1
+    assert sync(second, entry('shared'))['created'] == 1
+    assert log_count(app, first_id) == log_count(app, second_id) == 1
+
+
+def test_repeated_client_id_in_one_batch(app, new_patient):
+    user_id, client = new_patient()
+    body = sync(client, entry('x'), entry('x', time='10:00'))
+    assert body['results'][0]['status'] == 'created'
+    assert body['results'][1] == {'client_id': 'x', 'status': 'invalid', 'error': 'client_id repeated in batch'}
+    assert log_count(app, user_id) == 1
+
+
+def test_invalid_entries_do_not_block_the_rest(app, new_patient):
+    user_id, client = new_patient()
+    body = sync(client, entry('ok'), {'date': '2024-03-01'}, entry('bool', urge_level=True),
+                entry('frac', urge_level=2.5), entry('high', urge_level=6), entry('late', date='2024-02-30'))
+    assert [result['status'] for result in body['results']] == ['created'] + ['invalid'] * 5
+    assert log_count(app, user_id) == 1
+
+
+def test_dates_and_times_are_stored_zero_padded(app, new_patient):
+    user_id, client = new_patient()
+    sync(client, entry('unpadded', date='2024-1-5', time='9:5'))
+    with app.app_context():
+        log = SmokingLog.query.filter_by(user_id=user_id).one()
+        assert (log.date, log.time) == ('2024-01-05', '09:05')
+
+
+def test_body_must_be_an_object(new_patient):
+    _, client = new_patient()
+    assert client.post('/api/smoking-logs/batch', json=[entry('a')]).status_code == 400
+    assert client.post('/api/smoking-logs/batch', json={'entries': 'a'}).status_code == 400
+
+
+def test_doctors_cannot_sync(doctor_client):
+    assert doctor_client.post('/api/smoking-logs/batch', json={'entries': []}).status_code == 403
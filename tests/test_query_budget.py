@@ -0,0 +1,61 @@
+"""The main pages stay within their query budgets and run no N+1 patterns"""
+import pytest
+from querydebug import assert_query_budget
+
+
+@pytest.fixture(autouse=True)
+def cold_caches(app, patient_id):
+    """Every test starts from empty caches, the most expensive case"""
+    from app import analytics_cache, cohort_cache, identity_cache, patterns_cache
+    from models import User
+    with app.app_context():
+        for (user_id,) in User.query.with_entities(User.id):
+            identity_cache.invalidate(user_id)
+    analytics_cache.invalidate(patient_id)
+    patterns_cache.invalidate(patient_id)
+    cohort_cache.invalidate('cohort')
+
+
+def get(client, path):
+    response = client.get(path)
+    response.close()
+    assert response.status_code == 200, path
+    return response
+
+
+def test_patient_pages(patient_client):
+    with assert_query_budget():
+        get(patient_client, '/patient/dashboard')
+        get(patient_client, '/autocomplete/location?q=h')
+
+
+def test_doctor_pages(doctor_client, patient_id):
+    with assert_query_budget():
+        get(doctor_client, '/doctor/dashboard')
+        get(doctor_client, '/doctor/cohort')
+        get(doctor_client, '/api/cohort')
+        get(doctor_client, f'/api/patients/{patient_id}/analytics')
+        get(doctor_client, f'/api/patients/{patient_id}/patterns')
+        get(doctor_client, f'/doctor/patient/{patient_id}/logs')
+        get(doctor_client, f'/doctor/patient/{patient_id}/export.csv')
+
+
+def test_view_patient_data_cold_and_warm(doctor_client, patient_id):
+    with assert_query_budget() as reports:
+        get(doctor_client, f'/doctor/patient/{patient_id}')
+        get(doctor_client, f'/doctor/patient/{patient_id}')
+    cold, warm = reports
+    assert warm.query_count < cold.query_count
+
+
+def test_admin_pages(admin_client, patient_id):
+    with assert_query_budget():
+        get(admin_client, '/admin/dashboard')
+        get(admin_client, f'/admin/users/{patient_id}')
+        get(admin_client, '/admin/dashboard?q=PAT')
+
+
+def test_budget_overrun_fails(doctor_client):
+    with pytest.raises(AssertionError, match='budget 1'):
+        with assert_query_budget(budget=1):
+            get(doctor_client, '/doctor/dashboard')
@@ -0,0 +1,141 @@
+"""Content-addressed report storage, with S3 run against an in-memory stand-in"""
+import hashlib
+import io
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from storage import LocalStorage, S3Storage, shard_key
+
+PDF = b'%PDF-1.4 storage test'
+DIGEST = hashlib.sha256(PDF).hexdigest()
+
+
+class ClientError(Exception):
+    """Shaped like botocore's ClientError, which S3Storage inspects"""
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+
+class FakeS3Client:
+    """The part of boto3's S3 client that S3Storage uses, kept in memory"""
+
+    def __init__(self):
+        self.objects = {}  # (bucket, key) -> bytes
+        self.puts = 0
+
+    def put_object(self, Bucket, Key, Body, ContentLength):
+        data = Body if isinstance(Body, bytes) else Body.read()
+        assert len(data) == ContentLength
+        self.objects[(Bucket, Key)] = data
+        self.puts += 1
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError('404')
+        return {'ContentLength': len(self.objects[(Bucket, Key)])}
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError('NoSuchKey')
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def list_objects_v2(self, Bucket, Prefix):
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        return {'Contents': [{'Key': key} for key in keys]} if keys else {}
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        assert operation == 'get_object'
+        query = {name: value for name, value in Params.items() if name not in ('Bucket', 'Key')}
+        query['Expires'] = ExpiresIn
+        return f'https://s3.test/{Params["Bucket"]}/{Params["Key"]}?' + \
+            '&'.join(f'{name}={value}' for name, value in query.items())
+
+
+@pytest.fixture
+def s3():
+    return S3Storage('reports', prefix='/medical/', client=FakeS3Client(), spool_size=8)
+
+
+def test_s3_save_stores_under_the_content_hash(s3):
+    digest, size = s3.save(io.BytesIO(PDF))
+    assert (digest, size) == (DIGEST, len(PDF))
+    assert s3.client.objects[('reports', 'medical/' + shard_key(DIGEST))] == PDF
+    assert s3.exists(digest)
+    assert s3.open(digest).read() == PDF
+    assert s3.path(digest) is None
+
+
+def test_s3_save_skips_blobs_already_stored(s3):
+    s3.save(io.BytesIO(PDF))
+    assert s3.save(io.BytesIO(PDF)) == (DIGEST, len(PDF))
+    assert s3.client.puts == 1
+    s3.save(io.BytesIO(PDF + b'!'))
+    assert s3.client.puts == 2
+
+
+def test_s3_delete_removes_the_blob_and_its_derived_files(s3):
+    other, _ = s3.save(io.BytesIO(b'another report'))
+    s3.save(io.BytesIO(PDF))
+    s3.save_derived(DIGEST, 'thumb.jpg', b'jpeg')
+    s3.save_derived(DIGEST, 'preview.jpg', b'jpeg')
+
+    s3.delete(DIGEST)
+    assert not s3.exists(DIGEST)
+    assert [key for _, key in s3.client.objects] == ['medical/' + shard_key(other)]
+
+
+def test_s3_exists_reraises_other_errors(s3):
+    def denied(**kwargs):
+        raise ClientError('403')
+    s3.client.head_object = denied
+    with pytest.raises(ClientError):
+        s3.exists(DIGEST)
+
+
+def test_s3_presigned_urls(s3):
+    digest, _ = s3.save(io.BytesIO(PDF))
+    url = urlsplit(s3.url(digest, 'scan.pdf', 'application/pdf', as_attachment=True))
+    assert url.path == '/reports/medical/' + shard_key(digest)
+    query = parse_qs(url.query)
+    assert query['ResponseContentType'] == ['application/pdf']
+    assert query['ResponseContentDisposition'] == ['attachment; filename="scan.pdf"']
+    assert query['Expires'] == [str(s3.url_expires)]
+
+    inline = parse_qs(urlsplit(s3.url(digest, 'scan.pdf', 'application/pdf')).query)
+    assert inline['ResponseContentDisposition'] == ['inline; filename="scan.pdf"']
+    assert urlsplit(s3.derived_url(digest, 'thumb.jpg', 'image/jpeg')).path.endswith(shard_key(digest) + '.thumb.jpg')
+
+
+def test_reports_on_s3_are_served_by_redirect(app, new_patient, s3, monkeypatch):
+    import app as app_module
+    monkeypatch.setattr(app_module, 'storage', s3)
+    _, client = new_patient()
+    response = client.post('/patient/upload-report', content_type='multipart/form-data',
+                           data={'report_name': 'Scan', 'file': (io.BytesIO(PDF), 'scan.pdf')})
+    assert response.status_code == 302
+    assert s3.exists(DIGEST)
+
+    with app.app_context():
+        from models import MedicalReport
+        report_id = MedicalReport.query.filter_by(content_hash=DIGEST).one().id
+    response = client.get(f'/download/{report_id}')
+    assert response.status_code == 302
+    assert response.location.startswith('https://s3.test/reports/medical/' + shard_key(DIGEST))
+
+
+def test_local_save_deduplicates_and_deletes(tmp_path):
+    local = LocalStorage(str(tmp_path))
+    assert local.save(io.BytesIO(PDF)) == (DIGEST, len(PDF))
+    assert local.save(io.BytesIO(PDF)) == (DIGEST, len(PDF))
+    assert local.path(DIGEST) == str(tmp_path.joinpath(*shard_key(DIGEST).split('/')))
+    local.save_derived(DIGEST, 'thumb.jpg', b'jpeg')
+
+    local.delete(DIGEST)
+    assert not local.exists(DIGEST)
+    assert not (tmp_path.joinpath(*shard_key(DIGEST).split('/')).with_name(DIGEST + '.thumb.jpg')).exists()
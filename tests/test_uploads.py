@@ -0,0 +1,83 @@
+"""Resumable report uploads"""
+import hashlib
+
+BODY = b'%PDF-1.4 resumable upload test body'
+
+
+def start(client, size=len(BODY), **fields):
+    body = {'filename': 'scan.pdf', 'report_name': 'Scan', 'size': size}
+    body.update(fields)
+    return client.post('/patient/uploads', json=body)
+
+
+def send(client, upload_id, offset, chunk):
+    return client.patch(f'/patient/uploads/{upload_id}', data=chunk,
+                        headers={'Upload-Offset': str(offset), 'Content-Type': 'application/offset+octet-stream'})
+
+
+def test_upload_resumes_from_the_server_offset(new_patient):
+    _, client = new_patient()
+    response = start(client, sha256=hashlib.sha256(BODY).hexdigest())
+    assert response.status_code == 201
+    upload_id = response.get_json()['upload_id']
+    assert response.get_json()['offset'] == 0
+
+    assert send(client, upload_id, 0, BODY[:10]).get_json()['offset'] == 10
+    # A retried chunk (wrong offset) is refused with the offset to resume from
+    response = send(client, upload_id, 0, BODY[:10])
+    assert response.status_code == 409
+    assert response.get_json()['offset'] == 10
+    assert client.get(f'/patient/uploads/{upload_id}').get_json()['offset'] == 10
+
+    # Finalizing before every byte has arrived is refused too
+    assert client.post(f'/patient/uploads/{upload_id}/finalize').status_code == 409
+
+    assert send(client, upload_id, 10, BODY[10:]).get_json()['offset'] == len(BODY)
+    response = client.post(f'/patient/uploads/{upload_id}/finalize')
+    assert response.status_code == 201
+
+    download = client.get(response.get_json()['url'])
+    assert download.status_code == 200
+    assert download.data == BODY
+    download.close()
+
+
+def test_chunk_past_the_declared_size_is_refused(new_patient):
+    _, client = new_patient()
+    upload_id = start(client, size=4).get_json()['upload_id']
+    assert send(client, upload_id, 0, b'12345').status_code == 413
+    assert client.get(f'/patient/uploads/{upload_id}').get_json()['offset'] == 0
+
+
+def test_checksum_mismatch_discards_the_upload(new_patient):
+    _, client = new_patient()
+    upload_id = start(client).get_json()['upload_id']
+    send(client, upload_id, 0, BODY)
+    response = client.post(f'/patient/uploads/{upload_id}/finalize', json={'sha256': '0' * 64})
+    assert response.status_code == 422
+    assert client.get(f'/patient/uploads/{upload_id}').status_code == 404
+
+
+def test_checksum_is_required(new_patient):
+    _, client = new_patient()
+    upload_id = start(client).get_json()['upload_id']
+    send(client, upload_id, 0, BODY)
+    assert client.post(f'/patient/uploads/{upload_id}/finalize').status_code == 400
+
+
+def test_invalid_upload_requests(new_patient):
+    _, client = new_patient()
+    assert start(client, size=True).status_code == 400
+    assert start(client, size='10').status_code == 400
+    assert start(client, size=0).status_code == 400
+    assert start(client, filename='script.exe').status_code == 400
+    assert start(client, sha256='not-a-hash').status_code == 400
+    assert client.post('/patient/uploads', json=['scan.pdf']).status_code == 400
+
+
+def test_uploads_belong_to_their_patient(new_patient):
+    _, owner = new_patient()
+    _, other = new_patient()
+    upload_id = start(owner).get_json()['upload_id']
+    assert other.get(f'/patient/uploads/{upload_id}').status_code == 404
+    assert send(other, upload_id, 0, BODY).status_code == 404
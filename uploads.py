@@ -0,0 +1,67 @@
+"""
+Resumable report uploads
+
+A client opens an UploadSession, sends the file as raw chunks at increasing
+offsets and finalizes it with the file's SHA-256. Chunks are written straight
+to a part file on disk, so memory use stays at one read buffer whatever the
+file size. After a dropped connection the client asks for the session's
+offset and carries on from there.
+"""
+import os
+import secrets
+from datetime import datetime, timedelta
+from models import db, UploadSession
+from storage import CHUNK_SIZE
+
+
+def new_upload_id():
+    return secrets.token_hex(16)
+
+
+def part_path(folder, upload_id):
+    """Part file holding the bytes received so far for an upload"""
+    return os.path.join(os.path.abspath(folder), f'{upload_id}.part')
+
+
+def write_chunk(path, offset, stream, length):
+    """Copy up to length bytes from stream into path at offset; returns bytes written
+
+    A short count means the client went away mid-chunk. The bytes that did
+    arrive are valid, so the caller still records them.
+    """
+    written = 0
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as out:
+        out.seek(offset)
+        while written < length:
+            chunk = stream.read(min(CHUNK_SIZE, length - written))
+            if not chunk:
+                break
+            out.write(chunk)
+            written += len(chunk)
+    return written
+
+
+def advance(upload, offset, written):
+    """Record written bytes at offset; False if another request moved the offset first"""
+    result = db.session.execute(
+        db.update(UploadSession)
+        .where(UploadSession.id == upload.id, UploadSession.received == offset)
+        .values(received=offset + written, updated_at=datetime.utcnow())
+    )
+    return result.rowcount == 1
+
+
+def discard(upload, folder):
+    """Delete an upload and its part file; the caller commits"""
+    try:
+        os.remove(part_path(folder, upload.id))
+    except FileNotFoundError:
+        pass
+    db.session.delete(upload)
+
+
+def purge_expired(folder, ttl):
+    """Discard uploads idle for longer than ttl seconds; the caller commits"""
+    cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+    for upload in UploadSession.query.filter(UploadSession.updated_at < cutoff).all():
+        discard(upload, folder)